@@ -1,12 +1,41 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, g
+from flask import (Flask, render_template, request, jsonify, session, redirect, url_for, flash, g, Response,
+                   has_app_context, has_request_context, send_file)
+from markupsafe import Markup
 import sqlite3
 from datetime import datetime, timezone, timedelta
 from functools import wraps
+import click
 import os
+import json
+import gzip
+import zlib
+import hashlib
+import math
+import unicodedata
+import bisect
+import re
+import csv
+import io
+import tempfile
+import threading
+import queue
+import time
+import pathlib
+import atexit
+from contextlib import contextmanager
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:  # Windows (testes locais)
+    fcntl = None
+try:
+    import brotli
+except ImportError:  # opcional: sem ele só há variantes .gz
+    brotli = None
 
 app = Flask(__name__)
 app.secret_key = 'alerta_nampula_2025_ultra_secret_key'
-DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alerta.db')
+DB = os.environ.get('ALERTA_DB') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alerta.db')
 
 # Mozambique time: CAT = UTC+2
 CAT = timezone(timedelta(hours=2))
@@ -14,24 +43,494 @@ CAT = timezone(timedelta(hours=2))
 def now_cat():
     return datetime.now(CAT).strftime('%Y-%m-%d %H:%M:%S')
 
+# ── Pool de ligações SQLite (um por worker) ───────────────────
+# Leituras usam ligações só-de-leitura emprestadas por pedido; as escritas
+# passam por uma única ligação de escrita por worker, guardada por um lock.
+# Em modo WAL os leitores nunca esperam pelo escritor.
+PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",      # 16 MB
+    "PRAGMA mmap_size = 67108864",     # 64 MB
+    "PRAGMA temp_store = MEMORY",
+)
+
+class PoolEsgotado(Exception):
+    """Nenhuma ligação de leitura ficou livre dentro de PoolSQLite.ESPERA_S."""
+
+class PoolSQLite:
+    LEITORES = int(os.environ.get('DB_LEITORES', 4))      # gunicorn.conf.py ajusta às threads
+    ESPERA_S = float(os.environ.get('DB_ESPERA_S', 5))
+    TENTATIVAS = 3
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.pid = None
+        self.lock_preparar = threading.Lock()
+        self.metricas = {'leituras_emprestadas': 0, 'leituras_espera_s': 0.0, 'leituras_esgotadas': 0,
+                         'escritas': 0, 'escrita_espera_s': 0.0,
+                         'busy_retries': 0, 'busy_falhas': 0}
+
+    def _ligar(self, so_leitura=False):
+        if so_leitura:
+            uri = pathlib.Path(self.caminho).as_uri() + '?mode=ro'
+            db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            db = sqlite3.connect(self.caminho, check_same_thread=False)
+            db.execute("PRAGMA journal_mode = WAL")
+        for p in PRAGMAS:
+            db.execute(p)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _preparar(self):
+        # Depois de um fork (gunicorn) cada worker abre as suas ligações
+        with self.lock_preparar:
+            if self.pid == os.getpid():
+                return
+            self.lock_escrita = threading.Lock()
+            self.escritor = self._ligar()
+            self.livres = queue.LifoQueue()
+            self.criados = 0
+            self.lock_criar = threading.Lock()
+            self.pid = os.getpid()
+
+    def emprestar(self):
+        self._preparar()
+        t = time.perf_counter()
+        try:
+            db = self.livres.get_nowait()
+        except queue.Empty:
+            with self.lock_criar:
+                criar = self.criados < self.LEITORES
+                if criar: self.criados += 1
+            if criar:
+                db = self._ligar(so_leitura=True)
+            else:
+                # Um empréstimo lento ou perdido não pode prender os pedidos seguintes
+                try:
+                    db = self.livres.get(timeout=self.ESPERA_S)
+                except queue.Empty:
+                    self.metricas['leituras_esgotadas'] += 1
+                    raise PoolEsgotado(f'{self.LEITORES} leitores ocupados há {self.ESPERA_S}s') from None
+        self.metricas['leituras_emprestadas'] += 1
+        self.metricas['leituras_espera_s'] += time.perf_counter() - t
+        return db
+
+    def devolver(self, db):
+        if db.in_transaction:
+            db.rollback()
+        self.livres.put(db)
+
+    @contextmanager
+    def escrita(self):
+        self._preparar()
+        t = time.perf_counter()
+        with self.lock_escrita:
+            self.metricas['escrita_espera_s'] += time.perf_counter() - t
+            self.metricas['escritas'] += 1
+            try:
+                yield self.escritor
+            except Exception:
+                if self.escritor.in_transaction:
+                    self.escritor.rollback()
+                raise
+
+    def transacao(self, fn):
+        # Corre fn(db) numa transacção de escrita. Outro worker pode ter a BD
+        # bloqueada para além do busy_timeout: tenta de novo.
+        for tentativa in range(self.TENTATIVAS):
+            try:
+                with self.escrita() as db:
+                    db.execute("BEGIN IMMEDIATE")
+                    resultado = fn(db)
+                    db.commit()
+                    return resultado
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                if tentativa == self.TENTATIVAS - 1:
+                    self.metricas['busy_falhas'] += 1
+                    raise
+                self.metricas['busy_retries'] += 1
+                time.sleep(0.05 * (tentativa + 1))
+
+    def escrever(self, sql, args=()):
+        return self.transacao(lambda db: db.execute(sql, args).lastrowid)
+
+    def estado(self):
+        self._preparar()
+        return dict(self.metricas, leitores_abertos=self.criados,
+                    leitores_livres=self.livres.qsize(), pid=self.pid)
+
+pool = PoolSQLite(DB)
+
+# ── Fila de escrita com group commit (inserções do USSD) ──────
+# Uma thread por worker junta as inserções em lotes (até LOTE_MAX linhas ou
+# JANELA_S segundos) e faz um só COMMIT por lote. Cada pedido espera apenas
+# pelo commit do seu lote e recebe o id (Ref#) da sua linha.
+class FilaEscrita:
+    LOTE_MAX = 64
+    JANELA_S = 0.005
+    ESPERA_MAX_S = 3.0
+
+    def __init__(self):
+        self.pid = None
+        self.metricas = {'lotes': 0, 'linhas': 0, 'erros': 0, 'maior_lote': 0, 'canceladas': 0}
+
+    def _preparar(self):
+        if self.pid == os.getpid():
+            return
+        self.lock = threading.Lock()
+        self.fila = queue.Queue()
+        self.thread = threading.Thread(target=self._ciclo, name='fila-escrita', daemon=True)
+        self.pid = os.getpid()
+        self.thread.start()
+
+    def inserir(self, sql, args):
+        return self._esperar({'sql': sql, 'args': args})['id']
+
+    def inserir_unico(self, sql, args, procurar, guardar):
+        # Na transacção do lote: procurar(db) devolve o id de uma linha
+        # equivalente já existente; senão insere e chama guardar(db, id).
+        # -> (id, inserida?)
+        item = self._esperar({'sql': sql, 'args': args, 'procurar': procurar, 'guardar': guardar})
+        return item['id'], not item['existente']
+
+    def _esperar(self, item):
+        self._preparar()
+        item.update(feito=threading.Event(), id=None, erro=None, existente=False,
+                    iniciado=False, cancelado=False)
+        self.fila.put(item)
+        if not item['feito'].wait(self.ESPERA_MAX_S):
+            # Ainda na fila: cancela-se, e o erro devolvido é verdadeiro (nada
+            # foi gravado). Já no lote em curso: o resultado chega com o commit.
+            with self.lock:
+                item['cancelado'] = not item['iniciado']
+            if item['cancelado']:
+                self.metricas['canceladas'] += 1
+                raise TimeoutError('fila de escrita sem resposta')
+            item['feito'].wait()
+        if item['erro']:
+            raise item['erro']
+        return item
+
+    def _ciclo(self):
+        while True:
+            item = self.fila.get()
+            if item is None:
+                return
+            lote, fim = [item], time.monotonic() + self.JANELA_S
+            while len(lote) < self.LOTE_MAX:
+                try:
+                    item = self.fila.get(timeout=max(0, fim - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._gravar(lote)
+                    return
+                lote.append(item)
+            self._gravar(lote)
+
+    def _gravar(self, lote):
+        try:
+            with pool.escrita() as db:
+                db.execute("BEGIN IMMEDIATE")
+                # Com a BD já bloqueada o commit é imediato: quem desistiu
+                # até aqui fica de fora, os restantes esperam por ele
+                with self.lock:
+                    lote = [item for item in lote if not item['cancelado']]
+                    for item in lote:
+                        item['iniciado'] = True
+                for i, item in enumerate(lote):
+                    # Savepoint por linha: um erro (ex. UNIQUE) não anula o lote
+                    db.execute(f"SAVEPOINT l{i}")
+                    try:
+                        existente = item.get('procurar') and item['procurar'](db)
+                        if existente:
+                            item['id'], item['existente'] = existente, True
+                        else:
+                            item['id'] = db.execute(item['sql'], item['args']).lastrowid
+                            if item.get('guardar'):
+                                item['guardar'](db, item['id'])
+                        db.execute(f"RELEASE l{i}")
+                    except sqlite3.Error as e:
+                        db.execute(f"ROLLBACK TO l{i}")
+                        db.execute(f"RELEASE l{i}")
+                        item['erro'] = e
+                        self.metricas['erros'] += 1
+                db.commit()
+        except Exception as e:
+            for item in lote:
+                item['id'], item['erro'] = None, e
+            self.metricas['erros'] += len(lote)
+        self.metricas['lotes'] += 1
+        self.metricas['linhas'] += len(lote)
+        self.metricas['maior_lote'] = max(self.metricas['maior_lote'], len(lote))
+        for item in lote:
+            item['feito'].set()
+
+    def parar(self):
+        # Esvazia a fila antes de o worker terminar
+        if self.pid != os.getpid():
+            return
+        self.fila.put(None)
+        self.thread.join(timeout=10)
+        self.pid = None
+
+fila_escrita = FilaEscrita()
+atexit.register(fila_escrita.parar)
+
+# ── Métricas (exportadas em /metrics) ─────────────────────────
+# Cada worker conta em memória (latência por endpoint, consultas SQL feitas
+# por query(), consultas por pedido) e, no máximo a cada INTERVALO_S, grava
+# uma cópia num ficheiro por pid em METRICAS_DIR. /metrics soma os ficheiros
+# dos workers vivos. Um worker que morre leva os seus contadores consigo (o
+# Prometheus trata isso como um reset, como num reinício).
+class Metricas:
+    LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+    SQL = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5)
+    POR_PEDIDO = (0, 1, 2, 3, 5, 10, 20, 50)
+    INTERVALO_S = 2.0
+    LENTA_S = float(os.environ.get('SQL_LENTA_MS', 100)) / 1000
+    LENTAS_MAX = 50
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self.pid = None
+
+    def _preparar(self):
+        if self.pid == os.getpid():
+            return
+        self.lock = threading.Lock()
+        self.pedidos = {}     # "endpoint|método|estado" -> n
+        self.latencia = {}    # endpoint -> histograma
+        self.sql = {}         # sql normalizado -> histograma + linhas
+        self.por_pedido = self._hist(self.POR_PEDIDO)
+        self.lentas = []
+        self.gravado = 0.0
+        self.pid = os.getpid()
+
+    @staticmethod
+    def _hist(limites):
+        return [0] * (len(limites) + 1) + [0.0]     # contagens por intervalo, +Inf, soma
+
+    @staticmethod
+    def _observar(h, limites, valor):
+        h[bisect.bisect_left(limites, valor)] += 1
+        h[-1] += valor
+
+    def pedido(self, endpoint, metodo, estado, segundos, n_sql):
+        self._preparar()
+        with self.lock:
+            chave = f'{endpoint}|{metodo}|{estado}'
+            self.pedidos[chave] = self.pedidos.get(chave, 0) + 1
+            h = self.latencia.get(endpoint) or self.latencia.setdefault(endpoint, self._hist(self.LATENCIA))
+            self._observar(h, self.LATENCIA, segundos)
+            self._observar(self.por_pedido, self.POR_PEDIDO, n_sql)
+        if time.monotonic() - self.gravado > self.INTERVALO_S:
+            self.gravar()
+
+    def consulta(self, sql, args, segundos, linhas):
+        self._preparar()
+        texto = _normalizar_sql(sql)
+        with self.lock:
+            m = self.sql.get(texto) or self.sql.setdefault(texto, {'h': self._hist(self.SQL), 'linhas': 0})
+            self._observar(m['h'], self.SQL, segundos)
+            m['linhas'] += linhas
+            if segundos >= self.LENTA_S:
+                forma = ', '.join(type(a).__name__ for a in args) if isinstance(args, (tuple, list)) else type(args).__name__
+                self.lentas = (self.lentas + [{'quando': now_cat(), 'ms': round(segundos * 1000, 1),
+                                               'sql': texto, 'parametros': f'({forma})',
+                                               'endpoint': request.endpoint if has_request_context() else None}]
+                               )[-self.LENTAS_MAX:]
+        if segundos >= self.LENTA_S:
+            app.logger.warning('SQL lenta (%.0f ms): %s params=(%s)', segundos * 1000, texto, forma)
+
+    def gravar(self):
+        self._preparar()
+        os.makedirs(self.pasta, exist_ok=True)
+        with self.lock:
+            dados = {'pedidos': dict(self.pedidos), 'latencia': {k: list(v) for k, v in self.latencia.items()},
+                     'sql': {k: {'h': list(v['h']), 'linhas': v['linhas']} for k, v in self.sql.items()},
+                     'por_pedido': list(self.por_pedido), 'lentas': list(self.lentas),
+                     'componentes': _metricas_componentes()}
+            self.gravado = time.monotonic()
+        caminho = os.path.join(self.pasta, f'{self.pid}.json')
+        with open(caminho + '.tmp', 'w') as f:
+            json.dump(dados, f)
+        os.replace(caminho + '.tmp', caminho)
+
+    def juntar(self):
+        # Soma os ficheiros de todos os workers vivos (e apaga os dos mortos)
+        self.gravar()
+        total = {'pedidos': {}, 'latencia': {}, 'sql': {}, 'por_pedido': self._hist(self.POR_PEDIDO),
+                 'lentas': [], 'componentes': {}}
+        somar = lambda a, b: [x + y for x, y in zip(a, b)]
+        for nome in os.listdir(self.pasta):
+            if not nome.endswith('.json'):
+                continue
+            pid = int(nome[:-5])
+            try:
+                if pid != os.getpid():
+                    os.kill(pid, 0)
+            except ProcessLookupError:
+                os.remove(os.path.join(self.pasta, nome))
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(os.path.join(self.pasta, nome)) as f:
+                    d = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for k, n in d['pedidos'].items():
+                total['pedidos'][k] = total['pedidos'].get(k, 0) + n
+            for k, h in d['latencia'].items():
+                total['latencia'][k] = somar(total['latencia'][k], h) if k in total['latencia'] else h
+            for k, m in d['sql'].items():
+                t = total['sql'].setdefault(k, {'h': self._hist(self.SQL), 'linhas': 0})
+                t['h'] = somar(t['h'], m['h'])
+                t['linhas'] += m['linhas']
+            total['por_pedido'] = somar(total['por_pedido'], d['por_pedido'])
+            total['lentas'] += d['lentas']
+            for comp, valores in d['componentes'].items():
+                t = total['componentes'].setdefault(comp, {})
+                for k, v in valores.items():
+                    t[k] = max(t.get(k, 0), v) if k.startswith('maior') else t.get(k, 0) + v
+        total['lentas'].sort(key=lambda l: l['quando'], reverse=True)
+        return total
+
+def _normalizar_sql(sql):
+    # Listas IN (?,?,?) de tamanho variável contam como uma só consulta
+    return _RE_LISTA_SQL.sub('(?…)', ' '.join(sql.split()))
+
+_RE_LISTA_SQL = re.compile(r'\(\?(?:\s*,\s*\?)+\)')
+
+def _metricas_componentes():
+    def numeros(d):
+        return {k: v for k, v in d.items() if isinstance(v, (int, float)) and not isinstance(v, bool)}
+    comp = {'pool': numeros(pool.metricas), 'fila_escrita': numeros(fila_escrita.metricas)}
+    if 'dedup_pedidos' in globals():
+        comp['dedup_ussd'] = dict(dedup_pedidos.metricas)
+    if 'cache_ussd' in globals():
+        comp['cache_ussd'] = {'hits': cache_ussd.hits, 'misses': cache_ussd.misses}
+    if 'cache_pagina' in globals():
+        comp['cache_pagina'] = {f'{nome}_{k}': v for nome, m in cache_pagina.metricas.items() for k, v in m.items()}
+    if 'admissao' in globals():
+        comp['admissao_ussd'] = {f'{classe}_{k}': v for classe in AdmissaoUSSD.CLASSES
+                                 for k, v in admissao.metricas[classe].items()}
+    if 'despachante' in globals():
+        comp['difusao'] = numeros(despachante.metricas)
+    if 'cache_compressao' in globals():
+        comp['compressao'] = dict(cache_compressao.metricas)
+    return comp
+
+metricas = Metricas(os.environ.get('METRICAS_DIR') or os.path.join(
+    tempfile.gettempdir(), 'alerta-metricas-' + hashlib.md5(DB.encode()).hexdigest()[:8]))
+
+@app.before_request
+def _inicio_pedido():
+    g.t0 = time.perf_counter()
+    g.n_sql = 0
+
+@app.after_request
+def _fim_pedido(resposta):
+    if 't0' in g:
+        metricas.pedido(request.endpoint or '(nenhum)', request.method, resposta.status_code,
+                        time.perf_counter() - g.t0, g.n_sql)
+    return resposta
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DB)
-        g.db.row_factory = sqlite3.Row
+        g.db = pool.emprestar()
     return g.db
 
+@app.errorhandler(PoolEsgotado)
+def pool_esgotado(e):
+    app.logger.warning('pool: %s', e)
+    if request.path == '/ussd':
+        return SOBRECARGA_USSD, 200, {'Content-Type': 'text/plain'}
+    return jsonify({'ok': False, 'msg': 'Serviço sobrecarregado, tente de novo'}), 503, {'Retry-After': '5'}
+
 @app.teardown_appcontext
 def close_db(e=None):
     db = g.pop('db', None)
-    if db: db.close()
+    if db: pool.devolver(db)
 
 def query(sql, args=(), one=False, commit=False):
-    db = get_db()
-    cur = db.execute(sql, args)
+    t = time.perf_counter()
     if commit:
-        db.commit()
-        return cur.lastrowid
-    return cur.fetchone() if one else cur.fetchall()
+        r = pool.escrever(sql, args)
+        linhas = 0
+    else:
+        cur = get_db().execute(sql, args)
+        r = cur.fetchone() if one else cur.fetchall()
+        linhas = (r is not None) if one else len(r)
+    metricas.consulta(sql, args, time.perf_counter() - t, linhas)
+    if has_app_context():
+        g.n_sql = g.get('n_sql', 0) + 1
+    return r
+
+# ── Versão dos dados públicos ─────────────────────────────────
+# Cada escrita de dados visíveis no site chama marcar_alteracao() na mesma
+# transacção, que regista a linha alterada em `alteracao` (deletes ficam como
+# tombstones): ou ficam gravados os dois, ou nenhum. Uma alteração que não é
+# de linhas do site (configuração, bairros) fica com op='reload' e registo_id 0:
+# quem tem uma versão anterior recebe o snapshot completo.
+# A versão é o último `seq` desse registo, copiado para um ficheiro ao lado
+# da BD para que todos os workers a leiam sem abrir o SQLite.
+ALTERACOES_MAX = 50000   # entradas mantidas no registo de alterações
+VERSAO_FILE = DB + '.versao'
+_versao_lock = threading.Lock()
+
+def versao_dados():
+    try:
+        with open(VERSAO_FILE, 'rb') as f:
+            return int(f.read() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def _gravar_versao(seq):
+    with _versao_lock:
+        fd = os.open(VERSAO_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl: fcntl.flock(fd, fcntl.LOCK_EX)
+            try: atual = int(os.read(fd, 32) or 0)
+            except ValueError: atual = 0
+            # Os números só crescem: reescrever no offset 0 nunca deixa lixo
+            if seq > atual:
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, str(seq).encode())
+        finally:
+            os.close(fd)  # liberta também o flock
+
+def marcar_alteracao(db, tabela, ids, op='upsert'):
+    # Dentro da transacção de escrita; devolve o seq para publicar_versao()
+    # (sem ids, o último já registado)
+    if not ids:
+        return db.execute("SELECT COALESCE(MAX(seq), 0) FROM alteracao").fetchone()[0]
+    agora = now_cat()
+    for rid in ids:
+        seq = db.execute("INSERT INTO alteracao(tabela, registo_id, op, data) VALUES(?,?,?,?)",
+                         (tabela, rid, op, agora)).lastrowid
+    db.execute("DELETE FROM alteracao WHERE seq <= ?", (seq - ALTERACOES_MAX,))
+    return seq
+
+def publicar_versao(seq):
+    # Depois do commit
+    _gravar_versao(seq)
+    difusor.acordar.set()
+
+def escrever_alteracao(sql, args, tabela, rid=None, op='upsert'):
+    # Uma instrução e o registo de `rid` (por omissão a linha inserida) num só commit
+    def fn(db):
+        cur = db.execute(sql, args)
+        r = cur.lastrowid if rid is None else rid
+        return r, marcar_alteracao(db, tabela, [r], op)
+    r, seq = pool.transacao(fn)
+    publicar_versao(seq)
+    return r
 
 def get_site_config():
     try:
@@ -54,56 +553,528 @@ def get_site_config():
             'endereco': 'Carrupeia, Nampula', 'whatsapp': '', 'facebook': '', 'twitter': '',
         }
 
-def init_db():
-    with app.app_context():
-        db = get_db()
-        db.executescript("""
-        CREATE TABLE IF NOT EXISTS admin(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          nome TEXT NOT NULL, email TEXT UNIQUE NOT NULL,
-          password TEXT NOT NULL, nivel TEXT DEFAULT 'admin');
-        CREATE TABLE IF NOT EXISTS alerta(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          titulo TEXT NOT NULL, tipo TEXT NOT NULL, conteudo TEXT NOT NULL,
-          data TEXT DEFAULT (datetime('now')), ativo INTEGER DEFAULT 1);
-        CREATE TABLE IF NOT EXISTS familia(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          bairro TEXT NOT NULL, numero INTEGER NOT NULL, situacao TEXT NOT NULL,
-          abrigo TEXT NOT NULL, necessidades TEXT NOT NULL,
-          data TEXT DEFAULT (datetime('now')));
-        CREATE TABLE IF NOT EXISTS zona(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          nome TEXT NOT NULL, capacidade INTEGER NOT NULL, recursos TEXT NOT NULL,
-          ativa INTEGER DEFAULT 1);
-        CREATE TABLE IF NOT EXISTS apoio(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          tipo TEXT, quantidade TEXT, local_entrega TEXT, contacto TEXT,
-          status TEXT DEFAULT 'pendente',
-          data TEXT DEFAULT (datetime('now')));
-        CREATE TABLE IF NOT EXISTS subscricao(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          nome TEXT, telefone TEXT, email TEXT, metodos TEXT, tipo_alertas TEXT,
-          data TEXT DEFAULT (datetime('now')));
-        CREATE TABLE IF NOT EXISTS configuracao(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          chave TEXT UNIQUE NOT NULL, valor TEXT NOT NULL);
-        CREATE TABLE IF NOT EXISTS ussd_pedido(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          telefone TEXT NOT NULL,
-          tipo TEXT NOT NULL,
-          descricao TEXT NOT NULL,
-          status TEXT DEFAULT 'pendente',
-          data TEXT DEFAULT (datetime('now')));
-        CREATE TABLE IF NOT EXISTS ussd_voluntario(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          nome TEXT NOT NULL,
-          telefone TEXT NOT NULL UNIQUE,
-          habilidades TEXT,
-          data TEXT DEFAULT (datetime('now')));
+# ── Contadores materializados ─────────────────────────────────
+# Mantidos por triggers em cada INSERT/UPDATE/DELETE (rotas admin e USSD),
+# para o dashboard ler todas as estatísticas numa só consulta.
+# tabela -> [(chave, expressão sobre a linha R)]
+CONTADORES = {
+    'alerta': [
+        ('alertas',          "1"),
+        ('alertas_ativos',   "R.ativo=1"),
+        ('alertas_urgentes', "R.ativo=1 AND R.tipo='urgente'"),
+    ],
+    'familia': [
+        ('familias',         "1"),
+        ('familias_total',   "R.numero"),
+    ],
+    'zona': [
+        ('zonas',            "R.ativa=1"),
+        ('cap_total',        "CASE WHEN R.ativa=1 THEN R.capacidade ELSE 0 END"),
+        ('ocupacao_total',   "CASE WHEN R.ativa=1 THEN R.ocupacao ELSE 0 END"),
+        ('zonas_lotadas',    "R.ativa=1 AND R.ocupacao >= R.capacidade"),
+    ],
+    'apoio': [
+        ('apoios',           "1"),
+        ('apoios_pendentes', "R.status='pendente' OR R.status IS NULL"),
+    ],
+    'subscricao':      [('subscricoes',     "1")],
+    'admin':           [('admins',          "1")],
+    'ussd_pedido': [
+        ('ussd_pedidos',      "1"),
+        ('ussd_pedidos_pend', "R.status='pendente'"),
+    ],
+    'ussd_voluntario': [('ussd_voluntarios', "1")],
+}
+# Contagens por hora (janelas móveis de 7/30 dias e séries de /api/stats/timeseries):
+# tabela -> [expressão da chave sobre a linha R]; chaves NULL não contam.
+# A hora é a de `data`, em hora de Maputo: quem insere nestas tabelas passa
+# sempre data=now_cat(), porque o DEFAULT do esquema base é UTC.
+CONTADORES_HORA = {
+    'apoio':       ["'apoios'"],
+    'subscricao':  ["'subscricoes'"],
+    'ussd_pedido': ["'ussd|' || R.tipo", "'ussd_bairro|' || R.bairro"],
+}
+
+def _sql_contadores(contadores=CONTADORES, horas=CONTADORES_HORA):
+    sql = []
+    for tabela, conts in contadores.items():
+        def soma(sinal_linhas):
+            return ''.join(
+                "UPDATE contador SET valor = valor " +
+                ' '.join(f"{s} COALESCE(({expr.replace('R.', l + '.')}), 0)" for s, l in sinal_linhas) +
+                f" WHERE chave='{chave}';\n"
+                for chave, expr in conts)
+        ins = soma([('+', 'NEW')])
+        dele = soma([('-', 'OLD')])
+        upd = soma([('+', 'NEW'), ('-', 'OLD')])
+        for expr in horas.get(tabela, []):
+            novo, velho = expr.replace('R.', 'NEW.'), expr.replace('R.', 'OLD.')
+            mais = (f"INSERT INTO contador_hora(chave, hora, valor) SELECT {novo}, substr(NEW.data,1,13), 1 "
+                    f"WHERE ({novo}) IS NOT NULL{{}} ON CONFLICT(chave, hora) DO UPDATE SET valor = valor + 1;\n")
+            menos = (f"UPDATE contador_hora SET valor = valor - 1 "
+                     f"WHERE chave=({velho}) AND hora=substr(OLD.data,1,13){{}};\n")
+            # No UPDATE só se mexe quando a chave ou a hora mudam
+            mudou = f" AND (({velho}) IS NOT ({novo}) OR OLD.data IS NOT NEW.data)"
+            ins += mais.format('')
+            dele += menos.format('')
+            upd += menos.format(mudou) + mais.format(mudou)
+        sql.append(f"CREATE TRIGGER IF NOT EXISTS cont_{tabela}_ins AFTER INSERT ON {tabela} BEGIN\n{ins}END;")
+        sql.append(f"CREATE TRIGGER IF NOT EXISTS cont_{tabela}_del AFTER DELETE ON {tabela} BEGIN\n{dele}END;")
+        sql.append(f"CREATE TRIGGER IF NOT EXISTS cont_{tabela}_upd AFTER UPDATE ON {tabela} BEGIN\n{upd}END;")
+    return sql
+
+def instalar_contadores(db, contadores=CONTADORES, horas=CONTADORES_HORA):
+    # (Re)cria os triggers dos contadores e recalcula os valores a partir das
+    # tabelas. As migrações antigas passam a versão que tinham quando saíram.
+    for (nome,) in db.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name GLOB 'cont_*'").fetchall():
+        db.execute(f"DROP TRIGGER {nome}")
+    for sql in _sql_contadores(contadores, horas):
+        db.execute(sql)
+    recalcular_contadores(db, contadores, horas)
+
+def recalcular_contadores(db, contadores=CONTADORES, horas=CONTADORES_HORA):
+    db.execute("DELETE FROM contador")
+    db.execute("DELETE FROM contador_hora")
+    for tabela, conts in contadores.items():
+        cols = ', '.join(f"COALESCE(SUM({expr.replace('R.', '')}), 0)" for _, expr in conts)
+        valores = db.execute(f"SELECT {cols} FROM {_com_arquivo(db, tabela)}").fetchone()
+        db.executemany("INSERT INTO contador(chave, valor) VALUES(?,?)",
+                       [(chave, v) for (chave, _), v in zip(conts, valores)])
+    for tabela, exprs in horas.items():
+        for expr in exprs:
+            chave = expr.replace('R.', '')
+            db.execute(f"INSERT INTO contador_hora(chave, hora, valor) "
+                       f"SELECT {chave}, substr(data,1,13), COUNT(*) FROM {_com_arquivo(db, tabela)} "
+                       f"WHERE ({chave}) IS NOT NULL GROUP BY 1, 2")
+
+def _com_arquivo(db, tabela):
+    # As linhas arquivadas continuam a contar nos totais (ver ARQUIVO)
+    if tabela not in ARQUIVO or not _colunas(db, f'arquivo_{tabela}'):
+        return tabela
+    cols = ', '.join(sorted(_colunas(db, tabela)))
+    return f"(SELECT {cols} FROM {tabela} UNION ALL SELECT {cols} FROM arquivo_{tabela})"
+
+def ler_contadores():
+    # Uma consulta: totais + somas das janelas de 7 e 30 dias. As horas de
+    # contador_hora vêm de `data`, gravada em hora de Maputo (now_cat())
+    agora = now_cat()
+    rows = query(
+        "SELECT chave, valor FROM contador "
+        "UNION ALL SELECT 'apoios_semana', COALESCE(SUM(valor), 0) FROM contador_hora "
+        "  WHERE chave='apoios' AND hora >= substr(datetime(?, '-7 days'), 1, 13) "
+        "UNION ALL SELECT 'subs_mes', COALESCE(SUM(valor), 0) FROM contador_hora "
+        "  WHERE chave='subscricoes' AND hora >= substr(datetime(?, '-30 days'), 1, 13)", (agora, agora))
+    return {r['chave']: r['valor'] for r in rows}
+
+# ═══════════════════════════════════════════════════════════════
+#  MIGRAÇÕES — cada passo corre uma única vez, por ordem, no arranque.
+#  PRAGMA user_version guarda o número do último passo aplicado.
+#  Os passos são idempotentes (BDs anteriores a este mecanismo têm
+#  user_version 0 mas já têm parte do esquema).
+# ═══════════════════════════════════════════════════════════════
+
+def executar_sql(db, script):
+    # Como executescript(), mas sem o COMMIT implícito: fica na transacção do passo
+    instrucao = ''
+    for linha in script.splitlines(keepends=True):
+        instrucao += linha
+        if sqlite3.complete_statement(instrucao):
+            db.execute(instrucao)
+            instrucao = ''
+
+def _colunas(db, tabela):
+    return {r[1] for r in db.execute(f"PRAGMA table_info({tabela})")}
+
+# Os contadores como estavam quando cada migração saiu: um passo já publicado
+# não muda com CONTADORES, que só a última migração que os toca instala
+# (agora a 13). Com as colunas que existiam nessa altura.
+_CONTADORES_M3 = {
+    'alerta': [
+        ('alertas',          "1"),
+        ('alertas_ativos',   "R.ativo=1"),
+        ('alertas_urgentes', "R.ativo=1 AND R.tipo='urgente'"),
+    ],
+    'familia': [
+        ('familias',         "1"),
+        ('familias_total',   "R.numero"),
+    ],
+    'zona': [
+        ('zonas',            "R.ativa=1"),
+        ('cap_total',        "CASE WHEN R.ativa=1 THEN R.capacidade ELSE 0 END"),
+    ],
+    'apoio': [
+        ('apoios',           "1"),
+        ('apoios_pendentes', "R.status='pendente' OR R.status IS NULL"),
+    ],
+    'subscricao':      [('subscricoes',     "1")],
+    'admin':           [('admins',          "1")],
+    'ussd_pedido': [
+        ('ussd_pedidos',      "1"),
+        ('ussd_pedidos_pend', "R.status='pendente'"),
+    ],
+    'ussd_voluntario': [('ussd_voluntarios', "1")],
+}
+_CONTADORES_HORA_M3 = {'apoio': ["'apoios'"], 'subscricao': ["'subscricoes'"]}
+_CONTADORES_M10 = dict(_CONTADORES_M3, zona=[
+    ('zonas',            "R.ativa=1"),
+    ('cap_total',        "CASE WHEN R.ativa=1 THEN R.capacidade ELSE 0 END"),
+    ('ocupacao_total',   "CASE WHEN R.ativa=1 THEN R.ocupacao ELSE 0 END"),
+    ('zonas_lotadas',    "R.ativa=1 AND R.ocupacao >= R.capacidade"),
+])
+
+def _m1_esquema_base(db):
+    executar_sql(db, """
+    CREATE TABLE IF NOT EXISTS admin(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      nome TEXT NOT NULL, email TEXT UNIQUE NOT NULL,
+      password TEXT NOT NULL, nivel TEXT DEFAULT 'admin');
+    CREATE TABLE IF NOT EXISTS alerta(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      titulo TEXT NOT NULL, tipo TEXT NOT NULL, conteudo TEXT NOT NULL,
+      data TEXT DEFAULT (datetime('now')), ativo INTEGER DEFAULT 1);
+    CREATE TABLE IF NOT EXISTS familia(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      bairro TEXT NOT NULL, numero INTEGER NOT NULL, situacao TEXT NOT NULL,
+      abrigo TEXT NOT NULL, necessidades TEXT NOT NULL,
+      data TEXT DEFAULT (datetime('now')));
+    CREATE TABLE IF NOT EXISTS zona(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      nome TEXT NOT NULL, capacidade INTEGER NOT NULL, recursos TEXT NOT NULL,
+      ativa INTEGER DEFAULT 1);
+    CREATE TABLE IF NOT EXISTS apoio(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      tipo TEXT, quantidade TEXT, local_entrega TEXT, contacto TEXT,
+      status TEXT DEFAULT 'pendente',
+      data TEXT DEFAULT (datetime('now')));
+    CREATE TABLE IF NOT EXISTS subscricao(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      nome TEXT, telefone TEXT, email TEXT, metodos TEXT, tipo_alertas TEXT,
+      data TEXT DEFAULT (datetime('now')));
+    CREATE TABLE IF NOT EXISTS configuracao(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      chave TEXT UNIQUE NOT NULL, valor TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS ussd_pedido(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      telefone TEXT NOT NULL,
+      tipo TEXT NOT NULL,
+      descricao TEXT NOT NULL,
+      status TEXT DEFAULT 'pendente',
+      data TEXT DEFAULT (datetime('now')));
+    CREATE TABLE IF NOT EXISTS ussd_voluntario(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      nome TEXT NOT NULL,
+      telefone TEXT NOT NULL UNIQUE,
+      habilidades TEXT,
+      data TEXT DEFAULT (datetime('now')));
+    """)
+    if 'status' not in _colunas(db, 'apoio'):
+        db.execute("ALTER TABLE apoio ADD COLUMN status TEXT DEFAULT 'pendente'")
+
+def _m2_registo_alteracoes(db):
+    executar_sql(db, """
+    CREATE TABLE IF NOT EXISTS alteracao(
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      tabela TEXT NOT NULL,
+      registo_id INTEGER NOT NULL,
+      op TEXT NOT NULL DEFAULT 'upsert',
+      data TEXT DEFAULT (datetime('now')));
+    """)
+
+def _m3_contadores(db):
+    executar_sql(db, """
+    CREATE TABLE IF NOT EXISTS contador(
+      chave TEXT PRIMARY KEY,
+      valor INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS contador_hora(
+      chave TEXT NOT NULL,
+      hora TEXT NOT NULL,
+      valor INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY(chave, hora)) WITHOUT ROWID;
+    """)
+    # Calculados uma vez a partir das tabelas; a partir daí, triggers
+    recalcular_contadores(db, _CONTADORES_M3, _CONTADORES_HORA_M3)
+    for sql in _sql_contadores(_CONTADORES_M3, _CONTADORES_HORA_M3):
+        db.execute(sql)
+
+def _m4_indices_paginacao(db):
+    # Paginação por cursor (data, id) nas tabelas do admin
+    executar_sql(db, """
+    CREATE INDEX IF NOT EXISTS idx_alerta_data      ON alerta(data, id);
+    CREATE INDEX IF NOT EXISTS idx_familia_data     ON familia(data, id);
+    CREATE INDEX IF NOT EXISTS idx_apoio_data       ON apoio(data, id);
+    CREATE INDEX IF NOT EXISTS idx_subscricao_data  ON subscricao(data, id);
+    CREATE INDEX IF NOT EXISTS idx_ussd_pedido_data ON ussd_pedido(data, id);
+    CREATE INDEX IF NOT EXISTS idx_ussd_vol_data    ON ussd_voluntario(data, id);
+    """)
+
+def _m5_indices_filtros(db):
+    executar_sql(db, """
+    CREATE INDEX IF NOT EXISTS idx_alerta_ativo_tipo  ON alerta(ativo, tipo, data);
+    CREATE INDEX IF NOT EXISTS idx_zona_ativa_nome    ON zona(ativa, nome);
+    CREATE INDEX IF NOT EXISTS idx_ussd_pedido_status ON ussd_pedido(status, data);
+    CREATE INDEX IF NOT EXISTS idx_subscricao_tel     ON subscricao(telefone);
+    CREATE INDEX IF NOT EXISTS idx_subscricao_email   ON subscricao(email);
+    CREATE INDEX IF NOT EXISTS idx_apoio_status       ON apoio(status, data);
+    """)
+
+def _m6_difusao(db):
+    # Difusão de alertas aos subscritores: uma linha por alerta a difundir e
+    # uma linha por mensagem (subscritor x canal). Datas em hora CAT, como no resto.
+    executar_sql(db, """
+    CREATE TABLE IF NOT EXISTS difusao(
+      alerta_id INTEGER PRIMARY KEY,
+      estado TEXT NOT NULL DEFAULT 'pendente',
+      mensagens INTEGER NOT NULL DEFAULT 0,
+      criado TEXT NOT NULL,
+      expandido TEXT);
+    CREATE TABLE IF NOT EXISTS envio(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      alerta_id INTEGER NOT NULL,
+      subscricao_id INTEGER NOT NULL,
+      canal TEXT NOT NULL,
+      destino TEXT NOT NULL,
+      estado TEXT NOT NULL DEFAULT 'pendente',
+      tentativas INTEGER NOT NULL DEFAULT 0,
+      proxima TEXT NOT NULL DEFAULT '',
+      reservado TEXT,
+      enviado TEXT,
+      erro TEXT,
+      UNIQUE(alerta_id, subscricao_id, canal));
+    CREATE INDEX IF NOT EXISTS idx_envio_fila      ON envio(canal, estado, proxima, id);
+    CREATE INDEX IF NOT EXISTS idx_envio_alerta    ON envio(alerta_id, estado);
+    CREATE INDEX IF NOT EXISTS idx_envio_reservado ON envio(reservado) WHERE estado='enviando';
+    CREATE INDEX IF NOT EXISTS idx_envio_enviado   ON envio(enviado, canal) WHERE enviado IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_difusao_estado  ON difusao(estado, alerta_id);
+    """)
+
+def _m7_alvos_subscricao(db):
+    # Índice de audiência: uma linha por (tipo de alerta, canal, subscritor),
+    # em vez de interpretar os campos de texto metodos/tipo_alertas a cada alerta.
+    # `audiencia` guarda as contagens por (tipo, canal), mantidas por triggers.
+    executar_sql(db, """
+    CREATE TABLE IF NOT EXISTS subscricao_alvo(
+      tipo TEXT NOT NULL,
+      canal TEXT NOT NULL,
+      subscricao_id INTEGER NOT NULL,
+      destino TEXT NOT NULL,
+      PRIMARY KEY(tipo, canal, subscricao_id)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_alvo_subscricao ON subscricao_alvo(subscricao_id);
+    CREATE TABLE IF NOT EXISTS audiencia(
+      tipo TEXT NOT NULL,
+      canal TEXT NOT NULL,
+      n INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY(tipo, canal)) WITHOUT ROWID;
+    CREATE TRIGGER IF NOT EXISTS alvo_ins AFTER INSERT ON subscricao_alvo BEGIN
+      INSERT INTO audiencia(tipo, canal, n) VALUES(NEW.tipo, NEW.canal, 1)
+        ON CONFLICT(tipo, canal) DO UPDATE SET n = n + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS alvo_del AFTER DELETE ON subscricao_alvo BEGIN
+      UPDATE audiencia SET n = n - 1 WHERE tipo=OLD.tipo AND canal=OLD.canal;
+    END;
+    CREATE TRIGGER IF NOT EXISTS subscricao_alvo_del AFTER DELETE ON subscricao BEGIN
+      DELETE FROM subscricao_alvo WHERE subscricao_id=OLD.id;
+    END;
+    """)
+    for (sid,) in db.execute("SELECT id FROM subscricao").fetchall():
+        indexar_subscricao(db, sid)
+
+# Pesquisa de texto (FTS5): índice -> (tabela, colunas indexadas). Os índices
+# são de conteúdo externo (o texto fica só na tabela original) e os triggers
+# mantêm-nos em dia com cada INSERT, UPDATE e DELETE.
+BUSCA = {
+    'busca_alerta':     ('alerta',          ('titulo', 'conteudo')),
+    'busca_familia':    ('familia',         ('bairro', 'necessidades')),
+    'busca_pedido':     ('ussd_pedido',     ('descricao', 'telefone')),
+    'busca_voluntario': ('ussd_voluntario', ('habilidades',)),
+}
+
+def _sql_busca(indice, tabela, colunas, conteudo=None):
+    # conteudo: de onde o índice lê o texto, se não for a própria tabela
+    cols = ', '.join(colunas)
+    novos = ', '.join('NEW.' + c for c in colunas)
+    antigos = ', '.join('OLD.' + c for c in colunas)
+    return f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {indice} USING fts5(
+      {cols}, content='{conteudo or tabela}', content_rowid='id',
+      tokenize='unicode61 remove_diacritics 2');
+    CREATE TRIGGER IF NOT EXISTS {indice}_ins AFTER INSERT ON {tabela} BEGIN
+      INSERT INTO {indice}(rowid, {cols}) VALUES(NEW.id, {novos});
+    END;
+    CREATE TRIGGER IF NOT EXISTS {indice}_del AFTER DELETE ON {tabela} BEGIN
+      INSERT INTO {indice}({indice}, rowid, {cols}) VALUES('delete', OLD.id, {antigos});
+    END;
+    CREATE TRIGGER IF NOT EXISTS {indice}_upd AFTER UPDATE OF {cols} ON {tabela} BEGIN
+      INSERT INTO {indice}({indice}, rowid, {cols}) VALUES('delete', OLD.id, {antigos});
+      INSERT INTO {indice}(rowid, {cols}) VALUES(NEW.id, {novos});
+    END;
+    """
+
+def _m8_busca(db):
+    for indice, (tabela, colunas) in BUSCA.items():
+        executar_sql(db, _sql_busca(indice, tabela, colunas))
+        db.execute(f"INSERT INTO {indice}({indice}) VALUES('rebuild')")
+    # O título de um alerta pesa mais do que o conteúdo
+    db.execute("INSERT INTO busca_alerta(busca_alerta, rank) VALUES('rank', 'bm25(4.0, 1.0)')")
+
+# Centros aproximados dos bairros de Nampula (corrigíveis em /api/bairros)
+BAIRROS_NAMPULA = [
+    ('Central', -15.1195, 39.2650), ('Muahivire', -15.1000, 39.2600),
+    ('Napipine', -15.1380, 39.2930), ('Muhala', -15.1300, 39.2420),
+    ('Namicopo', -15.0940, 39.2850), ('Carrupeia', -15.1240, 39.2790),
+    ('Mutauanha', -15.1010, 39.3000), ('Natikiri', -15.0650, 39.3000),
+    ('Marrere', -15.0800, 39.3400), ('Muatala', -15.1050, 39.2450),
+    ('Namutequeliua', -15.1400, 39.2600), ('Murrapaniua', -15.1500, 39.2300),
+    ('Anchilo', -15.0500, 39.3200),
+]
+
+def _m9_coordenadas(db):
+    # Coordenadas das zonas (opcionais: sem elas a zona só aparece nas listas),
+    # pessoas alojadas e o centro de cada bairro, para procurar a zona mais próxima
+    for coluna, tipo in (('lat', 'REAL'), ('lon', 'REAL'), ('ocupacao', 'INTEGER NOT NULL DEFAULT 0')):
+        if coluna not in _colunas(db, 'zona'):
+            db.execute(f"ALTER TABLE zona ADD COLUMN {coluna} {tipo}")
+    executar_sql(db, """
+    CREATE TABLE IF NOT EXISTS bairro(
+      nome TEXT PRIMARY KEY,
+      lat REAL NOT NULL,
+      lon REAL NOT NULL) WITHOUT ROWID;
+    """)
+    db.executemany("INSERT OR IGNORE INTO bairro(nome, lat, lon) VALUES(?,?,?)", BAIRROS_NAMPULA)
+
+def _m10_alocacao(db):
+    # Cada família pode ficar numa zona (zona_id); zona.ocupacao passa a ser a
+    # soma de familia.numero das famílias lá alojadas, mantida por triggers
+    if 'zona_id' not in _colunas(db, 'familia'):
+        db.execute("ALTER TABLE familia ADD COLUMN zona_id INTEGER")
+    executar_sql(db, """
+    CREATE INDEX IF NOT EXISTS idx_familia_zona ON familia(zona_id);
+    CREATE TRIGGER IF NOT EXISTS familia_zona_ins AFTER INSERT ON familia WHEN NEW.zona_id IS NOT NULL BEGIN
+      UPDATE zona SET ocupacao = ocupacao + NEW.numero WHERE id = NEW.zona_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS familia_zona_del AFTER DELETE ON familia WHEN OLD.zona_id IS NOT NULL BEGIN
+      UPDATE zona SET ocupacao = ocupacao - OLD.numero WHERE id = OLD.zona_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS familia_zona_upd AFTER UPDATE OF numero, zona_id ON familia
+      WHEN OLD.numero IS NOT NEW.numero OR OLD.zona_id IS NOT NEW.zona_id BEGIN
+      UPDATE zona SET ocupacao = ocupacao - OLD.numero WHERE id = OLD.zona_id;
+      UPDATE zona SET ocupacao = ocupacao + NEW.numero WHERE id = NEW.zona_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS zona_familias_del AFTER DELETE ON zona BEGIN
+      UPDATE familia SET zona_id = NULL WHERE zona_id = OLD.id;
+    END;
+    """)
+    # Famílias já registadas: o abrigo escrito à mão é o nome de uma zona?
+    zonas = {normalizar_nome(nome): zid for zid, nome in db.execute("SELECT id, nome FROM zona")}
+    db.executemany("UPDATE familia SET zona_id=? WHERE id=?",
+                   [(zonas[normalizar_nome(abrigo)], fid)
+                    for fid, abrigo in db.execute("SELECT id, abrigo FROM familia WHERE zona_id IS NULL")
+                    if normalizar_nome(abrigo) in zonas])
+    db.execute("UPDATE zona SET ocupacao = (SELECT COALESCE(SUM(numero), 0) FROM familia WHERE zona_id = zona.id)")
+    instalar_contadores(db, _CONTADORES_M10, _CONTADORES_HORA_M3)
+
+def _m11_pedidos_recentes(db):
+    # Índice partilhado dos pedidos USSD recentes, para não duplicar pedidos
+    # repetidos (chave: telefone, tipo e descrição normalizada)
+    executar_sql(db, """
+    CREATE TABLE IF NOT EXISTS pedido_recente(
+      chave TEXT PRIMARY KEY,
+      pedido_id INTEGER NOT NULL,
+      expira REAL NOT NULL) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_pedido_recente_expira ON pedido_recente(expira);
+    """)
+
+def _m12_arquivo(db):
+    # Tabelas de arquivo (ver ARQUIVO); os totais passam a somar as duas partes
+    preparar_arquivo(db)
+
+def _m13_series_pedidos(db):
+    # Pedidos USSD por tipo e por bairro em contador_hora (ver CONTADORES_HORA);
+    # o bairro fica NULL enquanto o pedido não traz localização
+    if 'bairro' not in _colunas(db, 'ussd_pedido'):
+        db.execute("ALTER TABLE ussd_pedido ADD COLUMN bairro TEXT")
+    preparar_arquivo(db)
+    instalar_contadores(db)
+
+def _m14_zona_eliminada(db):
+    # Eliminar uma zona passa a ser feito só em delete_zona, que também limpa o
+    # abrigo das famílias e regista a alteração delas no registo público
+    db.execute("DROP TRIGGER IF EXISTS zona_familias_del")
+
+def _m15_categoria_alerta(db):
+    # Categoria escolhida pelo admin (CATEGORIAS_ALERTA); NULL: todos os subscritores
+    if 'categoria' not in _colunas(db, 'alerta'):
+        db.execute("ALTER TABLE alerta ADD COLUMN categoria TEXT")
+    preparar_arquivo(db)
+
+def _m16_busca_arquivo(db):
+    # As linhas arquivadas continuam na pesquisa: o índice das tabelas com
+    # arquivo passa a ler o texto de uma vista sobre as duas, e o DELETE que
+    # as move para arquivo_<tabela> (já lá estão) não as tira do índice
+    for indice, (tabela, colunas) in BUSCA.items():
+        if tabela not in ARQUIVO:
+            continue
+        cols = ', '.join(colunas)
+        antigos = ', '.join('OLD.' + c for c in colunas)
+        for sufixo in ('ins', 'del', 'upd'):
+            db.execute(f"DROP TRIGGER IF EXISTS {indice}_{sufixo}")
+        db.execute(f"DROP TABLE IF EXISTS {indice}")
+        db.execute(f"CREATE VIEW IF NOT EXISTS {indice}_texto AS SELECT id, {cols} FROM {tabela} "
+                   f"UNION ALL SELECT id, {cols} FROM arquivo_{tabela}")
+        executar_sql(db, _sql_busca(indice, tabela, colunas, f'{indice}_texto'))
+        executar_sql(db, f"""
+        DROP TRIGGER {indice}_del;
+        CREATE TRIGGER {indice}_del AFTER DELETE ON {tabela}
+          WHEN NOT EXISTS (SELECT 1 FROM arquivo_{tabela} WHERE id = OLD.id) BEGIN
+          INSERT INTO {indice}({indice}, rowid, {cols}) VALUES('delete', OLD.id, {antigos});
+        END;
         """)
+        db.execute(f"INSERT INTO {indice}({indice}) VALUES('rebuild')")
+    db.execute("INSERT INTO busca_alerta(busca_alerta, rank) VALUES('rank', 'bm25(4.0, 1.0)')")
+
+MIGRACOES = [
+    (1, _m1_esquema_base),
+    (2, _m2_registo_alteracoes),
+    (3, _m3_contadores),
+    (4, _m4_indices_paginacao),
+    (5, _m5_indices_filtros),
+    (6, _m6_difusao),
+    (7, _m7_alvos_subscricao),
+    (8, _m8_busca),
+    (9, _m9_coordenadas),
+    (10, _m10_alocacao),
+    (11, _m11_pedidos_recentes),
+    (12, _m12_arquivo),
+    (13, _m13_series_pedidos),
+    (14, _m14_zona_eliminada),
+    (15, _m15_categoria_alerta),
+    (16, _m16_busca_arquivo),
+]
+
+def migrar(db):
+    atual = db.execute("PRAGMA user_version").fetchone()[0]
+    for numero, passo in MIGRACOES:
+        if numero <= atual:
+            continue
+        db.execute("BEGIN")
         try:
-            db.execute("ALTER TABLE apoio ADD COLUMN status TEXT DEFAULT 'pendente'")
-        except: pass
+            passo(db)
+            db.execute(f"PRAGMA user_version = {numero}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        app.logger.info('Migração %d aplicada (%s)', numero, passo.__name__)
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+def init_db():
+    with pool.escrita() as db:
+        migrar(db)
+        # O registo de alterações continua a numeração da versão já publicada
+        # (também depois de repor um backup mais antigo)
+        if not db.execute("SELECT 1 FROM sqlite_sequence WHERE name='alteracao'").fetchone():
+            db.execute("INSERT INTO sqlite_sequence(name, seq) VALUES('alteracao', ?)", (versao_dados(),))
+        else:
+            db.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name='alteracao'", (versao_dados(),))
         db.commit()
 
         if not db.execute("SELECT 1 FROM admin LIMIT 1").fetchone():
@@ -111,7 +1082,9 @@ def init_db():
                 ('Helio Paiva','heliopaiva111@gmail.com','Abacarito','master'),
                 ('Ana Macuacua','ana@alerta.co.mz','Admin2025!','admin'),
             ])
-        if not db.execute("SELECT 1 FROM alerta LIMIT 1").fetchone():
+        # Alertas de exemplo só numa BD que nunca os teve: o arquivo pode ter
+        # esvaziado a tabela quente (ver ARQUIVO)
+        if not db.execute("SELECT 1 FROM alerta UNION ALL SELECT 1 FROM arquivo_alerta LIMIT 1").fetchone():
             db.executemany("INSERT INTO alerta(titulo,tipo,conteudo,data) VALUES(?,?,?,?)",[
                 ('Alerta Meteorológico Nampula','urgente','Previsão de chuvas fortes nos próximos 3 dias. Evite zonas baixas e margens de rios.', now_cat()),
                 ('Segurança Pública','atencao','Atenção redobrada em locais públicos e mercados.', now_cat()),
@@ -166,6 +1139,235 @@ def fmt_datetime(d):
     except: return str(d) if d else ''
 
 
+# ═══════════════════════════════════════════════════════════════
+#  ZONAS SEGURAS — as mais próximas de um ponto ou bairro
+#  Cada worker guarda as zonas activas com coordenadas numa grelha de
+#  células de CELULA graus, refeita quando a versão dos dados muda. Para as
+#  k mais próximas percorrem-se anéis de células à volta do ponto até que
+#  nenhuma célula por ver possa ter uma zona mais perto que a k-ésima.
+# ═══════════════════════════════════════════════════════════════
+
+def normalizar_nome(texto):
+    texto = unicodedata.normalize('NFKD', texto or '').encode('ascii', 'ignore').decode().lower()
+    texto = ' '.join(re.sub(r'[^a-z0-9 ]', ' ', texto).split())
+    return re.sub(r'^(bairro|b) ', '', texto)
+
+# Área servida (lat mín, lat máx, lon mín, lon máx): por omissão a província de
+# Nampula com margem. Pontos fora dela não são pesquisados nem gravados.
+AREA_SERVICO = tuple(float(v) for v in os.environ.get('AREA_SERVICO', '-17.5,-12.5,36.5,41.5').split(','))
+ZONAS_RAIO_MAX_KM = 150
+
+def na_area_servico(lat, lon):
+    return AREA_SERVICO[0] <= lat <= AREA_SERVICO[1] and AREA_SERVICO[2] <= lon <= AREA_SERVICO[3]
+
+def distancia_km(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 12742 * math.asin(math.sqrt(a))
+
+class IndiceZonas:
+    CELULA = 0.02     # graus (~2 km)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versao = None
+        self.celulas = {}     # (i, j) -> [zona]
+        self.limites = None   # (i min, i max, j min, j max)
+        self.bairros = {}     # nome normalizado -> bairro
+
+    def _celula(self, lat, lon):
+        return math.floor(lat / self.CELULA), math.floor(lon / self.CELULA)
+
+    def _actualizar(self):
+        v = versao_dados()
+        if v == self.versao:
+            return
+        with self.lock:
+            if v == self.versao:
+                return
+            celulas = {}
+            for z in query("SELECT id, nome, lat, lon, capacidade, ocupacao, recursos FROM zona "
+                           "WHERE ativa=1 AND lat IS NOT NULL AND lon IS NOT NULL"):
+                z = row_to_dict(z)
+                z['vagas'] = max(0, z['capacidade'] - z['ocupacao'])
+                celulas.setdefault(self._celula(z['lat'], z['lon']), []).append(z)
+            self.limites = (min(i for i, _ in celulas), max(i for i, _ in celulas),
+                            min(j for _, j in celulas), max(j for _, j in celulas)) if celulas else None
+            self.celulas = celulas
+            self.bairros = {normalizar_nome(b['nome']): row_to_dict(b) for b in query("SELECT * FROM bairro")}
+            self.versao = v
+
+    def bairro(self, texto):
+        # Nome exacto, senão o único que começa assim, senão o primeiro que o contém
+        self._actualizar()
+        chave = normalizar_nome(texto)
+        if not chave:
+            return None
+        if chave in self.bairros:
+            return self.bairros[chave]
+        prefixo = [b for n, b in self.bairros.items() if n.startswith(chave)]
+        if len(prefixo) == 1:
+            return prefixo[0]
+        return next((b for n, b in sorted(self.bairros.items()) if chave in n), None)
+
+    def proximas(self, lat, lon, k=3, pessoas=1):
+        self._actualizar()
+        celulas, limites = self.celulas, self.limites
+        if not limites or not na_area_servico(lat, lon):
+            return []
+        i0, i1, j0, j1 = limites
+        ci, cj = self._celula(lat, lon)
+        # Um anel r só tem pontos a mais de (r - 1) células do ponto; em km,
+        # usa-se o grau de longitude (o mais curto) à latitude do ponto
+        km_celula = self.CELULA * 111.32 * math.cos(math.radians(min(abs(lat) + self.CELULA, 89)))
+        # Os anéis antes da caixa das zonas estão vazios; os que passam dela ou
+        # de ZONAS_RAIO_MAX_KM já não interessam. Em cada anel só se vêem as
+        # células dentro da caixa.
+        r_min = max(0, i0 - ci, ci - i1, j0 - cj, cj - j1)
+        r_max = min(max(abs(ci - i0), abs(ci - i1), abs(cj - j0), abs(cj - j1)),
+                    math.ceil(ZONAS_RAIO_MAX_KM / km_celula) + 1)
+        achadas = []
+        for r in range(r_min, r_max + 1):
+            if len(achadas) >= k and achadas[k - 1][0] <= (r - 1) * km_celula:
+                break
+            for i in range(max(ci - r, i0), min(ci + r, i1) + 1):
+                if abs(i - ci) == r:
+                    colunas = range(max(cj - r, j0), min(cj + r, j1) + 1)
+                else:
+                    colunas = [j for j in (cj - r, cj + r) if j0 <= j <= j1]
+                for j in colunas:
+                    for z in celulas.get((i, j), ()):
+                        if z['vagas'] >= pessoas:
+                            d = distancia_km(lat, lon, z['lat'], z['lon'])
+                            if d <= ZONAS_RAIO_MAX_KM:
+                                achadas.append((d, z['id'], z))
+            achadas.sort()
+        return [dict(z, distancia_km=round(d, 2)) for d, _, z in achadas[:k]]
+
+indice_zonas = IndiceZonas()
+
+@app.route('/api/zonas/proximas')
+def zonas_proximas():
+    # ?lat=&lon= ou ?bairro=, e opcionalmente k (até 10) e pessoas
+    k = max(1, min(request.args.get('k', 3, type=int), 10))
+    pessoas = max(1, request.args.get('pessoas', 1, type=int))
+    lat, lon = request.args.get('lat', type=float), request.args.get('lon', type=float)
+    origem = None
+    if lat is None or lon is None:
+        origem = indice_zonas.bairro(request.args.get('bairro', ''))
+        if not origem:
+            return jsonify({'ok': False, 'msg': 'Indique lat e lon ou um bairro conhecido'}), 400
+        lat, lon = origem['lat'], origem['lon']
+    elif not na_area_servico(lat, lon):
+        return jsonify({'ok': False, 'msg': 'Coordenadas fora da área servida'}), 400
+    t = time.perf_counter()
+    zonas = indice_zonas.proximas(lat, lon, k, pessoas)
+    return jsonify({'origem': {'lat': lat, 'lon': lon, 'bairro': origem and origem['nome']},
+                    'zonas': zonas, 'us': round((time.perf_counter() - t) * 1e6)})
+
+@app.route('/api/bairros', methods=['GET', 'POST'])
+def api_bairros():
+    if request.method == 'POST':
+        # Admin corrige ou acrescenta o centro de um bairro
+        if not session.get('admin_id'):
+            return jsonify({'ok': False}), 401
+        d = request.get_json(silent=True) or {}
+        try:
+            nome, lat, lon = d['nome'].strip(), float(d['lat']), float(d['lon'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return jsonify({'ok': False, 'msg': 'nome, lat e lon obrigatórios'}), 400
+        if not nome or not na_area_servico(lat, lon):
+            return jsonify({'ok': False, 'msg': 'Dados inválidos ou fora da área servida'}), 400
+        escrever_alteracao("INSERT INTO bairro(nome, lat, lon) VALUES(?,?,?) "
+                           "ON CONFLICT(nome) DO UPDATE SET lat=excluded.lat, lon=excluded.lon",
+                           (nome, lat, lon), 'bairro', 0, 'reload')
+        return jsonify({'ok': True})
+    return jsonify([row_to_dict(b) for b in query("SELECT * FROM bairro ORDER BY nome")])
+
+
+# ═══════════════════════════════════════════════════════════════
+#  ALOCAÇÃO DE FAMÍLIAS ÀS ZONAS SEGURAS
+#  zona.ocupacao é mantida pelos triggers da migração 10 em cada INSERT,
+#  UPDATE e DELETE de familia. As sugestões escolhem a zona mais próxima do
+#  bairro com vagas para todo o grupo; para várias famílias por alojar,
+#  as maiores escolhem primeiro (guloso), descontando as vagas já dadas.
+# ═══════════════════════════════════════════════════════════════
+
+def sugerir_zonas(bairro, pessoas, k=3, vagas=None):
+    # vagas: {zona_id: vagas} já descontadas por outras sugestões do mesmo plano
+    n = k + len(vagas or ())
+    b = indice_zonas.bairro(bairro)
+    candidatas = indice_zonas.proximas(b['lat'], b['lon'], n, pessoas) if b else []
+    if len(candidatas) < n:
+        # Bairro sem centro conhecido ou sem zonas com coordenadas e vagas por
+        # perto: seguem-se as zonas com mais vagas
+        vistas = {z['id'] for z in candidatas}
+        candidatas += [dict(row_to_dict(z), distancia_km=None) for z in query(
+            "SELECT id, nome, lat, lon, capacidade, ocupacao, capacidade - ocupacao vagas FROM zona "
+            "WHERE ativa=1 AND capacidade - ocupacao >= ? ORDER BY capacidade - ocupacao DESC LIMIT ?",
+            (pessoas, n + len(vistas))) if z['id'] not in vistas]
+    if vagas is not None:
+        candidatas = [z for z in candidatas if vagas.get(z['id'], z['vagas']) >= pessoas]
+    return candidatas[:k]
+
+def plano_alocacao(limite=200):
+    familias = query("SELECT id, bairro, numero, abrigo FROM familia WHERE zona_id IS NULL "
+                     "ORDER BY numero DESC, id LIMIT ?", (limite,))
+    vagas, plano = {}, []
+    for f in familias:
+        z = next(iter(sugerir_zonas(f['bairro'], f['numero'], k=1, vagas=vagas)), None)
+        if z:
+            vagas[z['id']] = vagas.get(z['id'], z['vagas']) - f['numero']
+        plano.append({'familia_id': f['id'], 'bairro': f['bairro'], 'pessoas': f['numero'],
+                      'zona_id': z and z['id'], 'zona': z and z['nome'],
+                      'distancia_km': z and z['distancia_km']})
+    return plano
+
+@app.route('/api/alocacao/sugestao')
+@login_required
+def api_sugestao_zona():
+    pessoas = max(1, request.args.get('pessoas', 1, type=int))
+    return jsonify(sugerir_zonas(request.args.get('bairro', ''), pessoas))
+
+@app.route('/api/alocacao', methods=['GET', 'POST'])
+@login_required
+def api_alocacao():
+    if request.method == 'GET':
+        return jsonify(plano_alocacao(max(1, min(request.args.get('limite', 200, type=int), 1000))))
+    # Aplica [{familia_id, zona_id}] (por exemplo o plano aceite) numa transacção
+    pares = [(p.get('zona_id'), p.get('familia_id')) for p in (request.get_json(silent=True) or [])
+             if isinstance(p, dict) and p.get('familia_id') and p.get('zona_id')]
+
+    def aplicar(db):
+        for zona_id, fid in pares:
+            db.execute("UPDATE familia SET zona_id=?, abrigo=COALESCE((SELECT nome FROM zona WHERE id=?), abrigo) "
+                       "WHERE id=?", (zona_id, zona_id, fid))
+        return marcar_alteracao(db, 'familia', [fid for _, fid in pares])
+    if pares:
+        publicar_versao(pool.transacao(aplicar))
+    return jsonify({'ok': True, 'alocadas': len(pares)})
+
+@app.route('/api/ocupacao')
+def api_ocupacao():
+    # Para o mapa: cada zona activa com ocupação e vagas; ETag pela versão dos dados
+    etag = f'"ocupacao-{versao_dados()}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers={'ETag': etag})
+    zonas = [dict(row_to_dict(z), vagas=max(0, z['capacidade'] - z['ocupacao']),
+                  lotada=z['ocupacao'] >= z['capacidade']) for z in query(
+        "SELECT id, nome, lat, lon, capacidade, ocupacao FROM zona WHERE ativa=1 ORDER BY nome")]
+    resposta = jsonify({
+        'zonas': zonas,
+        'capacidade': sum(z['capacidade'] for z in zonas),
+        'ocupacao': sum(z['ocupacao'] for z in zonas),
+        'lotadas': sum(z['lotada'] for z in zonas),
+        'por_alojar': query("SELECT COALESCE(SUM(numero), 0) n FROM familia WHERE zona_id IS NULL", one=True)['n'],
+    })
+    resposta.headers.update({'ETag': etag, 'Cache-Control': 'no-cache'})
+    return resposta
+
+
 # ═══════════════════════════════════════════════════════════════
 #  Callback URL: https://alerta-nampula.onrender.com/ussd
 # ═══════════════════════════════════════════════════════════════
@@ -184,292 +1386,548 @@ def ussd():
     return resposta, 200, {'Content-Type': 'text/plain'}
 
 
-def _processar_ussd(partes, telefone):
-    if not partes or partes[0] == '':
-        return _menu_principal()
-
-    opcao = partes[0]
-    if opcao == '1': return _menu_alertas(partes)
-    if opcao == '2': return _menu_zonas(partes)
-    if opcao == '3': return _menu_ajuda(partes, telefone)
-    if opcao == '4': return _menu_informacoes(partes)
-    if opcao == '5': return _menu_voluntariado(partes, telefone)
-    if opcao == '0': return _menu_medico(partes, telefone)
-    return 'END Opção inválida. Marque novamente.'
-
+# ── Árvore de menus ───────────────────────────────────────────
+# Cada nó é um ecrã fixo (texto), um ecrã calculado a partir da BD (render,
+# guardado em cache até a próxima alteração de dados) ou uma acção que lê a
+# entrada do utilizador / grava na BD (accao, corre em cada pedido).
+# Nos filhos, '#' aceita qualquer entrada e VOLTAR regressa ao menu principal.
+VOLTAR = 'voltar'
 
-def _menu_principal():
-    return (
-        'CON  ALERTA NAMPULA \n'
-        '1. Ver Alertas Activos\n'
-        '2. Zonas Seguras\n'
-        '3. Pedir Ajuda\n'
-        '4. Informações\n'
-        '5. Voluntariado\n'
-        '0. Suporte Médico'
-    )
+def no(texto=None, render=None, accao=None, filhos=None, invalida='END Opção inválida.', classe=None):
+    # classe: prioridade na admissão ('vida', 'escrita' ou 'leitura'); por
+    # omissão as acções são escritas e os ecrãs leituras
+    return {'texto': texto, 'render': render, 'accao': accao,
+            'filhos': filhos or {}, 'invalida': invalida,
+            'classe': classe or ('escrita' if accao else 'leitura')}
 
+def _icone(tipo):
+    return '🔴' if tipo == 'urgente' else ('🟠' if tipo == 'atencao' else '🔵')
 
-def _menu_alertas(partes):
+def _alertas_ussd():
     # Lê directamente da tabela `alerta` — os mesmos do site
-    alertas = query(
+    return query(
         "SELECT * FROM alerta WHERE ativo=1 "
         "ORDER BY CASE tipo WHEN 'urgente' THEN 1 WHEN 'atencao' THEN 2 ELSE 3 END, data DESC "
         "LIMIT 3"
     )
 
-    if len(partes) == 1:
-        if not alertas:
-            return 'END Sem alertas activos.\nFique seguro!'
-        resp = 'CON ALERTAS ACTIVOS:\n'
-        for i, a in enumerate(alertas, 1):
-            icone = '🔴' if a['tipo'] == 'urgente' else ('🟠' if a['tipo'] == 'atencao' else '🔵')
-            resp += f'{i}. {icone} {a["titulo"]}\n'
-        resp += '\nDigite o número para detalhes\n0. Voltar'
-        return resp
-
-    if partes[1] == '0':
-        return _menu_principal()
+USSD_MAX = 182     # caracteres que cabem num ecrã
 
+def _zonas_ussd():
+    # Lê directamente da tabela `zona` — as mesmas do site
+    return query("SELECT * FROM zona WHERE ativa=1 ORDER BY nome")
+
+def _ecra_alertas(partes):
+    alertas = _alertas_ussd()
+    if not alertas:
+        return 'END Sem alertas activos.\nFique seguro!'
+    linhas = ['CON ALERTAS ACTIVOS:']
+    linhas += [f'{i}. {_icone(a["tipo"])} {a["titulo"]}' for i, a in enumerate(alertas, 1)]
+    linhas.append('\nDigite o número para detalhes\n0. Voltar')
+    return '\n'.join(linhas)
+
+def _ecra_alerta_detalhe(partes):
     try:
         idx = int(partes[1]) - 1
-        a = list(alertas)[idx]
-        nivel = '🔴 URGENTE' if a['tipo'] == 'urgente' else ('🟠 ATENÇÃO' if a['tipo'] == 'atencao' else '🔵 INFO')
-        msg = a['conteudo'][:120]
-        sufixo = '...' if len(a['conteudo']) > 120 else ''
-        return f'END {nivel}\n{a["titulo"]}\n────────────────\n{msg}{sufixo}'
+        if idx < 0:
+            raise IndexError
+        a = _alertas_ussd()[idx]
     except (IndexError, ValueError):
         return 'END Alerta não encontrado.'
-
-
-def _menu_zonas(partes):
-    if len(partes) == 1:
-        return (
-            'CON ZONAS SEGURAS\n'
-            '1. Listar zonas\n'
-            '2. Ver recursos\n'
-            '0. Voltar'
-        )
-
-    if partes[1] == '0':
-        return _menu_principal()
-
-    # Lê directamente da tabela `zona` — as mesmas do site
-    zonas = query("SELECT * FROM zona WHERE ativa=1 ORDER BY nome")
-
-    if partes[1] == '1':
-        if not zonas:
-            return 'END Sem zonas seguras registadas.'
-        resp = 'END ZONAS SEGURAS:\n────────────────\n'
-        for z in zonas:
-            resp += f'• {z["nome"]}\n  Cap: {z["capacidade"]} pessoas\n'
-        return resp
-
-    if partes[1] == '2':
-        if not zonas:
-            return 'END Sem dados disponíveis.'
-        resp = 'END RECURSOS NAS ZONAS:\n'
-        for z in zonas:
-            resp += f'• {z["nome"]}:\n  {z["recursos"]}\n'
-        return resp
-
-    return 'END Opção inválida.'
-
-
-def _menu_ajuda(partes, telefone):
-    if len(partes) == 1:
-        return (
-            'CON PEDIR AJUDA\n'
-            '1. RESGATE URGENTE\n'
-            '2. Água potável\n'
-            '3. Alimentos\n'
-            '4. Medicamentos\n'
-            '0. Voltar'
-        )
-
-    if partes[1] == '0':
-        return _menu_principal()
-
-    tipos = {'1': 'resgate', '2': 'agua', '3': 'comida', '4': 'medicamentos'}
-    tipo = tipos.get(partes[1])
-    if not tipo:
-        return 'END Opção inválida.'
-
-    # Pedir detalhe adicional
-    if tipo in ('agua', 'comida') and len(partes) == 2:
-        return 'CON Quantas pessoas precisam?'
-    if tipo == 'medicamentos' and len(partes) == 2:
-        return 'CON Qual medicamento ou emergência?'
-
-    # Construir descrição
-    if tipo == 'resgate':
-        descricao = 'Resgate urgente via USSD'
-    elif tipo == 'agua':
-        descricao = f'Água para {partes[2] if len(partes) > 2 else "?"} pessoas'
-    elif tipo == 'comida':
-        descricao = f'Alimentos para {partes[2] if len(partes) > 2 else "?"} pessoas'
+    nivel = '🔴 URGENTE' if a['tipo'] == 'urgente' else ('🟠 ATENÇÃO' if a['tipo'] == 'atencao' else '🔵 INFO')
+    msg = a['conteudo'][:120]
+    sufixo = '...' if len(a['conteudo']) > 120 else ''
+    return f'END {nivel}\n{a["titulo"]}\n────────────────\n{msg}{sufixo}'
+
+def _lista_ussd(cabecalho, itens, rodape=''):
+    # Corta a lista para caber num ecrã USSD, indicando quantas ficaram de fora
+    texto = cabecalho
+    for i, item in enumerate(itens):
+        mais = f'… e mais {len(itens) - i - 1}\n' if i < len(itens) - 1 else ''
+        if len(texto) + len(item) + len(mais) + len(rodape) > USSD_MAX:
+            return texto + f'… e mais {len(itens) - i}\n' + rodape
+        texto += item
+    return texto + rodape
+
+def _ecra_zonas_lista(partes):
+    zonas = _zonas_ussd()
+    if not zonas:
+        return 'END Sem zonas seguras registadas.'
+    return _lista_ussd('END ZONAS SEGURAS:\n────────────────\n',
+                       [f'• {z["nome"]}\n  Cap: {z["capacidade"]} pessoas\n' for z in zonas])
+
+def _ecra_zonas_recursos(partes):
+    zonas = _zonas_ussd()
+    if not zonas:
+        return 'END Sem dados disponíveis.'
+    return _lista_ussd('END RECURSOS NAS ZONAS:\n', [f'• {z["nome"]}:\n  {z["recursos"]}\n' for z in zonas])
+
+def _ecra_zonas_proximas(partes):
+    # Bairro desconhecido, zonas sem coordenadas (BDs anteriores à migração 9)
+    # ou nenhuma com vagas por perto: sugerir_zonas completa com as que têm
+    # mais vagas e, se estão todas cheias, mostra-se a lista de sempre. Nunca
+    # se diz que não há abrigos quando há.
+    texto = partes[2] if len(partes) > 2 else ''
+    b = indice_zonas.bairro(texto)
+    zonas = sugerir_zonas(texto, 1, k=3)
+    if not zonas:
+        return _ecra_zonas_lista(partes)
+    if b and zonas[0]['distancia_km'] is not None:
+        cabecalho = f'END ZONAS PERTO DE {b["nome"].upper()}:\n'
     else:
-        descricao = f'Medicamentos: {partes[2] if len(partes) > 2 else "não especificado"}'
-
-    try:
-        pid = query(
+        cabecalho = 'END ZONAS COM MAIS VAGAS:\n'
+    return _lista_ussd(cabecalho, [
+        f'• {z["nome"][:28]}\n  {z["distancia_km"]:.1f} km, {z["vagas"]} vagas\n' if z['distancia_km'] is not None
+        else f'• {z["nome"][:28]}\n  {z["vagas"]} vagas\n' for z in zonas])
+
+# ── Pedidos repetidos ─────────────────────────────────────────
+# Numa emergência as pessoas voltam a marcar e repetem o mesmo pedido. Um
+# pedido igual (telefone, tipo, descrição normalizada) a outro ainda aberto e
+# feito há menos de TTL_S devolve o Ref# existente em vez de criar outra linha.
+# O índice partilhado entre workers é a tabela pedido_recente, consultada e
+# escrita na mesma transacção da fila de escrita (sem corridas entre workers);
+# cada worker guarda à frente uma LRU em memória para não ir à fila quando o
+# mesmo telefone volta a marcar.
+class DedupPedidos:
+    MAX = 10000
+    PODA_CADA = 256
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.recentes = OrderedDict()    # chave -> (pedido_id, expira)
+        self.gravados = 0
+        self.metricas = {'novos': 0, 'suprimidos': 0, 'suprimidos_memoria': 0}
+
+    @staticmethod
+    def chave(telefone, tipo, descricao):
+        return hashlib.sha1(f'{telefone}|{tipo}|{normalizar_nome(descricao)}'.encode()).hexdigest()[:20]
+
+    def _lembrar(self, chave, pid, expira):
+        with self.lock:
+            self.recentes[chave] = (pid, expira)
+            self.recentes.move_to_end(chave)
+            while len(self.recentes) > self.MAX:
+                self.recentes.popitem(last=False)
+
+    def _em_memoria(self, chave):
+        with self.lock:
+            pid, expira = self.recentes.get(chave, (None, 0))
+            if pid and expira <= time.time():
+                del self.recentes[chave]
+                return None
+            if pid:
+                self.recentes.move_to_end(chave)
+            return pid
+
+    def _procurar(self, chave):
+        def procurar(db):
+            r = db.execute("SELECT r.pedido_id FROM pedido_recente r JOIN ussd_pedido p ON p.id = r.pedido_id "
+                           "WHERE r.chave=? AND r.expira>? AND p.status IN ('pendente', 'em curso')",
+                           (chave, time.time())).fetchone()
+            return r and r[0]
+        return procurar
+
+    def _guardar(self, chave, expira):
+        def guardar(db, pid):
+            db.execute("INSERT OR REPLACE INTO pedido_recente(chave, pedido_id, expira) VALUES(?,?,?)",
+                       (chave, pid, expira))
+            self.gravados += 1
+            if self.gravados % self.PODA_CADA == 0:
+                db.execute("DELETE FROM pedido_recente WHERE expira <= ?", (time.time(),))
+        return guardar
+
+    def inserir(self, telefone, tipo, descricao):
+        # -> (Ref#, repetido?)
+        chave = self.chave(telefone, tipo, descricao)
+        pid = self._em_memoria(chave)
+        if pid and query("SELECT 1 FROM ussd_pedido WHERE id=? AND status IN ('pendente', 'em curso')",
+                         (pid,), one=True):
+            self.metricas['suprimidos_memoria'] += 1
+            return pid, True
+        expira = time.time() + self.ttl
+        pid, novo = fila_escrita.inserir_unico(
             "INSERT INTO ussd_pedido(telefone, tipo, descricao, data) VALUES(?,?,?,?)",
-            (telefone, tipo, descricao, now_cat()), commit=True
-        )
+            (telefone, tipo, descricao, now_cat()), self._procurar(chave), self._guardar(chave, expira))
+        self._lembrar(chave, pid, expira)
+        self.metricas['novos' if novo else 'suprimidos'] += 1
+        return pid, not novo
+
+    def estado(self):
+        return dict(self.metricas, em_memoria=len(self.recentes), ttl_s=self.ttl)
+
+dedup_pedidos = DedupPedidos(float(os.environ.get('USSD_DEDUP_S', 900)))
+
+def _pedido_ajuda(tipo):
+    def accao(partes, telefone):
+        detalhe = partes[2] if len(partes) > 2 else None
+        if tipo == 'resgate':
+            descricao = 'Resgate urgente via USSD'
+        elif tipo == 'agua':
+            descricao = f'Água para {detalhe or "?"} pessoas'
+        elif tipo == 'comida':
+            descricao = f'Alimentos para {detalhe or "?"} pessoas'
+        else:
+            descricao = f'Medicamentos: {detalhe or "não especificado"}'
+        try:
+            pid, repetido = dedup_pedidos.inserir(telefone, tipo, descricao)
+        except Exception:
+            return 'END Erro ao registar. Ligue 119.'
         msgs = {
             'resgate':      f'END ✔ RESGATE SOLICITADO! (Ref#{pid})\nAjuda a caminho.\nLigue 118 se possível.',
             'agua':         f'END ✔ Pedido registado (Ref#{pid})\n{descricao}.',
             'comida':       f'END ✔ Pedido registado (Ref#{pid})\n{descricao}.',
             'medicamentos': f'END ✔ Pedido registado (Ref#{pid})\nLigue 119 para urgência médica.',
         }
-        return msgs[tipo]
-    except Exception:
-        return 'END Erro ao registar. Ligue 119.'
-
-
-def _menu_informacoes(partes):
-    if len(partes) == 1:
-        return (
-            'CON INFORMAÇÕES\n'
-            '1. Alertas activos\n'
-            '2. Números emergência\n'
-            '3. Conselhos segurança\n'
-            '0. Voltar'
-        )
-
-    if partes[1] == '0':
-        return _menu_principal()
-    if partes[1] == '1':
-        return _menu_alertas(['1'])
-    if partes[1] == '2':
-        return (
-            'END EMERGÊNCIA:\n'
-            'Polícia:      117\n'
-            'Bombeiros:    118\n'
-            'SAMU/Saúde:   119\n'
-            'Prot.Civil:   26212000\n'
-            'Alerta Namp.: 847791199'
-        )
-    if partes[1] == '3':
-        return (
-            'END CONSELHOS:\n'
-            '• Dirija-se a zonas altas\n'
-            '• Evite linhas eléctricas\n'
-            '• Não atravesse rios\n'
-            '• Guarde documentos\n'
-            '• Siga as autoridades\n'
-            'Site: alerta-nampula.onrender.com'
-        )
-    return 'END Opção inválida.'
+        return msgs[tipo] + ('\nO seu pedido já estava registado.' if repetido else '')
+    return accao
 
+def _registar_voluntario(partes, telefone):
+    nome = partes[2].strip()[:100]
+    hab  = partes[3].strip()[:200] if len(partes) > 3 else ''
 
-def _menu_voluntariado(partes, telefone):
-    if len(partes) == 1:
-        return (
-            'CON VOLUNTARIADO\n'
-            '1. Registar-me\n'
-            '2. Informações doações\n'
-            '0. Voltar'
-        )
-
-    if partes[1] == '0':
-        return _menu_principal()
+    if len(nome) < 2:
+        return 'END Nome inválido. Tente novamente.'
 
-    if partes[1] == '1':
-        if len(partes) == 2:
-            return 'CON O seu nome completo:'
-        if len(partes) == 3:
-            return 'CON As suas habilidades:\n(ex: médico, motorista)'
+    existe = query("SELECT id FROM ussd_voluntario WHERE telefone=?", (telefone,), one=True)
+    if existe:
+        return 'END Já está registado!\nObrigado pelo seu apoio.'
 
-        nome = partes[2].strip()[:100]
-        hab  = partes[3].strip()[:200] if len(partes) > 3 else ''
-
-        if len(nome) < 2:
-            return 'END Nome inválido. Tente novamente.'
-
-        existe = query("SELECT id FROM ussd_voluntario WHERE telefone=?", (telefone,), one=True)
-        if existe:
-            return 'END Já está registado!\nObrigado pelo seu apoio.'
-
-        try:
-            query(
-                "INSERT INTO ussd_voluntario(nome, telefone, habilidades, data) VALUES(?,?,?,?)",
-                (nome, telefone, hab, now_cat()), commit=True
-            )
-            return f'END ✔ Obrigado, {nome}!\nEntramos em contacto em breve.'
-        except Exception:
-            return 'END Erro no registo. Tente novamente.'
-
-    if partes[1] == '2':
-        return (
-            'END DOAÇÕES:\n'
-            'M-Pesa Atemdimento: 847791199\n'
-            'M-Pesa INGC: 847791199\n'
-            'Site: alerta-nampula.onrender.com'
+    try:
+        fila_escrita.inserir(
+            "INSERT INTO ussd_voluntario(nome, telefone, habilidades, data) VALUES(?,?,?,?)",
+            (nome, telefone, hab, now_cat())
         )
+        return f'END ✔ Obrigado, {nome}!\nEntramos em contacto em breve.'
+    except Exception:
+        return 'END Erro no registo. Tente novamente.'
 
-    return 'END Opção inválida.'
-
-
-def _menu_medico(partes, telefone):
-    if len(partes) == 1:
+def _pedir_ambulancia(partes, telefone):
+    try:
+        pid, repetido = dedup_pedidos.inserir(telefone, 'ambulancia', 'Ambulância solicitada via USSD')
         return (
-            'CON SUPORTE MÉDICO\n'
-            '1. Unidades de saúde\n'
-            '2. Pedir ambulância\n'
-            '3. Zonas seguras\n'
-            '4. Primeiros socorros\n'
-            '0. Voltar'
+            f'END ✔ AMBULÂNCIA SOLICITADA! (Ref#{pid})\n'
+            'Ligue 119 para confirmar.\n'
+            'Informe a sua localização.'
+            + ('\nO seu pedido já estava registado.' if repetido else '')
         )
+    except Exception:
+        return 'END Erro. Ligue 119 directamente.'
 
-    if partes[1] == '0':
-        return _menu_principal()
-
-    if partes[1] == '1':
-        return (
-            'END UNIDADES DE SAÚDE:\n'
-            '• Hospital Central Nampula\n'
-            '• CS Napipine\n'
-            '• CS Muatala\n'
-            '• CS Muhala\n'
-            'Emergência: 119'
-        )
+MENU_ALERTAS = no(render=_ecra_alertas, filhos={
+    '0': VOLTAR,
+    '#': no(render=_ecra_alerta_detalhe),
+})
 
-    if partes[1] == '2':
-        try:
-            pid = query(
-                "INSERT INTO ussd_pedido(telefone, tipo, descricao, data) VALUES(?,?,?,?)",
-                (telefone, 'ambulancia', 'Ambulância solicitada via USSD', now_cat()), commit=True
-            )
-            return (
-                f'END ✔ AMBULÂNCIA SOLICITADA! (Ref#{pid})\n'
-                'Ligue 119 para confirmar.\n'
-                'Informe a sua localização.'
-            )
-        except Exception:
-            return 'END Erro. Ligue 119 directamente.'
-
-    if partes[1] == '3':
-        # Lê as zonas do site
-        zonas = query("SELECT * FROM zona WHERE ativa=1 ORDER BY nome")
-        if not zonas:
-            return 'END Sem zonas seguras registadas.\nLigue 119.'
-        resp = 'END ZONAS SEGURAS:\n'
-        for z in zonas:
-            resp += f'• {z["nome"]}\n  Cap: {z["capacidade"]} pessoas\n'
-        return resp
+MENU_USSD = no(
+    texto=(
+        'CON  ALERTA NAMPULA \n'
+        '1. Ver Alertas Activos\n'
+        '2. Zonas Seguras\n'
+        '3. Pedir Ajuda\n'
+        '4. Informações\n'
+        '5. Voluntariado\n'
+        '0. Suporte Médico'
+    ),
+    invalida='END Opção inválida. Marque novamente.',
+    filhos={
+        '1': MENU_ALERTAS,
+        '2': no(
+            texto=(
+                'CON ZONAS SEGURAS\n'
+                '1. Listar zonas\n'
+                '2. Ver recursos\n'
+                '3. Mais próximas de mim\n'
+                '0. Voltar'
+            ),
+            filhos={
+                '0': VOLTAR,
+                '1': no(render=_ecra_zonas_lista),
+                '2': no(render=_ecra_zonas_recursos),
+                '3': no(texto='CON Em que bairro está?', filhos={'#': no(render=_ecra_zonas_proximas)}),
+            }),
+        '3': no(
+            texto=(
+                'CON PEDIR AJUDA\n'
+                '1. RESGATE URGENTE\n'
+                '2. Água potável\n'
+                '3. Alimentos\n'
+                '4. Medicamentos\n'
+                '0. Voltar'
+            ),
+            filhos={
+                '0': VOLTAR,
+                '1': no(accao=_pedido_ajuda('resgate'), classe='vida'),
+                '2': no(texto='CON Quantas pessoas precisam?',
+                        filhos={'#': no(accao=_pedido_ajuda('agua'))}),
+                '3': no(texto='CON Quantas pessoas precisam?',
+                        filhos={'#': no(accao=_pedido_ajuda('comida'))}),
+                '4': no(texto='CON Qual medicamento ou emergência?',
+                        filhos={'#': no(accao=_pedido_ajuda('medicamentos'))}),
+            }),
+        '4': no(
+            texto=(
+                'CON INFORMAÇÕES\n'
+                '1. Alertas activos\n'
+                '2. Números emergência\n'
+                '3. Conselhos segurança\n'
+                '0. Voltar'
+            ),
+            filhos={
+                '0': VOLTAR,
+                '1': no(render=_ecra_alertas),
+                '2': no(texto=(
+                    'END EMERGÊNCIA:\n'
+                    'Polícia:      117\n'
+                    'Bombeiros:    118\n'
+                    'SAMU/Saúde:   119\n'
+                    'Prot.Civil:   26212000\n'
+                    'Alerta Namp.: 847791199'
+                )),
+                '3': no(texto=(
+                    'END CONSELHOS:\n'
+                    '• Dirija-se a zonas altas\n'
+                    '• Evite linhas eléctricas\n'
+                    '• Não atravesse rios\n'
+                    '• Guarde documentos\n'
+                    '• Siga as autoridades\n'
+                    'Site: alerta-nampula.onrender.com'
+                )),
+            }),
+        '5': no(
+            texto=(
+                'CON VOLUNTARIADO\n'
+                '1. Registar-me\n'
+                '2. Informações doações\n'
+                '0. Voltar'
+            ),
+            filhos={
+                '0': VOLTAR,
+                '1': no(texto='CON O seu nome completo:', filhos={
+                    '#': no(texto='CON As suas habilidades:\n(ex: médico, motorista)', filhos={
+                        '#': no(accao=_registar_voluntario),
+                    }),
+                }),
+                '2': no(texto=(
+                    'END DOAÇÕES:\n'
+                    'M-Pesa Atemdimento: 847791199\n'
+                    'M-Pesa INGC: 847791199\n'
+                    'Site: alerta-nampula.onrender.com'
+                )),
+            }),
+        '0': no(
+            texto=(
+                'CON SUPORTE MÉDICO\n'
+                '1. Unidades de saúde\n'
+                '2. Pedir ambulância\n'
+                '3. Zonas seguras\n'
+                '4. Primeiros socorros\n'
+                '0. Voltar'
+            ),
+            filhos={
+                '0': VOLTAR,
+                '1': no(texto=(
+                    'END UNIDADES DE SAÚDE:\n'
+                    '• Hospital Central Nampula\n'
+                    '• CS Napipine\n'
+                    '• CS Muatala\n'
+                    '• CS Muhala\n'
+                    'Emergência: 119'
+                )),
+                '2': no(accao=_pedir_ambulancia, classe='vida'),
+                '3': no(texto='CON Em que bairro está?', filhos={'#': no(render=_ecra_zonas_proximas)}),
+                '4': no(texto=(
+                    'END PRIMEIROS SOCORROS:\n'
+                    'Hemorragia: comprima\n'
+                    'Inconsciente: deite de lado\n'
+                    'Afogado: RCP imediato\n'
+                    'Queimadura: água fria\n'
+                    'Sempre ligue 119'
+                )),
+            }),
+    })
 
-    if partes[1] == '4':
-        return (
-            'END PRIMEIROS SOCORROS:\n'
-            'Hemorragia: comprima\n'
-            'Inconsciente: deite de lado\n'
-            'Afogado: RCP imediato\n'
-            'Queimadura: água fria\n'
-            'Sempre ligue 119'
-        )
+def compilar_menu(raiz):
+    # Resolve VOLTAR e atribui a cada nó o seu caminho (chave da cache)
+    def visitar(n, caminho):
+        n['caminho'] = caminho
+        for op, filho in n['filhos'].items():
+            if filho == VOLTAR:
+                n['filhos'][op] = raiz
+            else:
+                visitar(filho, caminho + (op,))
+    visitar(raiz, ())
+    return raiz
+
+MENU_USSD = compilar_menu(MENU_USSD)
+
+class CacheEcras:
+    # Ecrãs calculados, válidos enquanto a versão dos dados não mudar
+    MAX = 512
+
+    def __init__(self):
+        self.versao = None
+        self.ecras = {}
+        self.hits = self.misses = 0
+
+    def guardado(self, chave):
+        v = versao_dados()
+        if v != self.versao:
+            self.ecras, self.versao = {}, v
+        texto = self.ecras.get(chave)
+        if texto is not None:
+            self.hits += 1
+        return texto
+
+    def obter(self, chave, gerar):
+        texto = self.guardado(chave)
+        if texto is not None:
+            return texto
+        self.misses += 1
+        texto = gerar()
+        if len(self.ecras) >= self.MAX:
+            self.ecras = {}
+        self.ecras[chave] = texto
+        return texto
+
+cache_ussd = CacheEcras()
+
+# ── Admissão por prioridade ───────────────────────────────────
+# Em picos de carga os pedidos de vida (resgate, ambulância) não podem ficar
+# atrás de quem está a consultar menus. Cada pedido que vai à BD tira uma
+# ficha do balde do worker; as leituras não podem gastar as últimas fichas
+# (reservadas às escritas e ao resgate) e as escritas não podem gastar as do
+# resgate, que nunca é recusado. Com o balde do worker abaixo de metade conta
+# também o de cada telefone (cabe uma sessão inteira), para um só número não
+# gastar o que resta; fora disso ninguém é recusado. Ecrãs fixos e ecrãs já
+# em cache são servidos sem passar pela admissão.
+class LimiteTaxa:
+    # Balde de fichas: `taxa` mensagens por segundo, rajadas até `rajada`
+    def __init__(self, taxa, rajada=None):
+        self.taxa = taxa
+        self.rajada = rajada or taxa
+        self.fichas = self.rajada
+        self.t = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _repor(self):
+        agora = time.monotonic()
+        self.fichas = min(self.rajada, self.fichas + (agora - self.t) * self.taxa)
+        self.t = agora
+
+    def esperar(self, n=1):
+        while True:
+            with self.lock:
+                self._repor()
+                # Um lote maior que a rajada sai com o balde cheio e fica a dever
+                if self.fichas >= min(n, self.rajada):
+                    self.fichas -= n
+                    return
+                falta = (min(n, self.rajada) - self.fichas) / self.taxa
+            time.sleep(falta)
+
+    def nivel(self):
+        with self.lock:
+            self._repor()
+            return self.fichas
+
+    def tentar(self, reserva=0, forcar=False):
+        # Sem esperar: tira uma ficha se ficarem pelo menos `reserva`
+        # (com forcar tira sempre, deixando o balde a dever)
+        with self.lock:
+            self._repor()
+            if forcar or self.fichas - 1 >= reserva:
+                self.fichas -= 1
+                return True
+            return False
+
+class AdmissaoUSSD:
+    CLASSES = ('vida', 'escrita', 'leitura')
+    MAX_TELEFONES = 10000
+
+    def __init__(self, taxa, taxa_telefone, rajada_telefone, reserva_vida, reserva_escrita):
+        self.global_ = LimiteTaxa(taxa, taxa * 2)
+        # Fichas que cada classe não pode gastar
+        self.reserva = {'vida': 0,
+                        'escrita': self.global_.rajada * reserva_vida,
+                        'leitura': self.global_.rajada * (reserva_vida + reserva_escrita)}
+        self.taxa_telefone, self.rajada_telefone = taxa_telefone, rajada_telefone
+        self.telefones = {}
+        self.lock = threading.Lock()
+        self.metricas = {c: {'admitidos': 0, 'recusados': 0} for c in self.CLASSES}
+        self.metricas['leitura']['da_cache'] = 0
+
+    def _balde(self, telefone):
+        with self.lock:
+            b = self.telefones.get(telefone)
+            if b is None:
+                if len(self.telefones) >= self.MAX_TELEFONES:
+                    # Esquece os baldes que já voltaram a encher
+                    cheio = time.monotonic() - self.rajada_telefone / self.taxa_telefone
+                    self.telefones = {k: v for k, v in self.telefones.items() if v.t > cheio}
+                b = self.telefones[telefone] = LimiteTaxa(self.taxa_telefone, self.rajada_telefone)
+            return b
+
+    def admitir(self, classe, telefone):
+        if classe == 'vida':
+            self.global_.tentar(forcar=True)
+            ok = True
+        else:
+            balde = self._balde(telefone)
+            sob_pressao = self.global_.nivel() < self.global_.rajada / 2
+            ok = (not sob_pressao or balde.nivel() >= 1) and self.global_.tentar(self.reserva[classe])
+            if ok:
+                balde.tentar()   # só depois de admitido; sem fichas não fica a dever
+        self.metricas[classe]['admitidos' if ok else 'recusados'] += 1
+        return ok
+
+    def servido_da_cache(self):
+        self.metricas['leitura']['da_cache'] += 1
+
+    def estado(self):
+        return dict(self.metricas, fichas=round(self.global_.fichas, 1), telefones=len(self.telefones))
+
+admissao = AdmissaoUSSD(
+    taxa=float(os.environ.get('USSD_TAXA', 300)),                   # pedidos/s por worker
+    taxa_telefone=float(os.environ.get('USSD_TAXA_TELEFONE', 0.5)),
+    rajada_telefone=int(os.environ.get('USSD_RAJADA_TELEFONE', 20)),  # uma sessão completa e repetições
+    reserva_vida=float(os.environ.get('USSD_RESERVA_VIDA', 0.2)),   # fracção do balde
+    reserva_escrita=float(os.environ.get('USSD_RESERVA_ESCRITA', 0.2)),
+)
+
+SOBRECARGA_USSD = 'END Serviço sobrecarregado.\nTente dentro de alguns minutos.\nEmergência: ligue 119.'
 
-    return 'END Opção inválida.'
+def _processar_ussd(partes, telefone):
+    if not partes or partes[0] == '':
+        return MENU_USSD['texto']
+
+    n, usadas = MENU_USSD, 0
+    for op in partes:
+        if n['accao'] or not n['filhos']:
+            break   # as entradas seguintes pertencem a este nó
+        usadas += 1
+        filho = n['filhos'].get(op) or n['filhos'].get('#')
+        if filho is None:
+            return n['invalida']
+        n = filho
+        if n is MENU_USSD:
+            return n['texto']
+
+    if n['accao']:
+        if not admissao.admitir(n['classe'], telefone):
+            return SOBRECARGA_USSD
+        return n['accao'](partes, telefone)
+    if n['render']:
+        # Chave: entradas que levaram ao nó, incluindo as livres ('#')
+        chave = '*'.join(partes[:usadas])
+        texto = cache_ussd.guardado(chave)
+        if texto is not None:
+            admissao.servido_da_cache()
+            return texto
+        if not admissao.admitir(n['classe'], telefone):
+            return SOBRECARGA_USSD
+        return cache_ussd.obter(chave, lambda: n['render'](partes))
+    return n['texto']
 
 
 # ═══════════════════════════════════════════════════════════════
@@ -498,45 +1956,855 @@ def api_ussd_voluntarios():
     vols = query("SELECT * FROM ussd_voluntario ORDER BY data DESC")
     return jsonify([dict(v) for v in vols])
 
+# ── Pedidos por hora (séries de contador_hora) ────────────────
+TIPOS_PEDIDO = ('resgate', 'agua', 'comida', 'medicamentos', 'ambulancia')
+SERIE_MAX_HORAS = 24 * 90
+SERIE_MAX_NOMES = 50
+SQL_SERIE = "SELECT chave, hora, valor FROM contador_hora WHERE chave IN ({}) AND hora BETWEEN ? AND ?"
+
+@app.route('/api/stats/timeseries')
+@login_required
+def api_timeseries():
+    # ?tipo=agua,comida (por omissão todos) ou ?bairro=A,B; janela ?horas=48 (até
+    # agora) ou ?desde=AAAA-MM-DD HH&ate=AAAA-MM-DD HH. Uma contagem por hora, com zeros.
+    agora = datetime.strptime(now_cat()[:13], '%Y-%m-%d %H')
+    try:
+        ate = datetime.strptime(request.args['ate'], '%Y-%m-%d %H') if request.args.get('ate') else agora
+        desde = (datetime.strptime(request.args['desde'], '%Y-%m-%d %H') if request.args.get('desde')
+                 else ate - timedelta(hours=request.args.get('horas', 48, type=int) - 1))
+    except ValueError:
+        return jsonify({'ok': False, 'msg': 'Data inválida (AAAA-MM-DD HH)'}), 400
+    n = int((ate - desde).total_seconds() // 3600) + 1
+    if not 1 <= n <= SERIE_MAX_HORAS:
+        return jsonify({'ok': False, 'msg': f'A janela tem de ter entre 1 e {SERIE_MAX_HORAS} horas'}), 400
+    if request.args.get('bairro'):
+        prefixo, nomes = 'ussd_bairro|', [b.strip() for b in request.args['bairro'].split(',') if b.strip()]
+    else:
+        prefixo, nomes = 'ussd|', [t for t in request.args.get('tipo', ','.join(TIPOS_PEDIDO)).split(',')
+                                   if t in TIPOS_PEDIDO]
+    nomes = list(dict.fromkeys(nomes))[:SERIE_MAX_NOMES]
+    if not nomes:
+        return jsonify({'ok': False, 'msg': 'Tipo desconhecido'}), 400
+
+    horas = [(desde + timedelta(hours=i)).strftime('%Y-%m-%d %H') for i in range(n)]
+    posicao = {h: i for i, h in enumerate(horas)}
+    series = {nome: [0] * n for nome in nomes}
+    # Uma leitura por intervalo da chave primária (chave, hora) de contador_hora
+    for r in query(SQL_SERIE.format(','.join('?' * len(nomes))),
+                   tuple(prefixo + nome for nome in nomes) + (horas[0], horas[-1])):
+        series[r['chave'][len(prefixo):]][posicao[r['hora']]] = r['valor']
+    return jsonify({'horas': horas, 'series': series,
+                    'totais': {nome: sum(v) for nome, v in series.items()}})
+
+
+# ═══════════════════════════════════════════════════════════════
+#  API — tabelas do admin, paginadas por cursor (data, id)
+#  Cada separador do admin carrega as suas linhas a pedido.
+# ═══════════════════════════════════════════════════════════════
+
+# nome na API -> (tabela, {filtro: condição SQL}, ordenar por data?)
+TABELAS_ADMIN = {
+    'alertas':     ('alerta',          {'tipo': 'tipo = ?', 'ativo': 'ativo = ?'}, True),
+    'familias':    ('familia',         {'bairro': 'bairro LIKE ?', 'situacao': 'situacao = ?'}, True),
+    'zonas':       ('zona',            {'ativa': 'ativa = ?'}, False),
+    'apoios':      ('apoio',           {'status': "COALESCE(status, 'pendente') = ?", 'tipo': 'tipo = ?'}, True),
+    'subscricoes': ('subscricao',      {}, True),
+    'pedidos':     ('ussd_pedido',     {'status': 'status = ?', 'tipo': 'tipo = ?'}, True),
+    'voluntarios': ('ussd_voluntario', {}, True),
+}
+PAGINA_MAX = 200
+
+def _sql_pagina(nome, args, limite, tabela=None):
+    _, filtros, por_data = TABELAS_ADMIN[nome]
+    tabela = tabela or TABELAS_ADMIN[nome][0]
+    onde, params = [], []
+    for campo, cond in filtros.items():
+        valor = args.get(campo, '').strip()
+        if valor:
+            onde.append(cond)
+            params.append(valor + '%' if 'LIKE' in cond else valor)
+    if por_data:
+        if args.get('desde'):
+            onde.append('data >= ?'); params.append(args['desde'])
+        if args.get('ate'):
+            onde.append('data <= ?'); params.append(args['ate'] + ' 23:59:59')
+    # Cursor = "data|id" da última linha da página anterior
+    cursor = args.get('cursor', '')
+    if cursor:
+        data_c, _, id_c = cursor.rpartition('|')
+        if por_data:
+            onde.append('(data, id) < (?, ?)'); params += [data_c, int(id_c)]
+        else:
+            onde.append('id < ?'); params.append(int(id_c))
+    ordem = 'data DESC, id DESC' if por_data else 'id DESC'
+    where = (' WHERE ' + ' AND '.join(onde)) if onde else ''
+    return (f"SELECT * FROM {tabela}{where} ORDER BY {ordem} LIMIT ?",
+            tuple(params) + (limite + 1,))
+
+def _ler_pagina(nome, args, limite, ler=query):
+    # Até limite + 1 linhas (a última só indica que há mais)
+    tabela, _, por_data = TABELAS_ADMIN[nome]
+    rows = ler(*_sql_pagina(nome, args, limite))
+    if args.get('historico') == '1' and tabela in ARQUIVO:
+        # Histórico: as duas partes já vêm ordenadas pelo cursor; junta-se e corta-se
+        rows += ler(*_sql_pagina(nome, args, limite, f'arquivo_{tabela}'))
+        rows.sort(key=lambda r: (r['data'] if por_data else '', r['id']), reverse=True)
+    return rows[:limite + 1]
+
+def pagina(nome, args):
+    por_data = TABELAS_ADMIN[nome][2]
+    limite = max(1, min(args.get('limite', 50, type=int), PAGINA_MAX))
+    rows = _ler_pagina(nome, args, limite)
+    itens = [row_to_dict(r) for r in rows[:limite]]
+    proximo = None
+    if len(rows) > limite:
+        ultimo = itens[-1]
+        proximo = f"{ultimo['data'] if por_data else ''}|{ultimo['id']}"
+    return {'itens': itens, 'proximo': proximo}
+
+@app.route('/api/admin/<nome>')
+@login_required
+def api_admin_tabela(nome):
+    if nome not in TABELAS_ADMIN:
+        return jsonify({'ok': False, 'msg': 'Tabela desconhecida'}), 404
+    try:
+        return jsonify(pagina(nome, request.args))
+    except ValueError:
+        return jsonify({'ok': False, 'msg': 'Cursor inválido'}), 400
+
+# ── Pesquisa (índices FTS5 da migração 8) ─────────────────────
+# nome na API -> (índice, SQL do título mostrado, separador do admin)
+FONTES_BUSCA = {
+    'alertas':     ('busca_alerta',     "SELECT id, titulo, data FROM (SELECT id, titulo, data FROM alerta "
+                                        "UNION ALL SELECT id, titulo, data FROM arquivo_alerta) "
+                                        "WHERE id IN ({})", 'tab-alertas'),
+    'familias':    ('busca_familia',    "SELECT id, bairro || ' (' || numero || ' pessoas)' titulo, data "
+                                        "FROM familia WHERE id IN ({})", 'tab-familias'),
+    'pedidos':     ('busca_pedido',     "SELECT id, tipo || ' — ' || telefone titulo, data "
+                                        "FROM (SELECT id, tipo, telefone, data FROM ussd_pedido "
+                                        "UNION ALL SELECT id, tipo, telefone, data FROM arquivo_ussd_pedido) "
+                                        "WHERE id IN ({})", 'tab-ussd'),
+    'voluntarios': ('busca_voluntario', "SELECT id, nome titulo, data FROM ussd_voluntario WHERE id IN ({})", 'tab-ussd'),
+}
+BUSCA_MAX = 50
+BUSCA_PAGINAS = 20
+BUSCA_LIMIAR_RELEVANCIA = 5000
+
+def termos_busca(texto):
+    # Cada palavra vai entre aspas: nada do que o admin escreve é interpretado
+    # como sintaxe FTS5 (AND, NEAR, col:, ...). Só a última é prefixo (ainda a
+    # ser escrita); prefixos obrigam o FTS5 a juntar as listas de vários termos.
+    termos = ['"' + t.replace('"', '""') + '"' for t in re.split(r'[^\w+@.-]+', texto) if t.strip('+@.-')][:10]
+    return ' '.join(termos) + '*' if termos else ''
+
+def _trecho(texto):
+    # O snippet vem com marcas \x02...\x03; escapa-se o resto antes de as trocar
+    return str(Markup.escape(texto or '')).replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+def buscar(texto, fontes, limite, inicio):
+    expressao = termos_busca(texto)
+    if not expressao:
+        return {'itens': [], 'tem_mais': False, 'total': 0, 'total_exacto': True, 'ordem': 'relevancia'}
+    # Ordenar por bm25 obriga a pontuar todas as linhas que casam. Com muitas,
+    # mostram-se as mais recentes (ORDER BY rowid DESC pára ao fim de LIMIT
+    # linhas) e só essas são pontuadas. A contagem também pára no limiar.
+    totais = {nome: query(f"SELECT COUNT(*) n FROM (SELECT 1 FROM {FONTES_BUSCA[nome][0]} "
+                          f"WHERE {FONTES_BUSCA[nome][0]} MATCH ? LIMIT ?)",
+                          (expressao, BUSCA_LIMIAR_RELEVANCIA + 1), one=True)['n'] for nome in fontes}
+    ordem = 'relevancia' if sum(totais.values()) <= BUSCA_LIMIAR_RELEVANCIA else 'recentes'
+    achados = []
+    for nome in fontes:
+        indice, sql_titulo, separador = FONTES_BUSCA[nome]
+        if not totais[nome]:
+            continue
+        rows = query(f"SELECT rowid id, rank, snippet({indice}, -1, char(2), char(3), '…', 12) trecho "
+                     f"FROM {indice} WHERE {indice} MATCH ? "
+                     f"ORDER BY {'rank' if ordem == 'relevancia' else 'rowid DESC'} LIMIT ?",
+                     (expressao, inicio + limite + 1))
+        if not rows:
+            continue
+        titulos = {r['id']: r for r in query(sql_titulo.format(','.join('?' * len(rows))),
+                                             [r['id'] for r in rows])}
+        achados += [{'tipo': nome, 'id': r['id'], 'titulo': titulos[r['id']]['titulo'],
+                     'data': titulos[r['id']]['data'], 'trecho': _trecho(r['trecho']),
+                     'separador': separador, 'rank': round(r['rank'], 3)}
+                    for r in rows if r['id'] in titulos]
+    if ordem == 'relevancia':
+        achados.sort(key=lambda a: a['rank'])
+    else:
+        achados.sort(key=lambda a: (a['data'] or '', a['id']), reverse=True)
+    return {'itens': achados[inicio:inicio + limite], 'tem_mais': len(achados) > inicio + limite,
+            'total': sum(totais.values()), 'total_exacto': ordem == 'relevancia', 'ordem': ordem}
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    texto = request.args.get('q', '').strip()
+    fontes = [f for f in request.args.get('tipo', '').split(',') if f in FONTES_BUSCA] or list(FONTES_BUSCA)
+    limite = max(1, min(request.args.get('limite', 20, type=int), BUSCA_MAX))
+    pagina_n = max(1, min(request.args.get('pagina', 1, type=int), BUSCA_PAGINAS))
+    t = time.perf_counter()
+    try:
+        res = buscar(texto, fontes, limite, (pagina_n - 1) * limite)
+    except sqlite3.OperationalError:
+        return jsonify({'ok': False, 'msg': 'Pesquisa inválida'}), 400
+    return jsonify(dict(res, q=texto, pagina=pagina_n, ms=round((time.perf_counter() - t) * 1000, 1)))
+
+
+# ═══════════════════════════════════════════════════════════════
+#  RECURSOS ESTÁTICOS — CSS e JS das páginas, fora dos templates
+#  A fonte está em assets/. `flask --app app assets` (ou o primeiro render,
+#  se a fonte mudou) grava em static/dist/ versões minificadas com o hash
+#  do conteúdo no nome e já comprimidas (.gz, e .br se houver brotli).
+#  Como o nome muda com o conteúdo, o browser guarda-as para sempre.
+# ═══════════════════════════════════════════════════════════════
+
+ASSETS_FONTE = os.path.join(app.root_path, 'assets')
+ASSETS_DIST = os.path.join(app.root_path, 'static', 'dist')
+ASSETS_MANIFESTO = os.path.join(ASSETS_DIST, 'manifest.json')
+ASSETS_VERSAO = 1             # mudar quando os minificadores mudarem
+ASSETS_CACHE = 'public, max-age=31536000, immutable'
+TIPOS_ASSET = {'css': 'text/css', 'js': 'text/javascript'}
+_RE_ASSET = re.compile(r'^[\w-]+\.[0-9a-f]{10}\.(css|js)$')
+
+# ── Minificação ───────────────────────────────────────────────
+# Conservadora: tira comentários e espaços sem nunca mexer em strings,
+# template literals ou expressões regulares. No JS as mudanças de linha só
+# saem onde não podem servir de ';' (inserção automática).
+_RE_CSS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*.*?\*/)|(\s+)|([^"\'/\s]+|/)', re.S)
+_JS_SEM_ESPACO = set('{}()[];,:=?&|')
+_JS_NL_DEPOIS = set('{([;,:=?&|')
+_JS_NL_ANTES = set('})];,:=?&|.')
+_RE_JS_ANTES_REGEX = re.compile(r'(?:^|[(,=:\[!&|?{};+\-*%<>~^]|\b(?:return|typeof|case|do|else|in|of|new|delete|void|throw|yield|await))\s*$')
+
+def _minificar_css(texto):
+    saida, espaco = [], False
+    for m in _RE_CSS.finditer(texto):
+        string, comentario, branco, resto = m.groups()
+        if comentario or branco:
+            espaco = espaco or bool(branco)
+            continue
+        tok = string or resto
+        anterior = saida[-1][-1] if saida else ''
+        if tok == '}' and anterior == ';':
+            saida[-1] = saida[-1][:-1]
+        elif espaco and anterior and anterior not in '{};,>:' and tok[0] not in '{};,>)':
+            saida.append(' ')
+        espaco = False
+        saida.append(tok)
+    return ''.join(saida)
+
+def _fim_string(t, i):
+    q, i = t[i], i + 1
+    while t[i] != q:
+        i += 2 if t[i] == '\\' else 1
+    return i + 1
+
+def _fim_regex(t, i):
+    i, classe = i + 1, False
+    while classe or t[i] != '/':
+        if t[i] == '\\':
+            i += 1
+        elif t[i] in '[]':
+            classe = t[i] == '['
+        i += 1
+    i += 1
+    while i < len(t) and t[i].isalpha():
+        i += 1
+    return i
+
+def _js(t, i, saida, em_expr=False):
+    # Copia código a partir de i; dentro de ${...} (em_expr) pára no } que fecha
+    n, prof = len(t), 0
+    while i < n:
+        c = t[i]
+        if c in '"\'':
+            j = _fim_string(t, i)
+            saida.append(t[i:j])
+        elif c == '`':
+            j = i + 1
+            saida.append('`')
+            while t[j] != '`':
+                if t[j] == '\\':
+                    saida.append(t[j:j + 2]); j += 2
+                elif t.startswith('${', j):
+                    saida.append('${')
+                    j = _js(t, j + 2, saida, True)
+                    saida.append('}'); j += 1
+                else:
+                    saida.append(t[j]); j += 1
+            saida.append('`'); j += 1
+        elif t.startswith('//', i) or t.startswith('/*', i) or c.isspace():
+            # Comentários e espaços juntam-se num só separador
+            j, nl = i, False
+            while j < n:
+                if t.startswith('//', j):
+                    fim = t.find('\n', j)
+                    j = n if fim < 0 else fim
+                elif t.startswith('/*', j):
+                    fim = t.index('*/', j) + 2
+                    nl = nl or '\n' in t[j:fim]
+                    j = fim
+                elif t[j].isspace():
+                    nl = nl or t[j] == '\n'
+                    j += 1
+                else:
+                    break
+            anterior = saida[-1][-1] if saida else ''
+            seguinte = t[j] if j < n else ''
+            if anterior and seguinte:
+                if nl and anterior not in _JS_NL_DEPOIS and seguinte not in _JS_NL_ANTES:
+                    saida.append('\n')
+                elif not nl and anterior not in _JS_SEM_ESPACO and seguinte not in _JS_SEM_ESPACO:
+                    saida.append(' ')
+        elif c == '/' and _RE_JS_ANTES_REGEX.search(''.join(saida[-12:])[-12:]):
+            j = _fim_regex(t, i)
+            saida.append(t[i:j])
+        else:
+            if em_expr and c == '}':
+                if prof == 0:
+                    return i
+                prof -= 1
+            elif em_expr and c == '{':
+                prof += 1
+            j = i + 1
+            saida.append(c)
+        i = j
+    return i
+
+def _minificar_js(texto):
+    saida = []
+    _js(texto, 0, saida)
+    return ''.join(saida).strip() + '\n'
+
+MINIFICADORES = {'css': _minificar_css, 'js': _minificar_js}
+
+# ── Construção e manifesto ────────────────────────────────────
+def _fontes_assets():
+    return sorted(f for f in os.listdir(ASSETS_FONTE) if f.rsplit('.', 1)[-1] in MINIFICADORES)
+
+def _hash_fonte():
+    h = hashlib.sha256(str(ASSETS_VERSAO).encode())
+    for nome in _fontes_assets():
+        with open(os.path.join(ASSETS_FONTE, nome), 'rb') as f:
+            h.update(nome.encode() + b'\0' + f.read())
+    return h.hexdigest()[:16]
+
+def _gravar_ficheiro(caminho, dados):
+    # Os workers podem construir ao mesmo tempo: cada um no seu .tmp
+    tmp = f'{caminho}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(dados)
+    os.replace(tmp, caminho)
+
+def construir_assets():
+    """Minifica assets/, grava em static/dist/ as versões com hash e o manifesto."""
+    os.makedirs(ASSETS_DIST, exist_ok=True)
+    manifesto = {'fonte': _hash_fonte(), 'ficheiros': {}, 'tamanhos': {}}
+    for nome in _fontes_assets():
+        base, ext = nome.rsplit('.', 1)
+        with open(os.path.join(ASSETS_FONTE, nome), encoding='utf-8') as f:
+            fonte = f.read().replace('\r\n', '\n')
+        dados = MINIFICADORES[ext](fonte).encode()
+        final = f'{base}.{hashlib.sha256(dados).hexdigest()[:10]}.{ext}'
+        variantes = {'': dados, '.gz': gzip.compress(dados, 9, mtime=0)}
+        if brotli:
+            variantes['.br'] = brotli.compress(dados, quality=11)
+        # Versões antigas ficam: páginas já em cache ainda as pedem
+        for sufixo, conteudo in variantes.items():
+            _gravar_ficheiro(os.path.join(ASSETS_DIST, final + sufixo), conteudo)
+        manifesto['ficheiros'][nome] = final
+        manifesto['tamanhos'][nome] = {'fonte': len(fonte.encode()),
+                                       **{s.lstrip('.') or 'min': len(v) for s, v in variantes.items()}}
+    _gravar_ficheiro(ASSETS_MANIFESTO, json.dumps(manifesto, indent=1).encode())
+    return manifesto
+
+_assets = None
+
+def manifesto_assets():
+    # Lido uma vez por worker (em debug a fonte é verificada a cada página)
+    global _assets
+    if _assets is None or app.debug:
+        try:
+            with open(ASSETS_MANIFESTO, encoding='utf-8') as f:
+                m = json.load(f)
+        except (OSError, ValueError):
+            m = {}
+        if m.get('fonte') != _hash_fonte() or not all(
+                os.path.exists(os.path.join(ASSETS_DIST, v)) for v in m['ficheiros'].values()):
+            m = construir_assets()
+        _assets = m
+    return _assets
+
+@app.template_global('asset')
+def url_asset(nome):
+    return url_for('asset', nome=manifesto_assets()['ficheiros'][nome])
+
+@app.route('/assets/<nome>')
+def asset(nome):
+    m = _RE_ASSET.match(nome)
+    caminho = os.path.join(ASSETS_DIST, nome)
+    if not m or not os.path.exists(caminho):
+        return 'Não encontrado', 404
+    aceita = request.headers.get('Accept-Encoding', '')
+    codificacao = next((c for c, sufixo in (('br', '.br'), ('gzip', '.gz'))
+                        if c in aceita and os.path.exists(caminho + sufixo)), None)
+    if codificacao:
+        caminho += '.br' if codificacao == 'br' else '.gz'
+    resp = send_file(caminho, mimetype=TIPOS_ASSET[m.group(1)], conditional=True)
+    if codificacao:
+        resp.headers['Content-Encoding'] = codificacao
+    resp.headers['Cache-Control'] = ASSETS_CACHE
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+@app.cli.command('assets')
+@click.option('--medir', is_flag=True, help='Medir o peso das páginas (primeira visita e seguintes).')
+def comando_assets(medir):
+    """Constrói os CSS/JS minificados e comprimidos de static/dist/."""
+    m = construir_assets()
+    for nome, final in m['ficheiros'].items():
+        t = m['tamanhos'][nome]
+        click.echo(f"{final}: fonte {t['fonte']} B, min {t['min']} B, gz {t['gz']} B"
+                   + (f", br {t['br']} B" if 'br' in t else ''))
+    if not medir:
+        return
+    # Peso por página: HTML + CSS (bloqueiam o primeiro render) + JS. Tempo
+    # estimado = 2 idas e voltas (HTML, depois CSS) + bytes / débito.
+    redes = {'2G': (40_000, 0.8), '3G': (400_000, 0.3)}   # bit/s, RTT em s
+    c = app.test_client()
+    with app.app_context():
+        admin_id = query("SELECT MIN(id) i FROM admin", one=True)['i']
+    with c.session_transaction() as s:
+        s['admin_id'], s['admin_nivel'], s['admin_nome'] = admin_id, 'master', 'medição'
+    for url, pagina in (('/', 'index'), ('/admin', 'admin')):
+        html = c.get(url).data
+        html_gz = len(gzip.compress(html, 6))
+        css, js = m['tamanhos'][f'{pagina}.css'], m['tamanhos'][f'{pagina}.js']
+        primeira = html_gz + css['gz'] + js['gz']
+        click.echo(f"{url}: HTML {len(html)} B ({html_gz} B gz); 1.ª visita {primeira} B gz, "
+                   f"seguintes {html_gz} B gz (CSS/JS em cache)")
+        for rede, (debito, rtt) in redes.items():
+            render = 2 * rtt + (html_gz + css['gz']) * 8 / debito
+            click.echo(f"    {rede}: primeiro render ≈ {render:.2f}s (1.ª visita), "
+                       f"{rtt + html_gz * 8 / debito:.2f}s (seguintes)")
+
+
+# ═══════════════════════════════════════════════════════════════
+#  COMPRESSÃO — gzip/brotli negociados das respostas de texto
+#  HTML e JSON acima de COMPRESSAO_MIN bytes. Respostas em stream (SSE,
+#  exportações, backups) e as que já vêm codificadas (assets, snapshot de
+#  /api/dados_publicos) passam como estão; o /ussd também, porque o gateway
+#  quer texto simples.
+# ═══════════════════════════════════════════════════════════════
+
+COMPRESSAO_MIN = 1024
+COMPRESSAO_TIPOS = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+COMPRESSAO_EXCLUIDAS = ('/ussd',)
+COMPRESSAO_CACHE_BYTES = 8 << 20
+
+def comprimir(dados, codificacao):
+    if codificacao == 'br':
+        return brotli.compress(dados, quality=5)
+    return gzip.compress(dados, 6, mtime=0)
+
+class CacheCompressao:
+    # Corpos já comprimidos por (hash do conteúdo, codificação): a mesma
+    # página ou o mesmo JSON não é recomprimido a cada pedido. LRU em bytes.
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self.total = 0
+        self.itens = OrderedDict()
+        self.lock = threading.Lock()
+        self.metricas = {'hits': 0, 'misses': 0, 'bytes_entrada': 0, 'bytes_saida': 0}
+
+    def obter(self, dados, codificacao):
+        chave = (hashlib.blake2b(dados, digest_size=16).digest(), codificacao)
+        with self.lock:
+            corpo = self.itens.get(chave)
+            if corpo is not None:
+                self.itens.move_to_end(chave)
+                self.metricas['hits'] += 1
+                return corpo
+        corpo = comprimir(dados, codificacao)
+        with self.lock:
+            self.metricas['misses'] += 1
+            if chave not in self.itens:
+                self.itens[chave] = corpo
+                self.total += len(corpo)
+            while self.total > self.maximo:
+                self.total -= len(self.itens.popitem(last=False)[1])
+        return corpo
+
+    def estado(self):
+        return dict(self.metricas, entradas=len(self.itens), bytes=self.total)
+
+cache_compressao = CacheCompressao(COMPRESSAO_CACHE_BYTES)
+
+@app.after_request
+def comprimir_resposta(resp):
+    if (request.method == 'HEAD' or request.path in COMPRESSAO_EXCLUIDAS or resp.status_code != 200
+            or resp.is_streamed or resp.direct_passthrough or 'Content-Encoding' in resp.headers
+            or not (resp.mimetype or '').startswith(COMPRESSAO_TIPOS)):
+        return resp
+    resp.vary.add('Accept-Encoding')
+    codificacao = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    dados = resp.get_data()
+    if not codificacao or len(dados) < COMPRESSAO_MIN:
+        return resp
+    # Guarda-se o comprimido só do que se pode repetir (tem ETag ou é público)
+    if 'ETag' in resp.headers or 'public' in resp.headers.get('Cache-Control', ''):
+        corpo = cache_compressao.obter(dados, codificacao)
+    else:
+        corpo = comprimir(dados, codificacao)
+    cache_compressao.metricas['bytes_entrada'] += len(dados)
+    cache_compressao.metricas['bytes_saida'] += len(corpo)
+    resp.set_data(corpo)
+    resp.headers['Content-Encoding'] = codificacao
+    # Outra codificação, outros bytes: o ETag passa a fraco (W/ continua a
+    # conter o valor original, que é o que as rotas comparam no If-None-Match)
+    etag = resp.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        resp.headers['ETag'] = 'W/' + etag
+    return resp
+
 
 # ═══════════════════════════════════════════════════════════════
 #  ROTAS PÚBLICAS
 # ═══════════════════════════════════════════════════════════════
 
+# ── Cache da página inicial ───────────────────────────────────
+# A página só muda quando um admin grava. Guarda-se o HTML completo da versão
+# actual dos dados e, à parte, cada fragmento (alertas, famílias, zonas,
+# estatísticas, configuração). Quando a versão muda, o registo `alteracao`
+# diz que tabelas mudaram e só os fragmentos que delas dependem são refeitos.
+class CachePagina:
+    def __init__(self, fragmentos):
+        self.fragmentos = fragmentos      # nome -> (tabelas, gerar)
+        self.lock = threading.Lock()
+        self.versao = None
+        self.pagina = None
+        self.valores = {}
+        self.metricas = {nome: {'hits': 0, 'misses': 0} for nome in ['pagina', *fragmentos]}
+
+    def _invalidar(self, versao):
+        tabelas = None    # None: refaz tudo (arranque, registo já podado, BD reposta)
+        if self.versao is not None and versao > self.versao:
+            primeiro = query("SELECT MIN(seq) s FROM alteracao", one=True)['s']
+            if primeiro is not None and primeiro <= self.versao + 1:
+                tabelas = {r['tabela'] for r in query(
+                    "SELECT DISTINCT tabela FROM alteracao WHERE seq > ? AND seq <= ?",
+                    (self.versao, versao))}
+        for nome, (deps, _) in self.fragmentos.items():
+            if tabelas is None or tabelas & set(deps):
+                self.valores.pop(nome, None)
+        self.versao = versao
+        self.pagina = None
+
+    def _fragmento(self, nome):
+        if nome in self.valores:
+            self.metricas[nome]['hits'] += 1
+        else:
+            self.metricas[nome]['misses'] += 1
+            self.valores[nome] = self.fragmentos[nome][1]()
+        return self.valores[nome]
+
+    def obter(self, render):
+        # A versão é lida antes dos dados: no pior caso guarda-se conteúdo mais
+        # novo com a versão anterior, e o pedido seguinte refaz esses fragmentos
+        v = versao_dados()
+        with self.lock:
+            if v != self.versao:
+                self._invalidar(v)
+            if self.pagina is not None:
+                self.metricas['pagina']['hits'] += 1
+                return self.pagina
+            self.metricas['pagina']['misses'] += 1
+            html = render({nome: self._fragmento(nome) for nome in self.fragmentos})
+            self.pagina = (html, '"p%d-%s"' % (v, hashlib.md5(html.encode()).hexdigest()[:12]))
+            return self.pagina
+
+    def estado(self):
+        res = {'versao': self.versao}
+        for nome, m in self.metricas.items():
+            total = m['hits'] + m['misses']
+            res[nome] = dict(m, taxa=round(m['hits'] / total, 3) if total else None)
+        return res
+
+def _frag_alertas():
+    alertas = query("SELECT * FROM alerta WHERE ativo=1 ORDER BY data DESC")
+    return {'ticker': Markup(render_template('_ticker_alertas.html', alertas=alertas)),
+            'lista':  Markup(render_template('_lista_alertas.html', alertas=alertas,
+                                             fmt_datetime=fmt_datetime))}
+
+def _frag_familias():
+    familias = query("SELECT * FROM familia ORDER BY data DESC")
+    return {'n': len(familias),
+            'lista': Markup(render_template('_lista_familias.html', familias=familias))}
+
+def _frag_zonas():
+    zonas = query("SELECT * FROM zona WHERE ativa=1")
+    return {'n': len(zonas),
+            'lista': Markup(render_template('_lista_zonas.html', zonas=zonas))}
+
+cache_pagina = CachePagina({
+    'alertas':  (('alerta',),  _frag_alertas),
+    'familias': (('familia',), _frag_familias),
+    'zonas':    (('zona',),    _frag_zonas),
+    'stats':    (('alerta', 'familia', 'zona', 'subscricao'), lambda: _stats_publicos()),
+    'cfg':      (('configuracao',), lambda: get_site_config()),
+})
+
 @app.route('/')
 def index():
+    html, etag = cache_pagina.obter(lambda f: render_template(
+        'index.html', frag=f, stats=f['stats'], cfg=f['cfg'],
+        fmt_date=fmt_date, fmt_datetime=fmt_datetime))
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers={'ETag': etag})
+    return Response(html, mimetype='text/html', headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+def row_to_dict(row):
+    return {key: row[key] for key in row.keys()}
+
+def _stats_publicos():
+    rows = query("SELECT chave, valor FROM contador WHERE chave IN "
+                 "('alertas_ativos','familias_total','zonas','subscricoes')")
+    c = {r['chave']: r['valor'] for r in rows}
+    return {
+        'alertas':     c.get('alertas_ativos', 0),
+        'familias':    c.get('familias_total', 0),
+        'zonas':       c.get('zonas', 0),
+        'subscricoes': c.get('subscricoes', 0)
+    }
+
+def _dados_publicos_dict(versao):
     alertas  = query("SELECT * FROM alerta WHERE ativo=1 ORDER BY data DESC")
     familias = query("SELECT * FROM familia ORDER BY data DESC")
     zonas    = query("SELECT * FROM zona WHERE ativa=1")
-    total    = query("SELECT SUM(numero) s FROM familia", one=True)['s'] or 0
-    stats    = {'alertas': len(alertas), 'familias': total, 'zonas': len(zonas),
-                'subscricoes': query("SELECT COUNT(*) c FROM subscricao", one=True)['c']}
-    cfg = get_site_config()
-    return render_template('index.html', alertas=alertas, familias=familias,
-                           zonas=zonas, stats=stats, cfg=cfg,
-                           fmt_date=fmt_date, fmt_datetime=fmt_datetime)
+    stats    = _stats_publicos()
+    return {
+        'versao':   versao,
+        'alertas':  [row_to_dict(a) for a in alertas],
+        'familias': [row_to_dict(f) for f in familias],
+        'zonas':    [row_to_dict(z) for z in zonas],
+        'stats':    stats
+    }
+
+# Snapshot já serializado (e comprimido) de /api/dados_publicos, por worker.
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+def snapshot_publico():
+    global _snapshot
+    v = versao_dados()
+    snap = _snapshot
+    if snap and snap['versao'] == v:
+        return snap
+    with _snapshot_lock:
+        snap = _snapshot
+        if snap and snap['versao'] == v:
+            return snap
+        corpo = json.dumps(_dados_publicos_dict(v), ensure_ascii=False,
+                           separators=(',', ':')).encode('utf-8')
+        etag = hashlib.sha1(corpo).hexdigest()[:20]
+        snap = {
+            'versao': v,
+            'corpo':  corpo,
+            'gzip':   gzip.compress(corpo, 6, mtime=0),
+            'etag':   f'"{etag}"',
+            'etag_gz': f'"{etag}-gz"',
+        }
+        _snapshot = snap
+        return snap
+
+# Linhas visíveis no site para cada tabela do registo de alterações
+_FILTRO_PUBLICO = {
+    'alertas':  ('alerta',  "SELECT * FROM alerta WHERE ativo=1 AND id IN ({})"),
+    'familias': ('familia', "SELECT * FROM familia WHERE id IN ({})"),
+    'zonas':    ('zona',    "SELECT * FROM zona WHERE ativa=1 AND id IN ({})"),
+}
+DELTA_MAX_LINHAS = 1000
+
+def delta_desde(desde):
+    """Alterações desde a versão `desde`, ou None se for preciso enviar tudo."""
+    # Versão à frente da nossa (BD reposta de um backup): o cliente tem de
+    # deitar fora o que tem
+    if desde > versao_dados():
+        return None
+    primeiro = query("SELECT MIN(seq) s FROM alteracao", one=True)['s']
+    if primeiro is None or desde < primeiro - 1:
+        return None
+    mudancas = query("SELECT seq, tabela, registo_id, op FROM alteracao WHERE seq > ? "
+                     "ORDER BY seq LIMIT ?", (desde, DELTA_MAX_LINHAS + 1))
+    if len(mudancas) > DELTA_MAX_LINHAS or any(m['op'] == 'reload' for m in mudancas):
+        return None
+    delta = {'versao': max([desde] + [m['seq'] for m in mudancas])}
+    for chave, (tabela, sql) in _FILTRO_PUBLICO.items():
+        ids = {m['registo_id'] for m in mudancas if m['tabela'] == tabela}
+        if not ids:
+            continue
+        linhas = query(sql.format(','.join('?' * len(ids))), tuple(ids))
+        visiveis = {r['id'] for r in linhas}
+        delta[chave] = {'upsert': [row_to_dict(r) for r in linhas],
+                        'remove': sorted(ids - visiveis)}
+    if mudancas:
+        delta['stats'] = _stats_publicos()
+    return delta
 
 @app.route('/api/dados_publicos')
 def dados_publicos():
-    alertas  = query("SELECT * FROM alerta WHERE ativo=1 ORDER BY data DESC")
-    familias = query("SELECT * FROM familia ORDER BY data DESC")
-    zonas    = query("SELECT * FROM zona WHERE ativa=1")
-    total    = query("SELECT SUM(numero) s FROM familia", one=True)['s'] or 0
-    stats    = {
-        'alertas':     len(alertas),
-        'familias':    total,
-        'zonas':       len(zonas),
-        'subscricoes': query("SELECT COUNT(*) c FROM subscricao", one=True)['c']
+    desde = request.args.get('since', type=int)
+    if desde is not None:
+        if desde == versao_dados():
+            return jsonify({'versao': desde})
+        delta = delta_desde(desde)
+        if delta is not None:
+            return jsonify(delta)
+    snap = snapshot_publico()
+    usa_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    etag = snap['etag_gz'] if usa_gzip else snap['etag']
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding',
+        'X-Dados-Versao': str(snap['versao']),
     }
+    pedidos = request.headers.get('If-None-Match', '')
+    if pedidos and (pedidos.strip() == '*' or
+                    any(e.strip() in (snap['etag'], snap['etag_gz'])
+                        for e in pedidos.split(','))):
+        return '', 304, headers
+    headers['Content-Type'] = 'application/json'
+    if usa_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return snap['gzip'], 200, headers
+    return snap['corpo'], 200, headers
 
-    def row_to_dict(row):
-        return {key: row[key] for key in row.keys()}
+# ═══════════════════════════════════════════════════════════════
+#  TEMPO REAL — /api/stream (Server-Sent Events)
+#  Um único difusor por worker observa a versão dos dados e envia
+#  apenas as diferenças (delta_desde) a todos os clientes ligados.
+# ═══════════════════════════════════════════════════════════════
 
-    return jsonify({
-        'alertas':  [row_to_dict(a) for a in alertas],
-        'familias': [row_to_dict(f) for f in familias],
-        'zonas':    [row_to_dict(z) for z in zonas],
-        'stats':    stats
+def evento_sse(tipo, dados, versao=None):
+    if isinstance(dados, bytes):
+        dados = dados.decode('utf-8')
+    elif not isinstance(dados, str):
+        dados = json.dumps(dados, ensure_ascii=False, separators=(',', ':'))
+    linhas = [f'event: {tipo}']
+    if versao is not None:
+        linhas.append(f'id: {versao}')
+    linhas.append(f'data: {dados}')
+    return '\n'.join(linhas) + '\n\n'
+
+class Difusor:
+    FILA_MAX = 64
+    INTERVALO = 1.0   # segundos entre verificações da versão (outros workers)
+    # Cada cliente prende uma thread do worker enquanto está ligado; acima
+    # disto recebe 503 e a página passa a polling (gunicorn.conf.py ajusta)
+    CLIENTES_MAX = int(os.environ.get('SSE_MAX', 32))
+
+    def __init__(self):
+        self.clientes = set()
+        self.lock     = threading.Lock()
+        self.acordar  = threading.Event()
+        self.versao   = None
+        self.thread   = None
+
+    def inscrever(self):
+        # None = worker cheio
+        q = queue.Queue(maxsize=self.FILA_MAX)
+        with self.lock:
+            if len(self.clientes) >= self.CLIENTES_MAX:
+                return None
+            self.clientes.add(q)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._ciclo, name='difusor-sse', daemon=True)
+                self.thread.start()
+        return q
+
+    def semear(self, snap):
+        # Primeiro snapshot servido passa a ser a base das diferenças
+        with self.lock:
+            if self.versao is None:
+                self.versao = snap['versao']
+
+    def cancelar(self, q):
+        with self.lock:
+            self.clientes.discard(q)
+
+    def publicar(self, evento):
+        # evento None = pedir a cada cliente um snapshot completo
+        with self.lock:
+            clientes = list(self.clientes)
+        for q in clientes:
+            try:
+                q.put_nowait(evento)
+            except queue.Full:
+                # Cliente lento: descarta o atraso e obriga a um snapshot completo
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait(None)
+
+    def _ciclo(self):
+        while True:
+            self.acordar.wait(self.INTERVALO)
+            self.acordar.clear()
+            if self.versao is None:
+                continue
+            try:
+                v = versao_dados()
+                if v == self.versao:
+                    continue
+                if not self.clientes:
+                    self.versao = v
+                    continue
+                with app.app_context():
+                    delta = delta_desde(self.versao)
+                if delta is None:
+                    # Registo já podado ou demasiadas alterações: snapshot para todos
+                    self.publicar(None)
+                    self.versao = v
+                else:
+                    if len(delta) > 1:
+                        self.publicar(evento_sse('delta', delta, delta['versao']))
+                    self.versao = delta['versao']
+            except Exception as e:
+                app.logger.warning('difusor SSE: %s', e)
+
+difusor = Difusor()
+
+@app.route('/api/stream')
+def stream():
+    q = difusor.inscrever()
+    if q is None:
+        return jsonify({'ok': False, 'msg': 'Demasiados clientes em tempo real'}), 503, {'Retry-After': '30'}
+    snap = snapshot_publico()
+    difusor.semear(snap)
+
+    def gerar(snap):
+        try:
+            yield 'retry: 5000\n\n'
+            yield evento_sse('snapshot', snap['corpo'], snap['versao'])
+            while True:
+                try:
+                    ev = q.get(timeout=15)
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                if ev is None:
+                    with app.app_context():
+                        snap = snapshot_publico()
+                    yield evento_sse('snapshot', snap['corpo'], snap['versao'])
+                else:
+                    yield ev
+        finally:
+            difusor.cancelar(q)
+
+    return Response(gerar(snap), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
     })
 
 @app.route('/apoio', methods=['POST'])
@@ -565,11 +2833,16 @@ def subscricao():
             if existente:
                 return jsonify({'ok': False, 'msg': 'Este email já está registado.'})
 
-        query("INSERT INTO subscricao(nome,telefone,email,metodos,tipo_alertas,data) VALUES(?,?,?,?,?,?)",
-              (request.form.get('nome',''), telefone, email,
-               ', '.join(request.form.getlist('notificacoes[]')),
-               ', '.join(request.form.getlist('tipo_alertas[]')),
-               now_cat()), commit=True)
+        def gravar(db):
+            sid = db.execute(
+                "INSERT INTO subscricao(nome,telefone,email,metodos,tipo_alertas,data) VALUES(?,?,?,?,?,?)",
+                (request.form.get('nome',''), telefone, email,
+                 ', '.join(request.form.getlist('notificacoes[]')),
+                 ', '.join(request.form.getlist('tipo_alertas[]')),
+                 now_cat())).lastrowid
+            indexar_subscricao(db, sid)
+            return marcar_alteracao(db, 'subscricao', [sid])
+        publicar_versao(pool.transacao(gravar))
         return jsonify({'ok': True, 'msg': 'Subscrição activada com sucesso!'})
     except Exception as e:
         return jsonify({'ok': False, 'msg': str(e)})
@@ -609,47 +2882,45 @@ def logout():
 @login_required
 def admin_dashboard():
     cfg         = get_site_config()
-    familias    = query("SELECT * FROM familia ORDER BY data DESC")
-    alertas     = query("SELECT * FROM alerta ORDER BY data DESC")
-    zonas       = query("SELECT * FROM zona ORDER BY id DESC")
-    apoios      = query("SELECT * FROM apoio ORDER BY data DESC")
-    subscricoes = query("SELECT * FROM subscricao ORDER BY data DESC")
+    # As tabelas completas são carregadas por separador via /api/admin/<nome>;
+    # aqui só o que aparece no dashboard e nas notificações.
+    familias    = query("SELECT * FROM familia ORDER BY data DESC, id DESC LIMIT 4")
+    alertas     = query("SELECT * FROM alerta ORDER BY data DESC, id DESC LIMIT 5")
+    apoios      = query("SELECT * FROM apoio ORDER BY data DESC, id DESC LIMIT 4")
+    apoios_pend = query("SELECT * FROM apoio WHERE status='pendente' OR status IS NULL "
+                        "ORDER BY data DESC, id DESC LIMIT 10")
     admins      = query("SELECT * FROM admin ORDER BY nivel DESC, nome ASC") if session.get('admin_nivel') == 'master' else []
 
-    # Pedidos e voluntários do USSD
-    ussd_pedidos    = query("SELECT * FROM ussd_pedido ORDER BY data DESC LIMIT 50")
-    ussd_voluntarios = query("SELECT * FROM ussd_voluntario ORDER BY data DESC")
-
-    total       = query("SELECT SUM(numero) s FROM familia", one=True)['s'] or 0
-    cap_total   = query("SELECT SUM(capacidade) s FROM zona WHERE ativa=1", one=True)['s'] or 0
-    pendentes   = query("SELECT COUNT(*) c FROM apoio WHERE status='pendente' OR status IS NULL", one=True)['c']
-    ussd_pend   = query("SELECT COUNT(*) c FROM ussd_pedido WHERE status='pendente'", one=True)['c']
+    # Pedidos USSD pendentes (notificações)
+    ussd_pendentes = query("SELECT * FROM ussd_pedido WHERE status='pendente' "
+                           "ORDER BY data DESC, id DESC LIMIT 10")
 
+    c = ler_contadores()
     stats = {
-        'alertas':              query("SELECT COUNT(*) c FROM alerta", one=True)['c'],
-        'alertas_ativos':       query("SELECT COUNT(*) c FROM alerta WHERE ativo=1", one=True)['c'],
-        'alertas_urgentes':     query("SELECT COUNT(*) c FROM alerta WHERE tipo='urgente' AND ativo=1", one=True)['c'],
-        'familias_registadas':  len(familias),
-        'familias_total':       total,
-        'zonas':                query("SELECT COUNT(*) c FROM zona WHERE ativa=1", one=True)['c'],
-        'cap_total':            cap_total,
-        'apoios':               query("SELECT COUNT(*) c FROM apoio", one=True)['c'],
-        'apoios_semana':        query("SELECT COUNT(*) c FROM apoio WHERE data >= datetime('now','-7 days')", one=True)['c'],
-        'apoios_pendentes':     pendentes,
-        'subscricoes':          query("SELECT COUNT(*) c FROM subscricao", one=True)['c'],
-        'subs_mes':             query("SELECT COUNT(*) c FROM subscricao WHERE data >= datetime('now','-30 days')", one=True)['c'],
-        'admins':               query("SELECT COUNT(*) c FROM admin", one=True)['c'],
-        'ussd_pedidos_total':   query("SELECT COUNT(*) c FROM ussd_pedido", one=True)['c'],
-        'ussd_pedidos_pend':    ussd_pend,
-        'ussd_voluntarios':     query("SELECT COUNT(*) c FROM ussd_voluntario", one=True)['c'],
+        'alertas':              c['alertas'],
+        'alertas_ativos':       c['alertas_ativos'],
+        'alertas_urgentes':     c['alertas_urgentes'],
+        'familias_registadas':  c['familias'],
+        'familias_total':       c['familias_total'],
+        'zonas':                c['zonas'],
+        'cap_total':            c['cap_total'],
+        'ocupacao_total':       c['ocupacao_total'],
+        'zonas_lotadas':        c['zonas_lotadas'],
+        'apoios':               c['apoios'],
+        'apoios_semana':        c['apoios_semana'],
+        'apoios_pendentes':     c['apoios_pendentes'],
+        'subscricoes':          c['subscricoes'],
+        'subs_mes':             c['subs_mes'],
+        'admins':               c['admins'],
+        'ussd_pedidos_total':   c['ussd_pedidos'],
+        'ussd_pedidos_pend':    c['ussd_pedidos_pend'],
+        'ussd_voluntarios':     c['ussd_voluntarios'],
     }
 
     active_tab = request.args.get('tab', 'dashboard')
-    return render_template('admin.html', cfg=cfg, stats=stats, alertas=alertas,
-                           familias=familias, zonas=zonas, apoios=apoios,
-                           subscricoes=subscricoes, admins=admins,
-                           ussd_pedidos=ussd_pedidos,
-                           ussd_voluntarios=ussd_voluntarios,
+    return render_template('admin.html', cfg=cfg, stats=stats, alertas=alertas, categorias=CATEGORIAS_ALERTA,
+                           familias=familias, apoios=apoios, apoios_pend=apoios_pend,
+                           admins=admins, ussd_pendentes=ussd_pendentes,
                            fmt_date=fmt_date, fmt_datetime=fmt_datetime,
                            active_tab=active_tab)
 
@@ -661,8 +2932,11 @@ def admin_dashboard():
 @app.route('/admin/alerta/add', methods=['POST'])
 @login_required
 def add_alerta():
-    query("INSERT INTO alerta(titulo,tipo,conteudo,data) VALUES(?,?,?,?)",
-          (request.form['titulo'], request.form['tipo'], request.form['conteudo'], now_cat()), commit=True)
+    rid = escrever_alteracao("INSERT INTO alerta(titulo,tipo,conteudo,categoria,data) VALUES(?,?,?,?,?)",
+                             (request.form['titulo'], request.form['tipo'], request.form['conteudo'],
+                              _categoria_form(), now_cat()),
+                             'alerta')
+    despachante.novo_alerta(rid)
     flash('Alerta publicado! Já está visível no site e no USSD.', 'success')
     return redirect(url_for('admin_dashboard', tab='tab-alertas'))
 
@@ -674,23 +2948,25 @@ def editar_alerta(id):
         flash('Alerta não encontrado.', 'error')
         return redirect(url_for('admin_dashboard', tab='tab-alertas'))
     if request.method == 'POST':
-        query("UPDATE alerta SET titulo=?, tipo=?, conteudo=?, data=?, ativo=1 WHERE id=?",
-              (request.form['titulo'], request.form['tipo'], request.form['conteudo'], now_cat(), id), commit=True)
+        escrever_alteracao("UPDATE alerta SET titulo=?, tipo=?, conteudo=?, categoria=?, data=?, ativo=1 WHERE id=?",
+                           (request.form['titulo'], request.form['tipo'], request.form['conteudo'],
+                            _categoria_form(), now_cat(), id),
+                           'alerta', id)
         flash('Alerta actualizado — visível no site e USSD.', 'success')
         return redirect(url_for('admin_dashboard', tab='tab-alertas'))
     cfg = get_site_config()
-    return render_template('editar_alerta.html', alerta=alerta, cfg=cfg)
+    return render_template('editar_alerta.html', alerta=alerta, cfg=cfg, categorias=CATEGORIAS_ALERTA)
 
 @app.route('/admin/alerta/toggle/<int:id>')
 @login_required
 def toggle_alerta(id):
-    query("UPDATE alerta SET ativo=CASE WHEN ativo=1 THEN 0 ELSE 1 END WHERE id=?", (id,), commit=True)
+    escrever_alteracao("UPDATE alerta SET ativo=CASE WHEN ativo=1 THEN 0 ELSE 1 END WHERE id=?", (id,), 'alerta', id)
     return redirect(url_for('admin_dashboard', tab='tab-alertas'))
 
 @app.route('/admin/alerta/delete/<int:id>')
 @login_required
 def delete_alerta(id):
-    query("DELETE FROM alerta WHERE id=?", (id,), commit=True)
+    escrever_alteracao("DELETE FROM alerta WHERE id=?", (id,), 'alerta', id, 'delete')
     flash('Alerta eliminado.', 'success')
     return redirect(url_for('admin_dashboard', tab='tab-alertas'))
 
@@ -699,13 +2975,31 @@ def delete_alerta(id):
 #  ADMIN — FAMÍLIAS
 # ═══════════════════════════════════════════════════════════════
 
+def _zona_form(bairro, numero):
+    # '' sem zona, 'auto' a sugerida para o bairro, ou o id de uma zona
+    # -> (zona_id, nome da zona ou None)
+    escolha = request.form.get('zona_id', '')
+    if escolha == 'auto':
+        z = next(iter(sugerir_zonas(bairro, numero, k=1)), None)
+        return (z['id'], z['nome']) if z else (None, None)
+    if escolha.isdigit():
+        z = query("SELECT id, nome FROM zona WHERE id=?", (int(escolha),), one=True)
+        return (z['id'], z['nome']) if z else (None, None)
+    return None, None
+
 @app.route('/admin/familia/add', methods=['POST'])
 @login_required
 def add_familia():
-    query("INSERT INTO familia(bairro,numero,situacao,abrigo,necessidades,data) VALUES(?,?,?,?,?,?)",
-          (request.form['bairro'], int(request.form['numero']), request.form['situacao'],
-           request.form['abrigo'], request.form['necessidades'], now_cat()), commit=True)
-    flash('Família registada!', 'success')
+    numero = int(request.form['numero'])
+    zona_id, zona = _zona_form(request.form['bairro'], numero)
+    escrever_alteracao("INSERT INTO familia(bairro,numero,situacao,abrigo,necessidades,data,zona_id) VALUES(?,?,?,?,?,?,?)",
+                       (request.form['bairro'], numero, request.form['situacao'],
+                        zona or request.form.get('abrigo', ''), request.form['necessidades'], now_cat(), zona_id),
+                       'familia')
+    if request.form.get('zona_id') == 'auto' and not zona:
+        flash('Família registada, mas nenhuma zona tem vagas para ela.', 'error')
+    else:
+        flash(f'Família registada{" em " + zona if zona else ""}!', 'success')
     return redirect(url_for('admin_dashboard', tab='tab-familias'))
 
 @app.route('/admin/familia/editar/<int:id>', methods=['GET','POST'])
@@ -716,18 +3010,23 @@ def editar_familia(id):
         flash('Família não encontrada.', 'error')
         return redirect(url_for('admin_dashboard', tab='tab-familias'))
     if request.method == 'POST':
-        query("UPDATE familia SET bairro=?, numero=?, situacao=?, abrigo=?, necessidades=?, data=? WHERE id=?",
-              (request.form['bairro'], int(request.form['numero']), request.form['situacao'],
-               request.form['abrigo'], request.form['necessidades'], now_cat(), id), commit=True)
+        numero = int(request.form['numero'])
+        zona_id, zona = _zona_form(request.form['bairro'], numero)
+        escrever_alteracao("UPDATE familia SET bairro=?, numero=?, situacao=?, abrigo=?, necessidades=?, data=?, zona_id=? WHERE id=?",
+                           (request.form['bairro'], numero, request.form['situacao'],
+                            zona or request.form.get('abrigo', ''), request.form['necessidades'], now_cat(), zona_id, id),
+                           'familia', id)
         flash('Família actualizada!', 'success')
         return redirect(url_for('admin_dashboard', tab='tab-familias'))
     cfg = get_site_config()
-    return render_template('editar_familia.html', familia=familia, cfg=cfg)
+    zonas = query("SELECT id, nome, capacidade, ocupacao FROM zona WHERE ativa=1 OR id=? ORDER BY nome",
+                  (familia['zona_id'],))
+    return render_template('editar_familia.html', familia=familia, cfg=cfg, zonas=zonas)
 
 @app.route('/admin/familia/delete/<int:id>')
 @login_required
 def delete_familia(id):
-    query("DELETE FROM familia WHERE id=?", (id,), commit=True)
+    escrever_alteracao("DELETE FROM familia WHERE id=?", (id,), 'familia', id, 'delete')
     flash('Família eliminada.', 'success')
     return redirect(url_for('admin_dashboard', tab='tab-familias'))
 
@@ -736,11 +3035,22 @@ def delete_familia(id):
 #  ADMIN — ZONAS
 # ═══════════════════════════════════════════════════════════════
 
+def _coordenadas_form():
+    # Latitude e longitude opcionais; inválidas, fora da área servida ou só uma
+    # delas contam como em falta
+    try:
+        lat, lon = float(request.form.get('lat', '')), float(request.form.get('lon', ''))
+    except ValueError:
+        return None, None
+    return (lat, lon) if na_area_servico(lat, lon) else (None, None)
+
 @app.route('/admin/zona/add', methods=['POST'])
 @login_required
 def add_zona():
-    query("INSERT INTO zona(nome,capacidade,recursos) VALUES(?,?,?)",
-          (request.form['nome'], int(request.form['capacidade']), request.form['recursos']), commit=True)
+    lat, lon = _coordenadas_form()
+    escrever_alteracao("INSERT INTO zona(nome,capacidade,recursos,lat,lon) VALUES(?,?,?,?,?)",
+                       (request.form['nome'], int(request.form['capacidade']), request.form['recursos'], lat, lon),
+                       'zona')
     flash('Zona segura adicionada!', 'success')
     return redirect(url_for('admin_dashboard', tab='tab-zonas'))
 
@@ -752,8 +3062,10 @@ def editar_zona(id):
         flash('Zona não encontrada.', 'error')
         return redirect(url_for('admin_dashboard', tab='tab-zonas'))
     if request.method == 'POST':
-        query("UPDATE zona SET nome=?, capacidade=?, recursos=? WHERE id=?",
-              (request.form['nome'], int(request.form['capacidade']), request.form['recursos'], id), commit=True)
+        lat, lon = _coordenadas_form()
+        escrever_alteracao("UPDATE zona SET nome=?, capacidade=?, recursos=?, lat=?, lon=? WHERE id=?",
+                           (request.form['nome'], int(request.form['capacidade']), request.form['recursos'], lat, lon, id),
+                           'zona', id)
         flash('Zona actualizada!', 'success')
         return redirect(url_for('admin_dashboard', tab='tab-zonas'))
     cfg = get_site_config()
@@ -762,14 +3074,23 @@ def editar_zona(id):
 @app.route('/admin/zona/toggle/<int:id>')
 @login_required
 def toggle_zona(id):
-    query("UPDATE zona SET ativa=CASE WHEN ativa=1 THEN 0 ELSE 1 END WHERE id=?", (id,), commit=True)
+    escrever_alteracao("UPDATE zona SET ativa=CASE WHEN ativa=1 THEN 0 ELSE 1 END WHERE id=?", (id,), 'zona', id)
     return redirect(url_for('admin_dashboard', tab='tab-zonas'))
 
 @app.route('/admin/zona/delete/<int:id>')
 @login_required
 def delete_zona(id):
-    query("DELETE FROM zona WHERE id=?", (id,), commit=True)
-    flash('Zona eliminada.', 'success')
+    # As famílias lá alojadas ficam sem zona nem abrigo; no mesmo commit ficam
+    # registadas como alteradas, para o site (deltas, SSE) deixar de as mostrar lá
+    def eliminar(db):
+        familias = [fid for (fid,) in db.execute("SELECT id FROM familia WHERE zona_id=?", (id,))]
+        db.execute("UPDATE familia SET zona_id=NULL, abrigo='' WHERE zona_id=?", (id,))
+        db.execute("DELETE FROM zona WHERE id=?", (id,))
+        marcar_alteracao(db, 'familia', familias)
+        return marcar_alteracao(db, 'zona', [id], 'delete'), len(familias)
+    seq, n = pool.transacao(eliminar)
+    publicar_versao(seq)
+    flash('Zona eliminada.' + (f' {n} família(s) ficaram sem abrigo.' if n else ''), 'success')
     return redirect(url_for('admin_dashboard', tab='tab-zonas'))
 
 
@@ -826,10 +3147,12 @@ def delete_ussd_pedido(id):
 @app.route('/admin/config/update', methods=['POST'])
 @master_required
 def update_config():
-    for campo in ['site_nome','site_subtitulo','site_email','site_telefone',
-                  'site_endereco','site_whatsapp','site_facebook','site_twitter']:
-        query("UPDATE configuracao SET valor=? WHERE chave=?",
-              (request.form.get(campo,''), campo), commit=True)
+    def gravar(db):
+        for campo in ['site_nome','site_subtitulo','site_email','site_telefone',
+                      'site_endereco','site_whatsapp','site_facebook','site_twitter']:
+            db.execute("UPDATE configuracao SET valor=? WHERE chave=?", (request.form.get(campo,''), campo))
+        return marcar_alteracao(db, 'configuracao', [0], 'reload')
+    publicar_versao(pool.transacao(gravar))
     flash('Configurações actualizadas!', 'success')
     return redirect(url_for('admin_dashboard', tab='tab-config'))
 
@@ -862,51 +3185,510 @@ def delete_admin_user(id):
 
 
 # ═══════════════════════════════════════════════════════════════
-#  BACKUP
+#  BACKUP — API de backup do SQLite, por passos de BACKUP_PAGINAS páginas
+#  numa leitura fixa (WAL: os escritores continuam a gravar), comprimido
+#  com gzip, com sha256 e verificação (PRAGMA integrity_check) registados
+#  em backups/manifesto.json. Os backups com mais de BACKUP_RETENCAO_DIAS
+#  são apagados, mantendo sempre os BACKUP_MINIMO mais recentes.
+#  Também em linha de comandos: flask --app app backup [--verificar]
 # ═══════════════════════════════════════════════════════════════
+BACKUP_DIR = os.environ.get('BACKUP_DIR') or os.path.join(os.path.dirname(DB), 'backups')
+BACKUP_PAGINAS = 256          # páginas copiadas por passo
+BACKUP_PAUSA_S = 0.005        # entre passos e blocos (deixa correr as outras threads)
+BACKUP_RETENCAO_DIAS = int(os.environ.get('BACKUP_RETENCAO_DIAS', 30))
+BACKUP_MINIMO = 3
+CHAVE_CRON = 'AlertaN4mpul4@2026!'
+BLOCO = 1 << 20
+
+def _backups():
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted((f for f in os.listdir(BACKUP_DIR)
+                   if f.startswith('backup_') and f.endswith(('.db', '.db.gz'))), reverse=True)
+
+@contextmanager
+def _manifesto():
+    # Lido e gravado sob flock: o cron e a linha de comandos podem coincidir
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    caminho = os.path.join(BACKUP_DIR, 'manifesto.json')
+    with open(caminho + '.lock', 'w') as trinco:
+        if fcntl: fcntl.flock(trinco, fcntl.LOCK_EX)
+        try:
+            with open(caminho, encoding='utf-8') as f:
+                dados = json.load(f)
+        except (OSError, ValueError):
+            dados = {}
+        yield dados
+        with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(dados, f, indent=1, ensure_ascii=False)
+        os.replace(caminho + '.tmp', caminho)
+
+def _copiar(origem, destino, h=None):
+    for bloco in iter(lambda: origem.read(BLOCO), b''):
+        destino.write(bloco)
+        if h: h.update(bloco)
+        time.sleep(BACKUP_PAUSA_S)
+
+class _Hash:
+    # Ficheiro que calcula o sha256 do que lhe é escrito (o .gz final)
+    def __init__(self, f, h):
+        self.f, self.h = f, h
+    def write(self, dados):
+        self.h.update(dados)
+        return self.f.write(dados)
+    def flush(self):
+        self.f.flush()
+
+class _Nulo:
+    # Só para calcular o sha256 ao ler
+    def write(self, dados):
+        return len(dados)
+
+def criar_backup():
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    nome = f"backup_{datetime.now(CAT).strftime('%Y%m%d_%H%M%S')}.db.gz"
+    final = os.path.join(BACKUP_DIR, nome)
+    cru = final[:-3] + '.tmp'
+    t = time.perf_counter()
+
+    # Transacção de leitura aberta durante toda a cópia: o backup vê um só
+    # instante da BD e não recomeça quando outro worker grava entre passos
+    origem = sqlite3.connect(pathlib.Path(DB).as_uri() + '?mode=ro', uri=True)
+    destino = sqlite3.connect(cru)
+    try:
+        origem.execute("BEGIN")
+        origem.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        origem.backup(destino, pages=BACKUP_PAGINAS,
+                      progress=lambda estado, restantes, total: time.sleep(BACKUP_PAUSA_S))
+    finally:
+        destino.close()
+        origem.close()
+
+    h = hashlib.sha256()
+    try:
+        with open(cru, 'rb') as f, open(final + '.tmp', 'wb') as bruto:
+            with gzip.GzipFile(filename=nome[:-3], mode='wb', fileobj=_Hash(bruto, h), mtime=0) as gz:
+                _copiar(f, gz)
+        os.replace(final + '.tmp', final)
+        tamanho_db = os.path.getsize(cru)
+    finally:
+        for resto in (cru, final + '.tmp'):
+            if os.path.exists(resto):
+                os.remove(resto)
+
+    with _manifesto() as m:
+        m[nome] = {'criado': now_cat(), 'sha256': h.hexdigest(), 'tamanho': os.path.getsize(final),
+                   'tamanho_db': tamanho_db, 'segundos': round(time.perf_counter() - t, 2)}
+    info = verificar_backup(nome)
+    info['apagados'] = aplicar_retencao()
+    return nome, info
+
+def verificar_backup(nome):
+    # Confere o sha256, descomprime para um ficheiro temporário e abre-o
+    # como numa reposição: PRAGMA integrity_check e versão do esquema
+    caminho = os.path.join(BACKUP_DIR, nome)
+    h = hashlib.sha256()
+    with tempfile.TemporaryDirectory(dir=BACKUP_DIR) as pasta:
+        tmp = os.path.join(pasta, 'verificar.db')
+        with open(caminho, 'rb') as f:
+            _copiar(f, _Nulo(), h)
+        try:
+            with (gzip.open if nome.endswith('.gz') else open)(caminho, 'rb') as f, open(tmp, 'wb') as d:
+                _copiar(f, d)
+            db = sqlite3.connect(tmp)
+            try:
+                integridade = [r[0] for r in db.execute("PRAGMA integrity_check")]
+                esquema = db.execute("PRAGMA user_version").fetchone()[0]
+            finally:
+                db.close()
+        except (OSError, EOFError, zlib.error, sqlite3.DatabaseError) as e:
+            integridade, esquema = [f'{type(e).__name__}: {e}'], None
+
+    with _manifesto() as m:
+        info = m.setdefault(nome, {'tamanho': os.path.getsize(caminho)})
+        esperado = info.setdefault('sha256', h.hexdigest())
+        info.update({
+            'verificado': now_cat(),
+            'sha256_ok': esperado == h.hexdigest(),
+            'integridade': 'ok' if integridade == ['ok'] else '; '.join(integridade[:5]),
+            'versao_esquema': esquema,
+        })
+        info['ok'] = info['sha256_ok'] and info['integridade'] == 'ok'
+        return dict(info)
+
+def aplicar_retencao():
+    limite = (datetime.now(CAT) - timedelta(days=BACKUP_RETENCAO_DIAS)).strftime('%Y%m%d_%H%M%S')
+    apagados = [b for b in _backups()[BACKUP_MINIMO:] if b[len('backup_'):][:15] < limite]
+    with _manifesto() as m:
+        for b in apagados:
+            os.remove(os.path.join(BACKUP_DIR, b))
+            m.pop(b, None)
+    return apagados
 
 @app.route('/cron/backup_auto')
 def backup_auto():
-    import shutil
-    CHAVE_SECRETA = 'AlertaN4mpul4@2026!'
-    if request.args.get('chave') != CHAVE_SECRETA:
+    if request.args.get('chave') != CHAVE_CRON:
         return 'Erro: Chave inválida', 403
     try:
-        if not os.path.exists('backups'):
-            os.makedirs('backups')
-        agora = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_file = f'backups/backup_{agora}.db'
-        if os.path.exists('alerta.db'):
-            shutil.copy('alerta.db', backup_file)
-        else:
+        if not os.path.exists(DB):
             return 'Erro: alerta.db não encontrado', 404
-        backups = sorted([f for f in os.listdir('backups') if f.endswith('.db')])
-        while len(backups) > 30:
-            os.remove(os.path.join('backups', backups.pop(0)))
-        return f'✅ Backup criado: backup_{agora}.db'
+        nome, info = criar_backup()
+        if not info['ok']:
+            return f"❌ Backup {nome} falhou a verificação: {info['integridade']}", 500
+        return f"✅ Backup criado: {nome} ({info['tamanho'] // 1024} KB, verificado)"
     except Exception as e:
         return f'❌ Erro: {str(e)}', 500
 
 @app.route('/admin/backups')
 @login_required
 def listar_backups():
-    if not os.path.exists('backups'):
+    backups = _backups()
+    if not backups:
         return 'Nenhum backup encontrado'
-    backups = sorted([f for f in os.listdir('backups') if f.endswith('.db')], reverse=True)
+    with _manifesto() as m:
+        info = {b: m.get(b, {}) for b in backups}
     from jinja2 import Template
-    html = '<h1>Backups</h1><ul>{% for b in backups %}<li><a href="/admin/backup/{{ b }}">{{ b }}</a></li>{% endfor %}</ul><p><a href="/admin">← Voltar</a></p>'
-    return Template(html).render(backups=backups)
+    html = ('<h1>Backups</h1><ul>{% for b in backups %}<li><a href="/admin/backup/{{ b }}">{{ b }}</a>'
+            '{% set i = info[b] %}{% if i.tamanho %} — {{ (i.tamanho / 1024) | round(1) }} KB{% endif %}'
+            '{% if i.verificado %} — {{ "✅ verificado" if i.ok else "❌ " ~ i.integridade }} em {{ i.verificado }}{% endif %}'
+            '{% if i.sha256 %} <small>sha256 {{ i.sha256[:12] }}…</small>{% endif %}'
+            '</li>{% endfor %}</ul><p><a href="/admin">← Voltar</a></p>')
+    return Template(html).render(backups=backups, info=info)
 
 @app.route('/admin/backup/<nome>')
 @login_required
 def baixar_backup(nome):
-    from flask import send_file
-    if '..' in nome or not nome.startswith('backup_'):
+    if '..' in nome or '/' in nome or not nome.startswith('backup_'):
         return 'Ficheiro inválido', 400
-    caminho = os.path.join('backups', nome)
+    caminho = os.path.join(BACKUP_DIR, nome)
     if not os.path.exists(caminho):
         return 'Backup não encontrado', 404
-    return send_file(caminho, as_attachment=True)
+    if nome.endswith('.gz'):
+        # send_file envia o ficheiro aos blocos
+        return send_file(caminho, as_attachment=True, mimetype='application/gzip')
+
+    # Backups antigos (.db sem compressão): comprimidos à medida que são enviados
+    def gerar():
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)
+        with open(caminho, 'rb') as f:
+            for bloco in iter(lambda: f.read(BLOCO), b''):
+                yield z.compress(bloco)
+        yield z.flush()
+    return Response(gerar(), mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename={nome}.gz'})
+
+@app.cli.command('backup')
+@click.option('--verificar', is_flag=True, help='Verificar todos os backups existentes em vez de criar um.')
+def comando_backup(verificar):
+    """Cria um backup comprimido e verificado da BD."""
+    if verificar:
+        falhas = 0
+        for b in _backups():
+            info = verificar_backup(b)
+            falhas += not info['ok']
+            click.echo(f"{'✔' if info['ok'] else '✗'} {b}: {info['integridade']}"
+                       f"{'' if info['sha256_ok'] else ' (sha256 não confere)'}")
+        if falhas:
+            raise SystemExit(1)
+        return
+    nome, info = criar_backup()
+    click.echo(f"{'✔' if info['ok'] else '✗'} {nome}: {info['tamanho'] // 1024} KB "
+               f"(BD {info['tamanho_db'] // 1024} KB, {info['segundos']}s), integridade {info['integridade']}")
+    for b in info['apagados']:
+        click.echo(f'  apagado (retenção): {b}')
+    if not info['ok']:
+        raise SystemExit(1)
+
+# ═══════════════════════════════════════════════════════════════
+#  ARQUIVO — linhas resolvidas e antigas saem das tabelas quentes
+#  ussd_pedido, apoio e alerta só crescem; o dashboard e as listas só
+#  precisam do que está aberto ou é recente. O cron (ou `flask arquivar`)
+#  move o resto para arquivo_<tabela>, na mesma BD, em lotes pequenos.
+#  O histórico completo lê-se em /api/admin/<nome>?historico=1.
+# ═══════════════════════════════════════════════════════════════
+
+# tabela -> (condição para arquivar, colunas com índice no arquivo)
+ARQUIVO = {
+    'ussd_pedido': ("status IN ('concluido', 'cancelado')", ['status', 'tipo']),
+    'apoio':       ("status IN ('confirmado', 'recusado')", ['status', 'tipo']),
+    'alerta':      ("ativo = 0",                            ['ativo', 'tipo']),
+}
+ARQUIVO_DIAS = int(os.environ.get('ARQUIVO_DIAS', 30))   # idade mínima (coluna data)
+ARQUIVO_LOTE = 500            # linhas por transacção
+ARQUIVO_PAUSA_S = 0.05        # entre lotes (deixa passar as outras escritas)
+ARQUIVO_TEMPO_MAX_S = 120     # por execução; o resto fica para a próxima
+
+def preparar_arquivo(db):
+    # Cria arquivo_<tabela> com as colunas da tabela quente + `arquivado`.
+    # Migrações que acrescentem colunas a estas tabelas voltam a chamar isto.
+    for tabela, (_, indices) in ARQUIVO.items():
+        arq = f'arquivo_{tabela}'
+        info = db.execute(f"PRAGMA table_info({tabela})").fetchall()
+        existentes = _colunas(db, arq)
+        if not existentes:
+            cols = ', '.join(f"{c[1]} {c[2]}{' PRIMARY KEY' if c[5] else ''}" for c in info)
+            db.execute(f"CREATE TABLE {arq}({cols}, arquivado TEXT)")
+        for c in info:
+            if existentes and c[1] not in existentes:
+                db.execute(f"ALTER TABLE {arq} ADD COLUMN {c[1]} {c[2]}")
+        db.execute(f"CREATE INDEX IF NOT EXISTS idx_{arq}_data ON {arq}(data, id)")
+        for col in indices:
+            db.execute(f"CREATE INDEX IF NOT EXISTS idx_{arq}_{col} ON {arq}({col}, data)")
+
+def _arquivar_lote(db, tabela, limite_data, agora):
+    cond = ARQUIVO[tabela][0]
+    ids = [r[0] for r in db.execute(
+        f"SELECT id FROM {tabela} WHERE {cond} AND data < ? ORDER BY data LIMIT ?",
+        (limite_data, ARQUIVO_LOTE))]
+    if not ids:
+        return 0
+    lista = json.dumps(ids)
+    origem = f"FROM {tabela} WHERE id IN (SELECT value FROM json_each(?))"
+    cols = ', '.join(sorted(_colunas(db, tabela)))
+    db.execute(f"INSERT OR REPLACE INTO arquivo_{tabela}({cols}, arquivado) SELECT {cols}, ? {origem}",
+               (agora, lista))
+    # O DELETE dispara os triggers dos contadores; repõe-se antes o que as
+    # linhas valem, para os totais continuarem a incluir o arquivo. Os da
+    # pesquisa deixam no índice o que já está no arquivo (migração 16).
+    for chave, expr in CONTADORES.get(tabela, []):
+        db.execute(f"UPDATE contador SET valor = valor + "
+                   f"(SELECT COALESCE(SUM({expr.replace('R.', '')}), 0) {origem}) WHERE chave=?",
+                   (lista, chave))
+    for expr in CONTADORES_HORA.get(tabela, []):
+        chave = expr.replace('R.', '')
+        db.execute(f"INSERT INTO contador_hora(chave, hora, valor) "
+                   f"SELECT {chave}, substr(data,1,13), COUNT(*) {origem} AND ({chave}) IS NOT NULL GROUP BY 1, 2 "
+                   f"ON CONFLICT(chave, hora) DO UPDATE SET valor = valor + excluded.valor",
+                   (lista,))
+    db.execute(f"DELETE {origem}", (lista,))
+    return len(ids)
+
+def arquivar(dias=None, tempo_max=ARQUIVO_TEMPO_MAX_S):
+    """Move para o arquivo as linhas resolvidas com mais de `dias` dias."""
+    dias = ARQUIVO_DIAS if dias is None else dias
+    limite_data = (datetime.now(CAT) - timedelta(days=dias)).strftime('%Y-%m-%d %H:%M:%S')
+    fim = time.monotonic() + tempo_max
+    movidas, completo = {}, True
+    for tabela in ARQUIVO:
+        movidas[tabela] = 0
+        while True:
+            if time.monotonic() > fim:
+                completo = False
+                break
+            n = pool.transacao(lambda db: _arquivar_lote(db, tabela, limite_data, now_cat()))
+            movidas[tabela] += n
+            if n < ARQUIVO_LOTE:
+                break
+            time.sleep(ARQUIVO_PAUSA_S)
+    return {'movidas': movidas, 'completo': completo, 'antes_de': limite_data}
+
+@app.route('/cron/arquivo_auto')
+def arquivo_auto():
+    if request.args.get('chave') != CHAVE_CRON:
+        return 'Erro: Chave inválida', 403
+    try:
+        r = arquivar()
+        resumo = ', '.join(f'{t}: {n}' for t, n in r['movidas'].items())
+        return f"✅ Arquivo (antes de {r['antes_de']}): {resumo}{'' if r['completo'] else ' — continua na próxima execução'}"
+    except Exception as e:
+        return f'❌ Erro: {str(e)}', 500
+
+@app.cli.command('arquivar')
+@click.option('--dias', type=int, default=None, help=f'Idade mínima das linhas (por omissão {ARQUIVO_DIAS}).')
+def comando_arquivar(dias):
+    """Move pedidos, apoios e alertas resolvidos e antigos para o arquivo."""
+    r = arquivar(dias, tempo_max=float('inf'))
+    for tabela, n in r['movidas'].items():
+        click.echo(f'{tabela}: {n} linhas arquivadas (antes de {r["antes_de"]})')
+
+# ═══════════════════════════════════════════════════════════════
+#  EXPORTAÇÃO E IMPORTAÇÃO — dados para parceiros (INGC, ONGs)
+#  A exportação lê as tabelas do admin por páginas do cursor (data, id),
+#  com os mesmos filtros, e escreve à medida: memória constante e nenhuma
+#  ligação presa enquanto o parceiro descarrega. A importação recebe as
+#  folhas de cálculo (em CSV) das famílias registadas no terreno.
+# ═══════════════════════════════════════════════════════════════
+
+EXPORTAVEIS = ('familias', 'pedidos', 'voluntarios')
+EXPORTAR_LOTE = 1000
+EXPORTAR_BLOCO = 64 << 10
+EXPORTAR_TOKEN = os.environ.get('EXPORTAR_TOKEN')   # acesso sem sessão: Authorization: Bearer ...
+
+def _ler_pool(sql, args=()):
+    db = pool.emprestar()
+    try:
+        return db.execute(sql, args).fetchall()
+    finally:
+        pool.devolver(db)
+
+def _linhas_exportacao(nome, args):
+    por_data = TABELAS_ADMIN[nome][2]
+    args = dict(args, cursor='')
+    while True:
+        rows = _ler_pagina(nome, args, EXPORTAR_LOTE, _ler_pool)
+        yield from rows[:EXPORTAR_LOTE]
+        if len(rows) <= EXPORTAR_LOTE:
+            return
+        ultimo = rows[EXPORTAR_LOTE - 1]
+        args['cursor'] = f"{ultimo['data'] if por_data else ''}|{ultimo['id']}"
+
+def _texto_exportacao(formato, colunas, linhas):
+    buf = io.StringIO()
+    escritor = csv.writer(buf) if formato == 'csv' else None
+    if escritor:
+        buf.write('\ufeff')   # BOM: o Excel abre o UTF-8 com acentos
+        escritor.writerow(colunas)
+    for r in linhas:
+        d = dict(r)
+        if escritor:
+            escritor.writerow([d.get(c) for c in colunas])
+        else:
+            buf.write(json.dumps({c: d.get(c) for c in colunas}, ensure_ascii=False) + '\n')
+        if buf.tell() > EXPORTAR_BLOCO:
+            yield buf.getvalue().encode()
+            buf.seek(0); buf.truncate()
+    yield buf.getvalue().encode()
+
+def _gzip_blocos(blocos):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for bloco in blocos:
+        dados = z.compress(bloco)
+        if dados:
+            yield dados
+    yield z.flush()
+
+@app.route('/api/exportar/<nome>')
+def exportar(nome):
+    # ?formato=csv|ndjson, ?gzip=1, e os filtros de /api/admin/<nome> (incl. historico=1)
+    if not session.get('admin_id') and not (
+            EXPORTAR_TOKEN and request.headers.get('Authorization') == f'Bearer {EXPORTAR_TOKEN}'):
+        return jsonify({'ok': False, 'msg': 'Não autorizado'}), 401
+    formato = request.args.get('formato', 'csv')
+    if nome not in EXPORTAVEIS or formato not in ('csv', 'ndjson'):
+        return jsonify({'ok': False, 'msg': 'Exportação desconhecida'}), 404
+    args = request.args.to_dict()
+    tabela = TABELAS_ADMIN[nome][0]
+    colunas = [c['name'] for c in _ler_pool(f"PRAGMA table_info({tabela})")]
+    if args.get('historico') == '1' and tabela in ARQUIVO:
+        colunas.append('arquivado')
+    corpo = _texto_exportacao(formato, colunas, _linhas_exportacao(nome, args))
+    ficheiro = f"{nome}_{datetime.now(CAT):%Y%m%d_%H%M}.{formato}"
+    tipo = 'text/csv' if formato == 'csv' else 'application/x-ndjson'
+    if request.args.get('gzip') == '1':
+        corpo, ficheiro, tipo = _gzip_blocos(corpo), ficheiro + '.gz', 'application/gzip'
+    return Response(corpo, mimetype=tipo,
+                    headers={'Content-Disposition': f'attachment; filename={ficheiro}',
+                             'Cache-Control': 'no-store'})
+
+# ── Importação de famílias ────────────────────────────────────
+IMPORTAR_LOTE = 500           # linhas por transacção
+IMPORTAR_MAX_BYTES = 5 << 20
+IMPORTAR_MAX_ERROS = 200      # erros devolvidos (conta-se o total)
+IMPORTAR_MAX_PESSOAS = 500
+SITUACOES = ('Inundações', 'Ciclone', 'Seca', 'Incêndio', 'Conflito', 'Outro')
+# cabeçalho normalizado -> campo
+COLUNAS_IMPORTAR = {
+    'bairro': 'bairro', 'numero': 'numero', 'pessoas': 'numero', 'n pessoas': 'numero',
+    'situacao': 'situacao', 'abrigo': 'abrigo', 'necessidades': 'necessidades', 'zona': 'zona',
+}
+
+def _ler_csv(dados):
+    # Folhas gravadas pelo Excel: UTF-8 (com ou sem BOM) ou Windows-1252, com , ou ;
+    try:
+        texto = dados.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        texto = dados.decode('cp1252', 'replace')
+    try:
+        dialecto = csv.Sniffer().sniff(texto[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialecto = csv.excel
+    return csv.reader(io.StringIO(texto), dialecto)
+
+def _validar_familia(linha, zonas, situacoes):
+    # -> (valores para o INSERT sem a data, None) ou (None, erro)
+    bairro = linha.get('bairro', '').strip()
+    necessidades = linha.get('necessidades', '').strip()
+    if not bairro:
+        return None, 'bairro em falta'
+    try:
+        numero = int(linha.get('numero', '').strip())
+    except ValueError:
+        return None, f"número de pessoas inválido: {linha.get('numero', '')!r}"
+    if not 1 <= numero <= IMPORTAR_MAX_PESSOAS:
+        return None, f'número de pessoas fora do intervalo 1–{IMPORTAR_MAX_PESSOAS}: {numero}'
+    situacao = situacoes.get(normalizar_nome(linha.get('situacao', '')))
+    if not situacao:
+        return None, f"situação desconhecida: {linha.get('situacao', '')!r}"
+    if not necessidades:
+        return None, 'necessidades em falta'
+    zona_id, abrigo = None, linha.get('abrigo', '').strip()
+    if linha.get('zona', '').strip():
+        zona_id, abrigo = zonas.get(normalizar_nome(linha['zona']), (None, None))
+        if not zona_id:
+            return None, f"zona desconhecida: {linha['zona']!r}"
+    return (bairro, numero, situacao, abrigo, necessidades, zona_id), None
+
+def _gravar_familias(lote, agora):
+    # Um lote numa transacção; os triggers tratam de contadores, pesquisa e
+    # ocupação das zonas. As alterações públicas ficam registadas de uma vez.
+    def fn(db):
+        antes = db.execute("SELECT COALESCE(MAX(id), 0) FROM familia").fetchone()[0]
+        db.executemany("INSERT INTO familia(bairro,numero,situacao,abrigo,necessidades,zona_id,data) "
+                       "VALUES(?,?,?,?,?,?,?)", [v + (agora,) for v in lote])
+        seq = db.execute("INSERT INTO alteracao(tabela, registo_id, op, data) "
+                         "SELECT 'familia', id, 'upsert', ? FROM familia WHERE id > ?", (agora, antes)).lastrowid
+        db.execute("DELETE FROM alteracao WHERE seq <= ?", (seq - ALTERACOES_MAX,))
+        return seq
+    publicar_versao(pool.transacao(fn))
+
+def importar_familias(dados, so_validar=False):
+    leitor = _ler_csv(dados)
+    cabecalho = [COLUNAS_IMPORTAR.get(normalizar_nome(c)) for c in next(leitor, [])]
+    em_falta = [c for c in ('bairro', 'numero', 'situacao', 'necessidades') if c not in cabecalho]
+    if em_falta:
+        raise ValueError('Colunas em falta: ' + ', '.join(em_falta))
+    zonas = {normalizar_nome(z['nome']): (z['id'], z['nome']) for z in _ler_pool("SELECT id, nome FROM zona")}
+    situacoes = {normalizar_nome(s): s for s in SITUACOES}
+    agora = now_cat()
+    r = {'validas': 0, 'inseridas': 0, 'erros': [], 'total_erros': 0}
+    lote = []
+    for campos in leitor:
+        if not any(c.strip() for c in campos):
+            continue
+        valores, erro = _validar_familia({c: v for c, v in zip(cabecalho, campos) if c}, zonas, situacoes)
+        if erro:
+            r['total_erros'] += 1
+            if len(r['erros']) < IMPORTAR_MAX_ERROS:
+                r['erros'].append({'linha': leitor.line_num, 'erro': erro})
+            continue
+        r['validas'] += 1
+        lote.append(valores)
+        if len(lote) >= IMPORTAR_LOTE:
+            if not so_validar:
+                _gravar_familias(lote, agora)
+                r['inseridas'] += len(lote)
+            lote = []
+    if lote and not so_validar:
+        _gravar_familias(lote, agora)
+        r['inseridas'] += len(lote)
+    r['ok'] = r['total_erros'] == 0
+    return r
+
+@app.route('/api/importar/familias', methods=['POST'])
+@login_required
+def api_importar_familias():
+    # Ficheiro CSV em `ficheiro`; validar=1 só verifica. As linhas válidas
+    # entram mesmo que outras falhem: os erros trazem o número da linha.
+    f = request.files.get('ficheiro')
+    if not f:
+        return jsonify({'ok': False, 'msg': 'Ficheiro em falta'}), 400
+    dados = f.read(IMPORTAR_MAX_BYTES + 1)
+    if len(dados) > IMPORTAR_MAX_BYTES:
+        return jsonify({'ok': False, 'msg': f'Ficheiro maior que {IMPORTAR_MAX_BYTES >> 20} MB'}), 413
+    try:
+        return jsonify(importar_familias(dados, so_validar=request.form.get('validar') == '1'))
+    except ValueError as e:
+        return jsonify({'ok': False, 'msg': str(e)}), 400
 
 
 # ═══════════════════════════════════════════════════════════════
@@ -917,6 +3699,576 @@ def baixar_backup(nome):
 def ping():
     return 'pong', 200
 
+@app.route('/api/db/pool')
+@login_required
+def estado_pool():
+    return jsonify(dict(pool.estado(), fila_escrita=fila_escrita.metricas,
+                        cache_ussd={'hits': cache_ussd.hits, 'misses': cache_ussd.misses,
+                                    'ecras': len(cache_ussd.ecras)},
+                        cache_pagina=cache_pagina.estado(), admissao_ussd=admissao.estado(),
+                        dedup_ussd=dedup_pedidos.estado(), compressao=cache_compressao.estado()))
+
+def _rotulos(**kw):
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in kw.items()) + '}'
+
+def _histograma(linhas, nome, limites, h, **rot):
+    acumulado = 0
+    for limite, n in zip(list(limites) + ['+Inf'], h[:-1]):
+        acumulado += n
+        linhas.append(f'{nome}_bucket{_rotulos(**rot, le=limite)} {acumulado}')
+    linhas.append(f'{nome}_sum{_rotulos(**rot) if rot else ""} {h[-1]:.6f}')
+    linhas.append(f'{nome}_count{_rotulos(**rot) if rot else ""} {acumulado}')
+
+@app.route('/metrics')
+def exportar_metricas():
+    # Formato de texto do Prometheus, somado de todos os workers
+    token = os.environ.get('METRICAS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return 'Não autorizado', 401
+    m = metricas.juntar()
+    linhas = ['# HELP alerta_pedidos_total Pedidos HTTP por endpoint, método e estado',
+              '# TYPE alerta_pedidos_total counter']
+    for chave, n in sorted(m['pedidos'].items()):
+        endpoint, metodo, estado = chave.rsplit('|', 2)
+        linhas.append(f'alerta_pedidos_total{_rotulos(endpoint=endpoint, metodo=metodo, estado=estado)} {n}')
+    linhas += ['# HELP alerta_pedido_segundos Latência dos pedidos por endpoint',
+               '# TYPE alerta_pedido_segundos histogram']
+    for endpoint, h in sorted(m['latencia'].items()):
+        _histograma(linhas, 'alerta_pedido_segundos', Metricas.LATENCIA, h, endpoint=endpoint)
+    linhas += ['# HELP alerta_sql_por_pedido Consultas SQL feitas em cada pedido',
+               '# TYPE alerta_sql_por_pedido histogram']
+    _histograma(linhas, 'alerta_sql_por_pedido', Metricas.POR_PEDIDO, m['por_pedido'])
+    linhas += ['# HELP alerta_sql_segundos Duração de cada consulta SQL (normalizada)',
+               '# TYPE alerta_sql_segundos histogram']
+    for sql, s in sorted(m['sql'].items()):
+        _histograma(linhas, 'alerta_sql_segundos', Metricas.SQL, s['h'], sql=sql)
+    linhas += ['# HELP alerta_sql_linhas_total Linhas devolvidas por consulta SQL',
+               '# TYPE alerta_sql_linhas_total counter']
+    for sql, s in sorted(m['sql'].items()):
+        linhas.append(f'alerta_sql_linhas_total{_rotulos(sql=sql)} {s["linhas"]}')
+    for comp, valores in sorted(m['componentes'].items()):
+        for k, v in sorted(valores.items()):
+            nome = f'alerta_{comp}_{k}'
+            linhas += [f'# TYPE {nome} gauge', f'{nome} {v:g}']
+    return Response('\n'.join(linhas) + '\n', mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/metrics/lentas')
+@login_required
+def consultas_lentas():
+    return jsonify({'limite_ms': Metricas.LENTA_S * 1000, 'consultas': metricas.juntar()['lentas']})
+
+
+# ═══════════════════════════════════════════════════════════════
+#  DIFUSÃO DE ALERTAS — SMS / WhatsApp / email aos subscritores
+#  add_alerta() só regista a difusão. Em cada worker um despachante
+#  expande-a em envios (um por subscritor e canal) e entrega-os em lotes
+#  pelos gateways, com limite de taxa, concorrência e novas tentativas.
+#  Os envios são reservados com UPDATE ... RETURNING, por isso vários
+#  workers partilham a mesma fila sem mensagens duplicadas.
+# ═══════════════════════════════════════════════════════════════
+
+# Categorias do formulário de subscrição; o admin escolhe uma ao publicar
+CATEGORIAS_ALERTA = {
+    'meteorologicos': 'Meteorológicos',
+    'seguranca':      'Segurança',
+    'saude':          'Saúde',
+    'inundacoes':     'Inundações',
+    'ciclones':       'Ciclones',
+}
+
+def _separar(texto):
+    return {p.strip() for p in (texto or '').split(',') if p.strip()}
+
+def categorias_alerta(alerta):
+    # Sem categoria escolhida o alerta vai a todos os subscritores
+    if alerta['categoria'] not in CATEGORIAS_ALERTA:
+        return set(CATEGORIAS_ALERTA) | {'urgentes'}
+    cats = {alerta['categoria']}
+    if alerta['tipo'] == 'urgente':
+        cats.add('urgentes')
+    return cats
+
+def _categoria_form():
+    categoria = request.form.get('categoria', '')
+    return categoria if categoria in CATEGORIAS_ALERTA else None
+
+def canais_subscritor(s):
+    metodos = _separar(s['metodos'])
+    canais = {c: s['telefone'] for c in ('sms', 'whatsapp') if c in metodos and s['telefone']}
+    if s['email']:
+        canais['email'] = s['email']
+    return canais
+
+CANAIS = ('sms', 'whatsapp', 'email')
+
+def indexar_subscricao(db, sid):
+    # Refaz as linhas de subscricao_alvo de uma subscrição (na transacção de quem chama)
+    cur = db.cursor()
+    cur.row_factory = sqlite3.Row
+    s = cur.execute("SELECT * FROM subscricao WHERE id=?", (sid,)).fetchone()
+    db.execute("DELETE FROM subscricao_alvo WHERE subscricao_id=?", (sid,))
+    if s:
+        db.executemany("INSERT INTO subscricao_alvo(tipo, canal, subscricao_id, destino) VALUES(?,?,?,?)",
+                       [(tipo, canal, sid, destino) for tipo in _separar(s['tipo_alertas'])
+                        for canal, destino in canais_subscritor(s).items()])
+
+def mensagem_alerta(alerta, canal):
+    nivel = {'urgente': 'URGENTE', 'atencao': 'ATENÇÃO'}.get(alerta['tipo'], 'INFO')
+    if canal == 'sms':
+        texto = f"[{nivel}] {alerta['titulo']}: {alerta['conteudo']}"
+        return texto if len(texto) <= 160 else texto[:157] + '...'
+    return f"{nivel} — {alerta['titulo']}\n\n{alerta['conteudo']}\n\nAlerta Nampula"
+
+# ── Gateways ──────────────────────────────────────────────────
+# enviar(mensagens) recebe [{'id', 'destino', 'assunto', 'texto'}] e devolve
+# {id: erro} só das que falharam; uma excepção conta como falha do lote todo.
+class Gateway:
+    nome = 'base'
+
+    def __init__(self, canal, taxa=20, concorrencia=2, lote=50):
+        self.canal = canal
+        self.taxa = taxa
+        self.concorrencia = concorrencia
+        self.lote = lote
+        self.limite = LimiteTaxa(taxa)
+
+    def enviar(self, mensagens):
+        raise NotImplementedError
+
+class GatewayRegisto(Gateway):
+    # Substituto local: escreve as mensagens num ficheiro em vez de as enviar
+    nome = 'registo'
+
+    def __init__(self, canal, ficheiro, **kw):
+        super().__init__(canal, **kw)
+        self.ficheiro = ficheiro
+        self.lock = threading.Lock()
+
+    def enviar(self, mensagens):
+        with self.lock, open(self.ficheiro, 'a', encoding='utf-8') as f:
+            for m in mensagens:
+                f.write(json.dumps(dict(m, canal=self.canal), ensure_ascii=False) + '\n')
+        return {}
+
+class GatewayHTTP(Gateway):
+    # POST {"canal", "mensagens": [{"id", "para", "texto"}]} para a ponte
+    # SMS/WhatsApp; a resposta pode trazer {"falhas": {"<id>": "erro"}}
+    nome = 'http'
+
+    def __init__(self, canal, url, token=None, **kw):
+        super().__init__(canal, **kw)
+        self.url = url
+        self.token = token
+
+    def enviar(self, mensagens):
+        import urllib.request
+        corpo = json.dumps({'canal': self.canal, 'mensagens': [
+            {'id': m['id'], 'para': m['destino'], 'texto': m['texto']} for m in mensagens]}).encode()
+        cab = {'Content-Type': 'application/json'}
+        if self.token:
+            cab['Authorization'] = f'Bearer {self.token}'
+        with urllib.request.urlopen(urllib.request.Request(self.url, corpo, cab), timeout=15) as r:
+            resposta = json.loads(r.read() or b'{}')
+        return {int(k): v for k, v in resposta.get('falhas', {}).items()}
+
+class GatewaySMTP(Gateway):
+    nome = 'smtp'
+
+    def __init__(self, host, porta, remetente, utilizador=None, senha=None, tls=False, **kw):
+        super().__init__('email', **kw)
+        self.host, self.porta, self.remetente = host, porta, remetente
+        self.utilizador, self.senha, self.tls = utilizador, senha, tls
+
+    def enviar(self, mensagens):
+        import smtplib
+        from email.message import EmailMessage
+        falhas = {}
+        with smtplib.SMTP(self.host, self.porta, timeout=15) as smtp:
+            if self.tls:
+                smtp.starttls()
+            if self.utilizador:
+                smtp.login(self.utilizador, self.senha)
+            for m in mensagens:
+                msg = EmailMessage()
+                msg['From'], msg['To'], msg['Subject'] = self.remetente, m['destino'], m['assunto']
+                msg.set_content(m['texto'])
+                try:
+                    smtp.send_message(msg)
+                except smtplib.SMTPException as e:
+                    falhas[m['id']] = str(e)
+        return falhas
+
+def gateways_configurados():
+    # Canais sem gateway ficam com os envios pendentes (visíveis em /api/difusao)
+    def num(nome, omissao):
+        return float(os.environ.get(nome, omissao))
+    gws = {}
+    for canal in ('sms', 'whatsapp'):
+        pre = canal.upper()
+        if os.environ.get(f'{pre}_GATEWAY_URL'):
+            gws[canal] = GatewayHTTP(canal, os.environ[f'{pre}_GATEWAY_URL'],
+                                     os.environ.get(f'{pre}_GATEWAY_TOKEN'),
+                                     taxa=num(f'{pre}_TAXA', 20),
+                                     concorrencia=int(num(f'{pre}_CONCORRENCIA', 2)))
+    if os.environ.get('SMTP_HOST'):
+        gws['email'] = GatewaySMTP(os.environ['SMTP_HOST'], int(num('SMTP_PORTA', 25)),
+                                   os.environ.get('SMTP_REMETENTE', 'alertas@alerta-nampula.org'),
+                                   os.environ.get('SMTP_UTILIZADOR'), os.environ.get('SMTP_SENHA'),
+                                   os.environ.get('SMTP_TLS') == '1',
+                                   taxa=num('EMAIL_TAXA', 10), concorrencia=int(num('EMAIL_CONCORRENCIA', 2)))
+    registo = os.environ.get('GATEWAY_REGISTO')
+    if registo:
+        for canal in ('sms', 'whatsapp', 'email'):
+            gws.setdefault(canal, GatewayRegisto(canal, registo, taxa=num('REGISTO_TAXA', 1000)))
+    return gws
+
+def _daqui(segundos):
+    return (datetime.now(CAT) + timedelta(seconds=segundos)).strftime('%Y-%m-%d %H:%M:%S')
+
+class Despachante:
+    LOTE_EXPANSAO = 5000
+    TENTATIVAS_MAX = 5
+    ESPERA_BASE_S = 30        # 30s, 60s, 120s, ... entre tentativas
+    RESERVA_EXPIRA_S = 300    # envios reservados por um worker que morreu voltam à fila
+    INTERVALO_S = 1.0
+
+    def __init__(self):
+        self.pid = None
+        self.gateways = {}
+        self.lock = threading.Lock()
+        self.metricas = {'difusoes': 0, 'lotes': 0, 'enviados': 0, 'falhas': 0,
+                         'desistencias': 0, 'cancelados': 0}
+
+    def iniciar(self):
+        if self.pid == os.getpid() or os.environ.get('DIFUSAO_ACTIVA', '1') == '0':
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.a_correr = True
+            self.gateways = gateways_configurados()
+            self.sinais = {c: threading.Event() for c in [None, *self.gateways]}
+            self.threads = [threading.Thread(target=self._ciclo_expansao, name='difusao', daemon=True)]
+            for canal, gw in self.gateways.items():
+                self.threads += [threading.Thread(target=self._ciclo_envio, args=(gw,),
+                                                  name=f'difusao-{canal}-{i}', daemon=True)
+                                 for i in range(gw.concorrencia)]
+            self.pid = os.getpid()
+            for t in self.threads:
+                t.start()
+
+    def novo_alerta(self, alerta_id):
+        pool.escrever("INSERT OR IGNORE INTO difusao(alerta_id, criado) VALUES(?,?)",
+                      (alerta_id, now_cat()))
+        self.iniciar()
+        if self.pid == os.getpid():
+            self.sinais[None].set()
+
+    def parar(self):
+        if self.pid != os.getpid():
+            return
+        self.a_correr = False
+        for s in self.sinais.values():
+            s.set()
+        for t in self.threads:
+            t.join(timeout=5)
+        self.pid = None
+
+    # ── expansão: alerta -> envios ────────────────────────────
+    def _ciclo_expansao(self):
+        while self.a_correr:
+            try:
+                expirado = _daqui(-self.RESERVA_EXPIRA_S)
+                pool.escrever("UPDATE envio SET estado='pendente' "
+                              "WHERE estado='enviando' AND reservado < ?", (expirado,))
+                while self.a_correr:
+                    d = pool.transacao(lambda db: db.execute(
+                        "UPDATE difusao SET estado='expandindo', expandido=? WHERE alerta_id = "
+                        "(SELECT alerta_id FROM difusao WHERE estado IN ('pendente', 'expandindo') "
+                        " AND (estado='pendente' OR expandido < ?) ORDER BY alerta_id LIMIT 1) "
+                        "RETURNING alerta_id", (now_cat(), expirado)).fetchone())
+                    if d is None:
+                        break
+                    self._expandir(d['alerta_id'])
+            except Exception:
+                app.logger.exception('difusão: falha ao expandir')
+            self.sinais[None].wait(self.INTERVALO_S * 5)
+            self.sinais[None].clear()
+
+    def _expandir(self, alerta_id):
+        # A audiência sai de subscricao_alvo por (tipo, canal), em fatias de ids
+        # para não prender o lock de escrita. INSERT OR IGNORE: repetir uma
+        # expansão interrompida não duplica envios.
+        db = pool.emprestar()
+        try:
+            alerta = db.execute("SELECT * FROM alerta WHERE id=?", (alerta_id,)).fetchone()
+            maximo = db.execute("SELECT COALESCE(MAX(id), 0) FROM subscricao").fetchone()[0]
+        finally:
+            pool.devolver(db)
+        cats = sorted(categorias_alerta(alerta)) if alerta and alerta['ativo'] else []
+
+        for inicio in range(0, maximo if cats else 0, self.LOTE_EXPANSAO):
+            novos = pool.transacao(lambda w: {canal: w.execute(
+                "INSERT OR IGNORE INTO envio(alerta_id, subscricao_id, canal, destino) "
+                "SELECT ?, subscricao_id, canal, MIN(destino) FROM subscricao_alvo "
+                "WHERE canal=? AND tipo IN (SELECT value FROM json_each(?)) "
+                "AND subscricao_id > ? AND subscricao_id <= ? GROUP BY subscricao_id",
+                (alerta_id, canal, json.dumps(cats), inicio, inicio + self.LOTE_EXPANSAO)).rowcount
+                for canal in CANAIS})
+            for canal, n in novos.items():
+                if n and canal in self.gateways:
+                    self.sinais[canal].set()
+
+        pool.escrever("UPDATE difusao SET estado='expandida', expandido=?, "
+                      "mensagens=(SELECT COUNT(*) FROM envio WHERE alerta_id=?) WHERE alerta_id=?",
+                      (now_cat(), alerta_id, alerta_id))
+        self.metricas['difusoes'] += 1
+
+    # ── entrega: envios -> gateway ────────────────────────────
+    def _ciclo_envio(self, gw):
+        while self.a_correr:
+            try:
+                lote = self._reservar(gw.canal, gw.lote)
+                if lote:
+                    self._entregar(gw, lote)
+                    continue
+            except Exception:
+                app.logger.exception('difusão: falha no canal %s', gw.canal)
+            self.sinais[gw.canal].wait(self.INTERVALO_S)
+            self.sinais[gw.canal].clear()
+
+    def _reservar(self, canal, n):
+        agora = now_cat()
+        return pool.transacao(lambda db: db.execute(
+            "UPDATE envio SET estado='enviando', reservado=?, tentativas=tentativas+1 "
+            "WHERE id IN (SELECT id FROM envio WHERE canal=? AND estado='pendente' AND proxima <= ? "
+            "ORDER BY proxima, id LIMIT ?) RETURNING id, alerta_id, destino, tentativas",
+            (agora, canal, agora, n)).fetchall())
+
+    def _entregar(self, gw, lote):
+        ids = sorted({e['alerta_id'] for e in lote})
+        db = pool.emprestar()
+        try:
+            alertas = {a['id']: a for a in db.execute(
+                f"SELECT * FROM alerta WHERE id IN ({','.join('?' * len(ids))})", ids)}
+        finally:
+            pool.devolver(db)
+
+        # Alertas entretanto pausados ou apagados já não se enviam
+        mensagens, cancelados = [], []
+        for e in lote:
+            a = alertas.get(e['alerta_id'])
+            if not a or not a['ativo']:
+                cancelados.append((e['id'],))
+                continue
+            mensagens.append({'id': e['id'], 'destino': e['destino'],
+                              'assunto': f"Alerta Nampula: {a['titulo']}",
+                              'texto': mensagem_alerta(a, gw.canal)})
+
+        falhas = {}
+        if mensagens:
+            gw.limite.esperar(len(mensagens))
+            try:
+                falhas = gw.enviar(mensagens)
+            except Exception as e:
+                falhas = {m['id']: f'{type(e).__name__}: {e}' for m in mensagens}
+
+        agora, enviados, repetir, desistir = now_cat(), [], [], []
+        for e in lote:
+            erro = falhas.get(e['id'])
+            if (e['id'],) in cancelados:
+                continue
+            if erro is None:
+                enviados.append((agora, e['id']))
+            elif e['tentativas'] >= self.TENTATIVAS_MAX:
+                desistir.append((str(erro)[:200], e['id']))
+            else:
+                espera = self.ESPERA_BASE_S * 2 ** (e['tentativas'] - 1)
+                repetir.append((str(erro)[:200], _daqui(espera), e['id']))
+
+        def gravar(db):
+            db.executemany("UPDATE envio SET estado='enviado', enviado=?, erro=NULL WHERE id=?", enviados)
+            db.executemany("UPDATE envio SET estado='pendente', erro=?, proxima=? WHERE id=?", repetir)
+            db.executemany("UPDATE envio SET estado='falhado', erro=? WHERE id=?", desistir)
+            db.executemany("UPDATE envio SET estado='cancelado' WHERE id=?", cancelados)
+        pool.transacao(gravar)
+
+        m = self.metricas
+        m['lotes'] += 1
+        m['enviados'] += len(enviados)
+        m['falhas'] += len(repetir)
+        m['desistencias'] += len(desistir)
+        m['cancelados'] += len(cancelados)
+
+despachante = Despachante()
+atexit.register(despachante.parar)
+
+@app.before_request
+def _arrancar_despachante():
+    # Retoma difusões pendentes (ex. depois de um reinício) sem esperar por um alerta novo
+    despachante.iniciar()
+
+@app.route('/api/difusao')
+@login_required
+def estado_difusao():
+    # Backlog e ritmo por canal (todos os workers, lidos da BD) e estimativa
+    # do tempo para chegar a 100 mil pessoas ao ritmo actual / ao máximo configurado
+    canais = {}
+    for r in query("SELECT canal, estado, COUNT(*) n FROM envio GROUP BY canal, estado"):
+        canais.setdefault(r['canal'], {})[r['estado']] = r['n']
+    # `+canal` impede o SQLite de preferir idx_envio_fila (percorre a tabela toda)
+    minuto = _daqui(-60)
+    ritmos = {r['canal']: r['n'] for r in query(
+        "SELECT canal, COUNT(*) n FROM envio WHERE enviado >= ? GROUP BY +canal", (minuto,))}
+    for canal in set(despachante.gateways) | set(ritmos):
+        canais.setdefault(canal, {})
+
+    for canal, c in canais.items():
+        gw = despachante.gateways.get(canal)
+        ritmo = ritmos.get(canal, 0) / 60
+        backlog = c.get('pendente', 0) + c.get('enviando', 0)
+        c.update({
+            'backlog': backlog,
+            'por_segundo': round(ritmo, 2),
+            'gateway': gw.nome if gw else None,
+            'taxa_max': gw.taxa if gw else None,
+            'fim_estimado_s': round(backlog / ritmo) if ritmo else None,
+            'para_100k_s': round(100000 / ritmo) if ritmo else None,
+            'para_100k_max_s': round(100000 / gw.taxa) if gw else None,
+        })
+
+    difusoes = [dict(d) for d in query(
+        "SELECT d.alerta_id, d.estado, d.mensagens, d.criado, d.expandido, a.titulo "
+        "FROM difusao d LEFT JOIN alerta a ON a.id = d.alerta_id "
+        "ORDER BY d.alerta_id DESC LIMIT 10")]
+    for d in difusoes:
+        d['envios'] = {r['estado']: r['n'] for r in query(
+            "SELECT estado, COUNT(*) n FROM envio WHERE alerta_id=? GROUP BY estado", (d['alerta_id'],))}
+
+    return jsonify({
+        'canais': canais,
+        'backlog': sum(c['backlog'] for c in canais.values()),
+        'difusoes': difusoes,
+        'worker': dict(despachante.metricas, pid=os.getpid()),
+    })
+
+@app.route('/api/audiencia')
+@login_required
+def audiencia():
+    # Subscritores por (tipo, canal); com ?tipo=&categoria= de um alerta,
+    # quantos o recebem em cada canal
+    matriz = {}
+    for r in query("SELECT tipo, canal, n FROM audiencia WHERE n > 0"):
+        matriz.setdefault(r['tipo'], {})[r['canal']] = r['n']
+    res = {'matriz': matriz}
+    if request.args.get('tipo'):
+        cats = sorted(categorias_alerta({k: request.args.get(k, '') for k in ('tipo', 'categoria')}))
+        if len(cats) == 1:
+            canais = dict(matriz.get(cats[0], {}))
+        else:
+            canais = {r['canal']: r['n'] for r in query(
+                "SELECT canal, COUNT(DISTINCT subscricao_id) n FROM subscricao_alvo "
+                "WHERE tipo IN (SELECT value FROM json_each(?)) GROUP BY canal", (json.dumps(cats),))}
+        res['alerta'] = {'categorias': cats, 'canais': canais, 'mensagens': sum(canais.values())}
+    return jsonify(res)
+
+
+# ═══════════════════════════════════════════════════════════════
+#  PLANOS DE CONSULTA — flask --app app planos [--verificar]
+#  Regista o EXPLAIN QUERY PLAN de todas as consultas deste ficheiro
+#  em planos_consulta.txt; --verificar falha se alguma passar a fazer
+#  um SCAN completo que não estava no registo.
+# ═══════════════════════════════════════════════════════════════
+
+PLANOS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'planos_consulta.txt')
+
+def _consultas_da_app():
+    import ast
+    from werkzeug.datastructures import MultiDict
+    with open(__file__, encoding='utf-8') as f:
+        arvore = ast.parse(f.read())
+    sqls = []
+    for no in ast.walk(arvore):
+        if not isinstance(no, ast.Call) or not no.args:
+            continue
+        nome = getattr(no.func, 'id', None) or getattr(no.func, 'attr', None)
+        arg = no.args[0]
+        if nome in ('query', 'execute', 'executemany', 'escrever', 'inserir') and isinstance(arg, ast.Constant) \
+                and isinstance(arg.value, str) \
+                and arg.value.lstrip().split(' ', 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+            sqls.append(' '.join(arg.value.split()))
+    # Consultas montadas em tempo de execução
+    for tabela, sql in _FILTRO_PUBLICO.values():
+        sqls.append(sql.format('?'))
+    sqls.append(SQL_SERIE.format('?,?'))
+    for nome, (tabela, filtros, por_data) in TABELAS_ADMIN.items():
+        variantes = [{}, {'cursor': '2025-01-01 00:00:00|1'}]
+        variantes += [{campo: 'x'} for campo in filtros]
+        if por_data:
+            variantes.append({'desde': '2025-01-01', 'ate': '2025-01-31'})
+        for args in variantes:
+            sqls.append(_sql_pagina(nome, MultiDict(args), 50)[0])
+            if tabela in ARQUIVO:
+                sqls.append(_sql_pagina(nome, MultiDict(args), 50, f'arquivo_{tabela}')[0])
+    return list(dict.fromkeys(sqls))
+
+def planos_actuais():
+    with tempfile.TemporaryDirectory() as pasta:
+        db = sqlite3.connect(os.path.join(pasta, 'planos.db'))
+        migrar(db)
+        planos = {}
+        for sql in _consultas_da_app():
+            try:
+                linhas = db.execute('EXPLAIN QUERY PLAN ' + sql, (None,) * sql.count('?')).fetchall()
+                planos[sql] = [r[3] for r in linhas]
+            except sqlite3.Error as e:
+                planos[sql] = [f'ERRO: {e}']
+        db.close()
+    return planos
+
+def _scans_completos(plano):
+    # "SCAN tabela" sem índice; "SCAN t USING INDEX ..." percorre um índice
+    return {l.split()[1] for l in plano
+            if l.startswith('SCAN ') and 'USING' not in l and 'CONSTANT ROW' not in l
+            and 'VIRTUAL TABLE' not in l}
+
+def _ler_planos(caminho):
+    planos, sql = {}, None
+    with open(caminho, encoding='utf-8') as f:
+        for linha in f:
+            linha = linha.rstrip('\n')
+            if linha.startswith('    '):
+                planos[sql].append(linha.strip())
+            elif linha:
+                sql = linha
+                planos[sql] = []
+    return planos
+
+@app.cli.command('planos')
+@click.option('--verificar', is_flag=True, help='Comparar com planos_consulta.txt em vez de o reescrever.')
+def comando_planos(verificar):
+    """EXPLAIN QUERY PLAN de todas as consultas da aplicação."""
+    planos = planos_actuais()
+    if not verificar:
+        with open(PLANOS_FILE, 'w', encoding='utf-8') as f:
+            for sql, plano in planos.items():
+                f.write(sql + '\n' + ''.join(f'    {l}\n' for l in plano) + '\n')
+        click.echo(f'{len(planos)} consultas registadas em {os.path.basename(PLANOS_FILE)}')
+        return
+    registados = _ler_planos(PLANOS_FILE)
+    regressoes = []
+    for sql, plano in planos.items():
+        novos = _scans_completos(plano) - _scans_completos(registados.get(sql, []))
+        erros = [l for l in plano if l.startswith('ERRO')]
+        if novos or erros:
+            regressoes.append((sql, sorted(novos), erros))
+    for sql, novos, erros in regressoes:
+        click.echo(f'✗ {sql}\n    SCAN completo: {", ".join(novos)} {" ".join(erros)}')
+    if regressoes:
+        raise SystemExit(1)
+    click.echo(f'✔ {len(planos)} consultas sem novos SCAN completos')
+
 
 # ═══════════════════════════════════════════════════════════════
 #  ARRANQUE CORRECTO PARA RENDER
@@ -0,0 +1,366 @@
+/* ===== TABS ===== */
+const tabMeta = {
+  'dashboard':    {label:'Dashboard',          icon:'fas fa-gauge-high'},
+  'tab-alertas':  {label:'Gestão de Alertas',  icon:'fas fa-bell'},
+  'tab-familias': {label:'Famílias Afectadas', icon:'fas fa-house-chimney-crack'},
+  'tab-zonas':    {label:'Zonas Seguras',       icon:'fas fa-shield-halved'},
+  'tab-apoios':   {label:'Apoios Recebidos',    icon:'fas fa-hand-holding-heart'},
+  'tab-subs':     {label:'Subscritores',        icon:'fas fa-satellite-dish'},
+  'tab-ussd':     {label:'Pedidos USSD',        icon:'fas fa-mobile-alt'},
+  'tab-admins':   {label:'Administradores',     icon:'fas fa-user-shield'},
+  'tab-config':   {label:'Configurações',       icon:'fas fa-sliders'}
+};
+
+function switchTab(id) {
+  document.querySelectorAll('.tab-pane').forEach(p => p.classList.remove('active'));
+  document.querySelectorAll('.tb-btn, .sbi[data-tab]').forEach(b => b.classList.remove('active'));
+  const pane = document.getElementById(id);
+  if (pane) pane.classList.add('active');
+  document.querySelectorAll(`[data-tab="${id}"]`).forEach(b => b.classList.add('active'));
+  const m = tabMeta[id] || tabMeta['dashboard'];
+  document.getElementById('pageTitle').innerHTML = `<i class="${m.icon}"></i> ${m.label}`;
+  history.replaceState(null, '', '#' + id);
+  closeSidebar();
+  (SEPARADOR_LISTAS[id] || []).forEach(nome => { if (!listas[nome].carregada) carregarLista(nome, true); });
+  if (id === 'tab-subs') matrizAudiencia();
+  if (id === 'tab-alertas') audienciaAlerta();
+  if (id === 'tab-familias') { zonasFamilia(); sugestaoZona(); }
+}
+
+/* ===== LISTAS PAGINADAS (carregadas a pedido por separador) ===== */
+function esc(v) {
+  return String(v ?? '').replace(/[&<>"']/g, m => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#039;'}[m]));
+}
+function fmtData(d)     { return d ? `${d.slice(8,10)}/${d.slice(5,7)}/${d.slice(0,4)}` : ''; }
+function fmtDataHora(d) { return d ? `${fmtData(d)} ${d.slice(11,16)}` : ''; }
+function corta(t, n)    { t = t || ''; return esc(t.slice(0, n)) + (t.length > n ? '...' : ''); }
+
+const SEPARADOR_LISTAS = {
+  'tab-alertas':  ['alertas'],
+  'tab-familias': ['familias'],
+  'tab-zonas':    ['zonas'],
+  'tab-apoios':   ['apoios'],
+  'tab-subs':     ['subscricoes'],
+  'tab-ussd':     ['pedidos', 'voluntarios']
+};
+
+const listas = {
+  alertas: { cols: 5, vazio: '<i class="fas fa-bell-slash"></i>Nenhum alerta publicado', linha: a => `
+    <tr>
+      <td><strong style="color:#fff">${esc(a.titulo)}</strong><br><span style="font-size:.78rem;color:var(--muted)">${esc(a.conteudo.slice(0,60))}...</span></td>
+      <td><span class="badge b-${esc(a.tipo)}">${esc(a.tipo)}</span></td>
+      <td style="color:var(--muted);font-size:.82rem">${fmtDataHora(a.data)}</td>
+      <td><span class="badge ${a.ativo ? 'b-on' : 'b-off'}">${a.ativo ? 'Activo' : 'Pausado'}</span></td>
+      <td><div class="acts">
+        <a href="/admin/alerta/editar/${a.id}" class="act-btn teal" title="Editar"><i class="fas fa-pencil"></i></a>
+        <a href="/admin/alerta/toggle/${a.id}" class="act-btn warn" title="${a.ativo ? 'Pausar' : 'Activar'}"><i class="fas fa-toggle-${a.ativo ? 'on' : 'off'}"></i></a>
+        <a href="/admin/alerta/delete/${a.id}" class="act-btn danger" onclick="return confirm('Eliminar alerta?')"><i class="fas fa-trash"></i></a>
+      </div></td>
+    </tr>` },
+  familias: { cols: 7, vazio: '<i class="fas fa-house"></i>Nenhuma família', linha: f => `
+    <tr>
+      <td><strong style="color:#fff">${esc(f.bairro)}</strong></td>
+      <td><strong style="color:var(--cyan)">${f.numero}</strong></td>
+      <td>${esc(f.situacao)}</td>
+      <td style="color:var(--muted)">${esc(f.abrigo)}</td>
+      <td style="color:var(--muted);font-size:.82rem">${corta(f.necessidades, 50)}</td>
+      <td style="color:var(--muted);font-size:.78rem">${fmtData(f.data)}</td>
+      <td><div class="acts">
+        <a href="/admin/familia/editar/${f.id}" class="act-btn teal" title="Editar"><i class="fas fa-pencil"></i></a>
+        <a href="/admin/familia/delete/${f.id}" class="act-btn danger" onclick="return confirm('Eliminar?')"><i class="fas fa-trash"></i></a>
+      </div></td>
+    </tr>` },
+  zonas: { cols: 5, vazio: '<i class="fas fa-shield-halved"></i>Nenhuma zona', linha: z => `
+    <tr>
+      <td><strong style="color:#fff">${esc(z.nome)}</strong></td>
+      <td><strong style="color:${z.ocupacao >= z.capacidade ? 'var(--red)' : 'var(--emerald)'}">${z.ocupacao}/${z.capacidade}</strong> pessoas</td>
+      <td style="color:var(--muted)">${corta(z.recursos, 70)}</td>
+      <td><span class="badge ${z.ativa ? 'b-on' : 'b-off'}">${z.ativa ? 'Activa' : 'Inactiva'}</span></td>
+      <td><div class="acts">
+        <a href="/admin/zona/editar/${z.id}" class="act-btn teal" title="Editar"><i class="fas fa-pencil"></i></a>
+        <a href="/admin/zona/toggle/${z.id}" class="act-btn warn" title="${z.ativa ? 'Desactivar' : 'Activar'}"><i class="fas fa-toggle-${z.ativa ? 'on' : 'off'}"></i></a>
+        <a href="/admin/zona/delete/${z.id}" class="act-btn danger" onclick="return confirm('Eliminar zona?')"><i class="fas fa-trash"></i></a>
+      </div></td>
+    </tr>` },
+  apoios: { cols: 7, vazio: '<i class="fas fa-inbox"></i>Nenhum apoio recebido', linha: a => {
+    const st = a.status || 'pendente';
+    return `
+    <tr>
+      <td><strong style="color:#fff">${esc(a.tipo)}</strong></td>
+      <td>${esc(a.quantidade)}</td>
+      <td style="color:var(--muted)">${esc(a.local_entrega)}</td>
+      <td style="color:var(--cyan)">${esc(a.contacto)}</td>
+      <td style="color:var(--muted);font-size:.8rem">${fmtDataHora(a.data)}</td>
+      <td><span class="badge b-${esc(st)}">${esc(st)}</span></td>
+      <td><div class="acts">
+        ${st === 'pendente' ? `
+        <a href="/admin/apoio/confirmar/${a.id}" class="act-btn green" title="Confirmar apoio"><i class="fas fa-check"></i></a>
+        <a href="/admin/apoio/recusar/${a.id}" class="act-btn danger" title="Recusar apoio" onclick="return confirm('Recusar este apoio?')"><i class="fas fa-times"></i></a>` : ''}
+        <a href="/admin/apoio/delete/${a.id}" class="act-btn danger" title="Eliminar" onclick="return confirm('Eliminar apoio?')"><i class="fas fa-trash"></i></a>
+      </div></td>
+    </tr>`; } },
+  subscricoes: { cols: 6, vazio: '<i class="fas fa-bell-slash"></i>Nenhuma subscrição', linha: s => `
+    <tr>
+      <td><strong style="color:#fff">${esc(s.nome)}</strong></td>
+      <td style="color:var(--cyan)">${esc(s.telefone)}</td>
+      <td style="color:var(--muted)">${esc(s.email) || '—'}</td>
+      <td>${esc(s.metodos)}</td>
+      <td style="color:var(--muted);font-size:.8rem">${esc(s.tipo_alertas)}</td>
+      <td style="color:var(--muted);font-size:.78rem">${fmtData(s.data)}</td>
+    </tr>` },
+  pedidos: { cols: 7, vazio: '<i class="fas fa-inbox"></i> Nenhum pedido USSD recebido', linha: p => {
+    const opc = [['pendente','⏳ Pendente'],['em curso','🔄 Em curso'],['concluido','✅ Concluído'],['cancelado','❌ Cancelado']]
+      .map(([v, t]) => `<option value="${v}"${p.status === v ? ' selected' : ''}>${t}</option>`).join('');
+    return `
+    <tr>
+      <td><strong style="color:var(--cyan)">#${p.id}</strong></td>
+      <td style="color:var(--text)">${esc(p.telefone)}</td>
+      <td><span class="badge b-${esc(p.tipo)}">${esc(p.tipo.charAt(0).toUpperCase() + p.tipo.slice(1))}</span></td>
+      <td style="color:var(--muted);max-width:250px">${esc(p.descricao)}</td>
+      <td style="color:var(--muted);font-size:.8rem">${fmtDataHora(p.data)}</td>
+      <td><span class="badge b-${esc(p.status)}">${esc(p.status)}</span></td>
+      <td>
+        <div class="acts">
+          <form method="POST" action="/admin/ussd_pedido/status/${p.id}" style="display:inline">
+            <select name="status" class="status-select" onchange="this.form.submit()">${opc}</select>
+          </form>
+          <a href="/admin/ussd_pedido/delete/${p.id}" class="act-btn danger" onclick="return confirm('Eliminar pedido #${p.id}?')" title="Eliminar">
+            <i class="fas fa-trash"></i>
+          </a>
+        </div>
+      </td>
+    </tr>`; } },
+  voluntarios: { cols: 4, vazio: '<i class="fas fa-users-slash"></i> Nenhum voluntário registado', linha: v => `
+    <tr>
+      <td><strong style="color:#fff">${esc(v.nome)}</strong></td>
+      <td style="color:var(--cyan)">${esc(v.telefone)}</td>
+      <td style="color:var(--muted)">${esc(v.habilidades) || 'Não especificado'}</td>
+      <td style="color:var(--muted);font-size:.8rem">${fmtDataHora(v.data)}</td>
+    </tr>` }
+};
+
+function carregarLista(nome, reiniciar) {
+  const L = listas[nome];
+  const tbody = document.getElementById('lista-' + nome);
+  const mais  = document.getElementById('mais-' + nome);
+  if (!tbody || L.aCarregar) return;
+  if (reiniciar) { L.cursor = null; tbody.innerHTML = ''; }
+  const form = document.querySelector(`.filtros[data-lista="${nome}"]`);
+  const params = new URLSearchParams(form ? new FormData(form) : undefined);
+  if (L.cursor) params.set('cursor', L.cursor);
+  L.aCarregar = true;
+  fetch(`/api/admin/${nome}?${params}`)
+    .then(r => r.json())
+    .then(d => {
+      L.carregada = true;
+      L.cursor = d.proximo;
+      if (reiniciar && d.itens.length === 0) {
+        tbody.innerHTML = `<tr class="empty"><td colspan="${L.cols}">${L.vazio}</td></tr>`;
+      } else {
+        tbody.insertAdjacentHTML('beforeend', d.itens.map(L.linha).join(''));
+      }
+      mais.style.display = d.proximo ? '' : 'none';
+    })
+    .catch(err => console.error('Erro ao carregar ' + nome + ':', err))
+    .finally(() => { L.aCarregar = false; });
+}
+
+Object.keys(listas).forEach(nome => {
+  const mais = document.getElementById('mais-' + nome);
+  if (mais) mais.addEventListener('click', () => carregarLista(nome, false));
+  const form = document.querySelector(`.filtros[data-lista="${nome}"]`);
+  if (form) form.addEventListener('submit', e => { e.preventDefault(); carregarLista(nome, true); });
+});
+
+/* ===== EXPORTAÇÃO / IMPORTAÇÃO ===== */
+document.querySelectorAll('[data-exportar]').forEach(b => b.addEventListener('click', () => {
+  const form = b.closest('form');
+  const params = new URLSearchParams(new FormData(form));
+  params.set('formato', 'csv');
+  window.location = `/api/exportar/${form.dataset.lista}?${params}`;
+}));
+
+const formImportar = document.getElementById('form-importar');
+if (formImportar) formImportar.addEventListener('submit', e => {
+  e.preventDefault();
+  const out = document.getElementById('resultado-importar');
+  out.textContent = 'A importar…';
+  fetch('/api/importar/familias', {method: 'POST', body: new FormData(formImportar)})
+    .then(r => r.json())
+    .then(d => {
+      if (d.msg) { out.innerHTML = `<p style="color:var(--red)">${esc(d.msg)}</p>`; return; }
+      out.innerHTML = `<p>${d.validas} linhas válidas, ${d.inseridas} inseridas, ${d.total_erros} com erros.</p>` +
+        d.erros.map(x => `<div style="color:var(--muted);font-size:.8rem">Linha ${x.linha}: ${esc(x.erro)}</div>`).join('');
+      if (d.inseridas) carregarLista('familias', true);
+    })
+    .catch(err => { out.textContent = ''; console.error('Erro ao importar:', err); });
+});
+
+/* ===== AUDIÊNCIA (índice subscricao_alvo) ===== */
+const CANAIS = [['sms', 'SMS'], ['whatsapp', 'WhatsApp'], ['email', 'Email']];
+
+function matrizAudiencia() {
+  fetch('/api/audiencia').then(r => r.json()).then(d => {
+    const tipos = Object.keys(d.matriz).sort();
+    document.getElementById('matriz-audiencia').innerHTML = tipos.length
+      ? tipos.map(t => `<tr><td><strong style="color:#fff">${esc(t)}</strong></td>` +
+          CANAIS.map(([c]) => `<td>${d.matriz[t][c] || 0}</td>`).join('') + '</tr>').join('')
+      : '<tr class="empty"><td colspan="4"><i class="fas fa-bell-slash"></i>Nenhuma subscrição</td></tr>';
+  }).catch(err => console.error('Erro ao carregar audiência:', err));
+}
+
+let audienciaTimer = null;
+function audienciaAlerta() {
+  const form = document.getElementById('form-alerta');
+  const alvo = document.getElementById('audiencia-alerta');
+  if (!form || !alvo) return;
+  clearTimeout(audienciaTimer);
+  audienciaTimer = setTimeout(() => {
+    const params = new URLSearchParams(new FormData(form));
+    fetch('/api/audiencia?' + params).then(r => r.json()).then(d => {
+      const a = d.alerta;
+      alvo.innerHTML = a.categorias.length
+        ? '<i class="fas fa-bullseye"></i> Vai notificar: ' +
+          CANAIS.map(([c, nome]) => `<strong>${a.canais[c] || 0}</strong> ${nome}`).join(' · ') +
+          ` <span>(${a.categorias.map(esc).join(', ')})</span>`
+        : '<i class="fas fa-bullseye"></i> Nenhum subscritor corresponde a este alerta.';
+    }).catch(err => console.error('Erro ao calcular audiência:', err));
+  }, 300);
+}
+document.getElementById('form-alerta')?.addEventListener('input', audienciaAlerta);
+
+/* ===== ALOCAÇÃO (zona sugerida para a família) ===== */
+function zonasFamilia() {
+  fetch('/api/ocupacao').then(r => r.json()).then(d => {
+    const sel = document.getElementById('zona-familia');
+    sel.querySelectorAll('option[data-zona]').forEach(o => o.remove());
+    d.zonas.forEach(z => sel.insertAdjacentHTML('beforeend',
+      `<option value="${z.id}" data-zona>${esc(z.nome)} — ${z.vagas} vagas</option>`));
+  }).catch(err => console.error('Erro ao carregar zonas:', err));
+}
+
+let sugestaoTimer = null;
+function sugestaoZona() {
+  const form = document.getElementById('form-familia');
+  const alvo = document.getElementById('sugestao-zona');
+  clearTimeout(sugestaoTimer);
+  if (form.zona_id.value !== 'auto' || !form.numero.value) { alvo.innerHTML = ''; return; }
+  sugestaoTimer = setTimeout(() => {
+    const params = new URLSearchParams({bairro: form.bairro.value, pessoas: form.numero.value});
+    fetch('/api/alocacao/sugestao?' + params).then(r => r.json()).then(zonas => {
+      alvo.innerHTML = zonas.length
+        ? '<i class="fas fa-location-dot"></i> Vai para: ' + zonas.map((z, i) =>
+            `${i ? '' : '<strong>'}${esc(z.nome)}${i ? '' : '</strong>'} (${z.vagas} vagas${z.distancia_km != null ? ', ' + z.distancia_km + ' km' : ''})`).join(' · alternativas: ')
+        : '<i class="fas fa-triangle-exclamation"></i> Nenhuma zona tem vagas para este grupo.';
+    }).catch(err => console.error('Erro ao sugerir zona:', err));
+  }, 300);
+}
+document.getElementById('form-familia')?.addEventListener('input', sugestaoZona);
+
+document.querySelectorAll('[data-tab]').forEach(el => {
+  el.addEventListener('click', function(e) { e.preventDefault(); switchTab(this.dataset.tab); });
+});
+
+// Server sets the active tab after redirect
+const serverTab = document.body.dataset.tab || '';
+const hash = location.hash.replace('#', '');
+const startTab = (hash && document.getElementById(hash)) ? hash
+               : (serverTab && serverTab !== 'dashboard' && document.getElementById(serverTab)) ? serverTab
+               : null;
+if (startTab) switchTab(startTab);
+
+/* ===== SIDEBAR ===== */
+const mobTog   = document.getElementById('mobTog');
+const mobIcon  = document.getElementById('mobTogIcon');
+const sb       = document.getElementById('sb');
+const backdrop = document.getElementById('sbBackdrop');
+
+function openSidebar() {
+  sb.classList.add('open');
+  backdrop.classList.add('show');
+  mobIcon.className = 'fas fa-times';
+  mobTog.classList.add('open');
+  mobTog.setAttribute('aria-expanded','true');
+  document.body.style.overflow = 'hidden';
+}
+function closeSidebar() {
+  sb.classList.remove('open');
+  backdrop.classList.remove('show');
+  mobIcon.className = 'fas fa-bars';
+  mobTog.classList.remove('open');
+  mobTog.setAttribute('aria-expanded','false');
+  document.body.style.overflow = '';
+}
+
+mobTog.addEventListener('click', function(e) {
+  e.stopPropagation();
+  sb.classList.contains('open') ? closeSidebar() : openSidebar();
+});
+backdrop.addEventListener('click', closeSidebar);
+document.addEventListener('keydown', e => {
+  if (e.key === 'Escape') { closeSidebar(); closeModal(); closeNotif(); }
+});
+
+/* ===== NOTIFICATIONS ===== */
+function toggleNotif(e) {
+  e.stopPropagation();
+  document.getElementById('notifDrop').classList.toggle('show');
+}
+function closeNotif() {
+  document.getElementById('notifDrop').classList.remove('show');
+}
+function markAllRead() {
+  document.querySelectorAll('.notif-item.unread').forEach(i => i.classList.remove('unread'));
+  const dot = document.querySelector('.notif-dot');
+  if (dot) dot.remove();
+  closeNotif();
+}
+/* ===== PESQUISA (/api/search) ===== */
+const BUSCA_ICONE = {
+  alertas:     ['familia', 'fas fa-triangle-exclamation'],
+  familias:    ['familia', 'fas fa-house-chimney-crack'],
+  pedidos:     ['ussd',    'fas fa-mobile-alt'],
+  voluntarios: ['apoio',   'fas fa-people-carry-box']
+};
+let buscaTimer = null;
+function pesquisar(pagina) {
+  const q = document.getElementById('buscaInput').value.trim();
+  const drop = document.getElementById('buscaDrop');
+  clearTimeout(buscaTimer);
+  if (!q) { drop.classList.remove('show'); return; }
+  buscaTimer = setTimeout(() => {
+    fetch('/api/search?' + new URLSearchParams({q, pagina})).then(r => r.json()).then(d => {
+      if (d.q !== document.getElementById('buscaInput').value.trim()) return;
+      const lista = document.getElementById('buscaLista');
+      const linhas = (d.itens || []).map(i => {
+        const [cls, ico] = BUSCA_ICONE[i.tipo];
+        // trecho já vem escapado pelo servidor, só com <mark>
+        return `<div class="notif-item" onclick="switchTab('${i.separador}');fecharBusca()">` +
+          `<div class="notif-ico ${cls}"><i class="${ico}"></i></div>` +
+          `<div class="notif-txt"><div class="notif-ttl">${esc(i.titulo)}</div><div class="notif-sub">${i.trecho}</div></div>` +
+          `<div class="notif-time">${fmtData(i.data)}</div></div>`;
+      }).join('');
+      const mais = d.tem_mais ? `<div class="notif-empty"><button class="notif-mark" onclick="event.stopPropagation();pesquisar(${d.pagina + 1})">Mais resultados</button></div>` : '';
+      lista.innerHTML = d.pagina > 1 ? lista.innerHTML.replace(/<div class="notif-empty">.*$/s, '') + linhas + mais
+                      : (linhas || '<div class="notif-empty">Nenhum resultado</div>') + mais;
+      document.getElementById('buscaInfo').textContent =
+        `${d.total}${d.total_exacto ? '' : '+'} · ${d.ordem === 'recentes' ? 'mais recentes' : 'por relevância'} · ${d.ms} ms`;
+      drop.classList.add('show');
+    }).catch(err => console.error('Erro na pesquisa:', err));
+  }, pagina > 1 ? 0 : 250);
+}
+function fecharBusca() {
+  document.getElementById('buscaDrop').classList.remove('show');
+}
+document.getElementById('buscaInput').addEventListener('input', () => pesquisar(1));
+document.getElementById('buscaInput').addEventListener('focus', () => pesquisar(1));
+
+document.addEventListener('click', function(e) {
+  const busca = document.getElementById('buscaDrop');
+  if (busca.classList.contains('show') && !busca.contains(e.target) && e.target.id !== 'buscaInput') fecharBusca();
+  const drop = document.getElementById('notifDrop');
+  const btn  = document.getElementById('notifBtn');
+  if (drop && drop.classList.contains('show') && !drop.contains(e.target) && e.target !== btn && !btn.contains(e.target)) {
+    closeNotif();
+  }
+});
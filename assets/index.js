@@ -0,0 +1,497 @@
+/* ===== HEADER SCROLL ===== */
+const hdr = document.getElementById('hdr');
+const btt = document.getElementById('btt');
+window.addEventListener('scroll', () => {
+  hdr.classList.toggle('scrolled', window.scrollY > 40);
+  btt.classList.toggle('show', window.scrollY > 400);
+}, { passive: true });
+
+/* ===== MOBILE NAV ===== */
+const ham = document.getElementById('ham');
+const mobileNav = document.getElementById('mobile-nav');
+const navClose = document.getElementById('nav-close');
+
+const hamIcon = ham.querySelector('i');
+ham.onclick = () => {
+  const open = mobileNav.classList.toggle('open');
+  ham.setAttribute('aria-expanded', open);
+  hamIcon.className = open ? 'fas fa-times' : 'fas fa-bars';
+  document.body.style.overflow = open ? 'hidden' : '';
+};
+navClose.onclick = closeNav;
+function closeNav() {
+  mobileNav.classList.remove('open');
+  ham.setAttribute('aria-expanded', 'false');
+  hamIcon.className = 'fas fa-bars';
+  document.body.style.overflow = '';
+}
+// Close on backdrop click
+mobileNav.addEventListener('click', e => { if (e.target === mobileNav) closeNav(); });
+// ESC key
+document.addEventListener('keydown', e => { if (e.key === 'Escape') { closeNav(); accDropdown.classList.remove('open'); } });
+
+/* ===== ACCESSIBILITY DROPDOWN ===== */
+const accTrigger = document.getElementById('acc-trigger');
+const accDropdown = document.getElementById('acc-dropdown');
+accTrigger.onclick = (e) => {
+  e.stopPropagation();
+  const open = accDropdown.classList.toggle('open');
+  accTrigger.setAttribute('aria-expanded', open);
+};
+document.addEventListener('click', e => {
+  if (!accTrigger.contains(e.target) && !accDropdown.contains(e.target)) {
+    accDropdown.classList.remove('open');
+    accTrigger.setAttribute('aria-expanded', 'false');
+  }
+});
+
+/* ===== COUNTER ANIMATION ===== */
+const counters = document.querySelectorAll('.stat-num[data-target]');
+const io = new IntersectionObserver(entries => {
+  entries.forEach(entry => {
+    if (!entry.isIntersecting) return;
+    const el = entry.target;
+    const target = +el.dataset.target;
+    let startTs = null;
+    const animate = ts => {
+      if (!startTs) startTs = ts;
+      const p = Math.min((ts - startTs) / 1800, 1);
+      const eased = p < 0.5 ? 2 * p * p : -1 + (4 - 2 * p) * p;
+      el.textContent = Math.floor(eased * target).toLocaleString('pt-PT');
+      if (p < 1) requestAnimationFrame(animate);
+      else el.textContent = target.toLocaleString('pt-PT');
+    };
+    requestAnimationFrame(animate);
+    io.unobserve(el);
+  });
+}, { threshold: 0.4 });
+counters.forEach(c => io.observe(c));
+
+/* ===== BACK TO TOP ===== */
+btt.onclick = () => window.scrollTo({ top: 0, behavior: 'smooth' });
+
+/* ===== VALIDAÇÃO E ENVIO DOS FORMULÁRIOS (SEM RECARREGAR) ===== */
+function showMessage(elementId, message, isError = false) {
+  const container = document.getElementById(elementId);
+  const msgSpan = container.querySelector('span');
+  msgSpan.textContent = message;
+  container.classList.add('show');
+  if (isError) {
+    // Esconder mensagem de sucesso se estiver visível
+    const okId = elementId.replace('err', 'ok');
+    const okEl = document.getElementById(okId);
+    if (okEl) okEl.classList.remove('show');
+  } else {
+    const errId = elementId.replace('ok', 'err');
+    const errEl = document.getElementById(errId);
+    if (errEl) errEl.classList.remove('show');
+  }
+  // Auto-esconder após 6 segundos
+  setTimeout(() => container.classList.remove('show'), 6000);
+}
+
+// Formulário de Apoio
+document.getElementById('form-apoio').addEventListener('submit', async (e) => {
+  e.preventDefault();
+  const form = e.target;
+  const tipo = document.getElementById('tipo_apoio').value;
+  const quantidade = document.getElementById('quantidade').value.trim();
+  const local = document.getElementById('local_entrega').value;
+  let contacto = document.getElementById('contacto_apoio').value.trim();
+
+  // Limpar mensagens anteriores
+  document.getElementById('apoio-err').classList.remove('show');
+  document.getElementById('apoio-ok').classList.remove('show');
+
+  // Validações básicas
+  if (!tipo) {
+    showMessage('apoio-err', 'Seleccione o tipo de apoio.', true);
+    return;
+  }
+  if (!quantidade) {
+    showMessage('apoio-err', 'Descreva a quantidade ou detalhes do apoio.', true);
+    return;
+  }
+  if (!local) {
+    showMessage('apoio-err', 'Seleccione o local de entrega.', true);
+    return;
+  }
+  if (!contacto) {
+    showMessage('apoio-err', 'Informe o seu contacto.', true);
+    return;
+  }
+
+  // Validação do telefone (formato moçambicano)
+  contacto = contacto.replace(/\s+/g, ''); // remove espaços
+  if (!/^\d{9}$/.test(contacto)) {
+    showMessage('apoio-err', 'O contacto deve ter exatamente 9 dígitos.', true);
+    return;
+  }
+  const prefix = contacto.substring(0, 2);
+  const prefixosValidos = ['86', '87', '84', '85', '82', '83'];
+  if (!prefixosValidos.includes(prefix)) {
+    showMessage('apoio-err', 'O número deve começar com 86, 87, 84, 85, 82 ou 83.', true);
+    return;
+  }
+  // Adicionar código do país
+  contacto = '+258' + contacto;
+
+  const btn = form.querySelector('button[type=submit]');
+  const orig = btn.innerHTML;
+  btn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> A enviar…';
+  btn.disabled = true;
+
+  try {
+    const formData = new FormData(form);
+    // Substituir o campo contacto pelo valor completo com +258
+    formData.set('contacto', contacto);
+
+    const response = await fetch('/apoio', {
+      method: 'POST',
+      body: formData
+    });
+    const data = await response.json();
+
+    if (data.ok) {
+      showMessage('apoio-ok', data.msg || 'Apoio registado com sucesso! Obrigado.');
+      form.reset();
+      // Limpar o campo contacto (o reset não limpa o input com valor fixo)
+      document.getElementById('contacto_apoio').value = '';
+    } else {
+      showMessage('apoio-err', data.msg || 'Erro ao registar apoio.', true);
+    }
+  } catch (error) {
+    showMessage('apoio-err', 'Erro de ligação. Tente novamente.', true);
+  } finally {
+    btn.innerHTML = orig;
+    btn.disabled = false;
+  }
+});
+
+// Formulário de Subscrição (Notificações)
+document.getElementById('form-sub').addEventListener('submit', async (e) => {
+  e.preventDefault();
+  const form = e.target;
+  const nome = document.getElementById('sub-nome').value.trim();
+  const telefoneInput = document.getElementById('sub-tel');
+  let telefone = telefoneInput.value.trim().replace(/\s+/g, ''); // remove espaços
+  const email = document.getElementById('sub-email').value.trim();
+  const canais = document.querySelectorAll('input[name="notificacoes[]"]:checked');
+  const tipos = document.querySelectorAll('input[name="tipo_alertas[]"]:checked');
+  const consentimento = document.querySelector('input[type="checkbox"]:required').checked;
+
+  // Limpar mensagens
+  document.getElementById('sub-err').classList.remove('show');
+  document.getElementById('sub-ok').classList.remove('show');
+
+  // Validações
+  if (!nome) {
+    showMessage('sub-err', 'Preencha o seu nome.', true);
+    return;
+  }
+
+  // Validação do telefone
+  if (!telefone) {
+    showMessage('sub-err', 'Informe o número de telemóvel.', true);
+    return;
+  }
+  if (!/^\d{9}$/.test(telefone)) {
+    showMessage('sub-err', 'O telemóvel deve ter exatamente 9 dígitos.', true);
+    return;
+  }
+  const prefix = telefone.substring(0, 2);
+  const prefixosValidos = ['86', '87', '84', '85', '82', '83'];
+  if (!prefixosValidos.includes(prefix)) {
+    showMessage('sub-err', 'O número deve começar com 86, 87, 84, 85, 82 ou 83.', true);
+    return;
+  }
+  // Adicionar o código do país
+  telefone = '+258' + telefone;
+
+  // Se email foi preenchido, validação simples
+  if (email && !/^\S+@\S+\.\S+$/.test(email)) {
+    showMessage('sub-err', 'E-mail inválido.', true);
+    return;
+  }
+
+  if (canais.length === 0) {
+    showMessage('sub-err', 'Seleccione pelo menos um canal de notificação.', true);
+    return;
+  }
+  if (tipos.length === 0) {
+    showMessage('sub-err', 'Seleccione pelo menos um tipo de alerta.', true);
+    return;
+  }
+  if (!consentimento) {
+    showMessage('sub-err', 'É necessário concordar com o consentimento.', true);
+    return;
+  }
+
+  const btn = form.querySelector('button[type=submit]');
+  const orig = btn.innerHTML;
+  btn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> A activar…';
+  btn.disabled = true;
+
+  try {
+    // Criar FormData e substituir o telefone pelo valor completo
+    const formData = new FormData(form);
+    formData.set('telefone', telefone); // agora tem +258XXXX...
+
+    const response = await fetch('/subscricao', {
+      method: 'POST',
+      body: formData
+    });
+    const data = await response.json();
+
+    if (data.ok) {
+      showMessage('sub-ok', data.msg || 'Notificações activadas com sucesso!');
+      form.reset();
+      // Limpar campo telefone (o reset não limpa o input com valor fixo do span)
+      telefoneInput.value = '';
+    } else {
+      showMessage('sub-err', data.msg || 'Erro ao activar notificações.', true);
+    }
+  } catch (error) {
+    showMessage('sub-err', 'Erro de ligação. Tente novamente.', true);
+  } finally {
+    btn.innerHTML = orig;
+    btn.disabled = false;
+  }
+});
+
+/* ===== NOVA FUNÇÃO: TEMPO REAL (POLLING) ===== */
+function escapeHtml(unsafe) {
+  return unsafe.replace(/[&<>"']/g, function(m) {
+    if(m === '&') return '&amp;';
+    if(m === '<') return '&lt;';
+    if(m === '>') return '&gt;';
+    if(m === '"') return '&quot;';
+    if(m === "'") return '&#039;';
+    return m;
+  });
+}
+
+function atualizarInterface(dados) {
+  // 1. Atualizar grelha de alertas
+  const alertsGrid = document.getElementById('alerts-grid');
+  if (alertsGrid) {
+    if (dados.alertas.length === 0) {
+      alertsGrid.innerHTML = '<div class="empty-state"><i class="fas fa-bell-slash" aria-hidden="true"></i><p>Nenhum alerta activo no momento.</p></div>';
+    } else {
+      alertsGrid.innerHTML = dados.alertas.map(a => `
+        <article class="alert-card ${a.tipo}" role="listitem">
+          <div class="alert-badge badge-${a.tipo}" role="img" aria-label="Tipo: ${a.tipo}">
+            <i class="fas fa-${a.tipo === 'urgente' ? 'circle-exclamation' : (a.tipo === 'atencao' ? 'bell' : 'circle-info')}" aria-hidden="true"></i>
+            ${a.tipo.toUpperCase()}
+          </div>
+          <div class="alert-title">${escapeHtml(a.titulo)}</div>
+          <div class="alert-date">
+            <i class="fas fa-calendar-days" aria-hidden="true"></i>
+            <time>${new Date(a.data).toLocaleString('pt-PT', {day:'2-digit', month:'2-digit', year:'numeric', hour:'2-digit', minute:'2-digit'})}</time>
+          </div>
+          <div class="alert-text">${escapeHtml(a.conteudo)}</div>
+        </article>
+      `).join('');
+    }
+  }
+
+  // 2. Atualizar lista de famílias
+  const familiasContainer = document.getElementById('familias-container');
+  if (familiasContainer) {
+    if (dados.familias.length === 0) {
+      familiasContainer.innerHTML = '<p style="color:var(--t3);font-size:.85rem;text-align:center;padding:20px">Nenhuma família registada.</p>';
+    } else {
+      familiasContainer.innerHTML = dados.familias.map(f => `
+        <div class="fam-row">
+          <h4>${escapeHtml(f.bairro)}</h4>
+          <p><i class="fas fa-users" aria-hidden="true"></i> <strong style="color:var(--t1)">${f.numero} famílias</strong> — ${escapeHtml(f.situacao)}</p>
+          <p><i class="fas fa-location-dot" aria-hidden="true"></i> ${escapeHtml(f.abrigo)}</p>
+          <p><i class="fas fa-circle-exclamation" aria-hidden="true"></i> ${escapeHtml(f.necessidades)}</p>
+        </div>
+      `).join('');
+    }
+  }
+
+  // 3. Atualizar lista de zonas
+  const zonasContainer = document.getElementById('zonas-container');
+  if (zonasContainer) {
+    if (dados.zonas.length === 0) {
+      zonasContainer.innerHTML = '<p style="color:var(--t3);font-size:.85rem;text-align:center;padding:20px">Nenhuma zona registada.</p>';
+    } else {
+      zonasContainer.innerHTML = dados.zonas.map(z => `
+        <div class="zona-row">
+          <div>
+            <div class="zona-name">${escapeHtml(z.nome)}</div>
+            <div class="zona-res">${escapeHtml(z.recursos)}</div>
+          </div>
+          <span class="zona-cap"><i class="fas fa-users" aria-hidden="true"></i> ${z.capacidade}</span>
+        </div>
+      `).join('');
+    }
+  }
+
+  // 4. Atualizar números das estatísticas na stats-bar (usando data-target)
+  document.querySelectorAll('.stat-num[data-target]').forEach(el => {
+    const target = el.getAttribute('data-target');
+    if (target === 'alertas') el.textContent = dados.stats.alertas.toLocaleString('pt-PT');
+    else if (target === 'familias') el.textContent = dados.stats.familias.toLocaleString('pt-PT');
+    else if (target === 'zonas') el.textContent = dados.stats.zonas.toLocaleString('pt-PT');
+    else if (target === 'subscricoes') el.textContent = dados.stats.subscricoes.toLocaleString('pt-PT');
+  });
+
+  // 5. Atualizar ticker (se houver)
+  const tickerTrack = document.querySelector('.ticker-track');
+  if (tickerTrack) {
+    if (dados.alertas.length > 0) {
+      // Duplica os alertas para criar efeito contínuo
+      const alertsDuplicated = [...dados.alertas, ...dados.alertas];
+      tickerTrack.innerHTML = alertsDuplicated.map(a => `
+        <span class="t-item">
+          <span class="t-sep"></span>
+          <strong>${a.tipo.toUpperCase()}</strong>&nbsp;—&nbsp;${escapeHtml(a.titulo)}: ${escapeHtml(a.conteudo.substring(0,60))}…
+        </span>
+      `).join('');
+    } else {
+      tickerTrack.innerHTML = ''; // esconde se não houver alertas
+    }
+  }
+}
+
+function buscarDados() {
+  fetch('/api/dados_publicos')
+    .then(response => response.json())
+    .then(data => atualizarInterface(data))
+    .catch(err => console.error('Erro ao buscar dados:', err));
+}
+
+/* ===== TEMPO REAL (SSE) com recurso a polling ===== */
+let estado = null;      // { versao, alertas: Map, familias: Map, zonas: Map, stats }
+let pollingTimer = null;
+
+// Em polling só se pedem as alterações desde a última versão conhecida
+function buscarAlteracoes() {
+  if (!estado) {
+    return fetch('/api/dados_publicos')
+      .then(r => r.json())
+      .then(d => aplicarSnapshot(d, d.versao))
+      .catch(err => console.error('Erro ao buscar dados:', err));
+  }
+  fetch('/api/dados_publicos?since=' + estado.versao)
+    .then(r => r.json())
+    .then(d => Array.isArray(d.alertas) ? aplicarSnapshot(d, d.versao) : aplicarDelta(d))
+    .catch(err => console.error('Erro ao buscar dados:', err));
+}
+
+function iniciarPolling() {
+  if (pollingTimer) return;
+  buscarAlteracoes();
+  pollingTimer = setInterval(buscarAlteracoes, 3000);
+}
+
+function porData(a, b) { return (b.data || '').localeCompare(a.data || '') || b.id - a.id; }
+
+function estadoParaDados() {
+  return {
+    alertas:  [...estado.alertas.values()].sort(porData),
+    familias: [...estado.familias.values()].sort(porData),
+    zonas:    [...estado.zonas.values()].sort((a, b) => a.id - b.id),
+    stats:    estado.stats
+  };
+}
+
+function aplicarSnapshot(dados, versao) {
+  const mapa = lista => new Map(lista.map(r => [r.id, r]));
+  estado = { versao: versao, alertas: mapa(dados.alertas), familias: mapa(dados.familias),
+             zonas: mapa(dados.zonas), stats: dados.stats };
+  atualizarInterface(dados);
+}
+
+function aplicarDelta(delta) {
+  if (!estado || delta.versao <= estado.versao) return;
+  ['alertas', 'familias', 'zonas'].forEach(chave => {
+    const d = delta[chave];
+    if (!d) return;
+    d.remove.forEach(id => estado[chave].delete(id));
+    d.upsert.forEach(r => estado[chave].set(r.id, r));
+  });
+  if (delta.stats) estado.stats = delta.stats;
+  estado.versao = delta.versao;
+  atualizarInterface(estadoParaDados());
+}
+
+function iniciarTempoReal() {
+  if (typeof EventSource === 'undefined') return iniciarPolling();
+  const es = new EventSource('/api/stream');
+  let falhas = 0;
+  es.addEventListener('snapshot', e => { falhas = 0; aplicarSnapshot(JSON.parse(e.data), +e.lastEventId); });
+  es.addEventListener('delta', e => { falhas = 0; aplicarDelta(JSON.parse(e.data)); });
+  es.onerror = () => {
+    // O EventSource volta a ligar sozinho; após falhas seguidas passa a polling
+    if (es.readyState === EventSource.CLOSED || ++falhas >= 3) {
+      es.close();
+      iniciarPolling();
+    }
+  };
+}
+
+document.addEventListener('DOMContentLoaded', iniciarTempoReal);
+
+/* ===== ACCESSIBILITY FUNCTIONS ===== */
+let fontSize = 16;
+const synth = window.speechSynthesis;
+let audioOn = false;
+
+function setAccBtns(ids, on) {
+  ids.forEach(id => {
+    const el = document.getElementById(id);
+    if (el) el.classList.toggle('on', on);
+  });
+}
+
+function toggleHC() {
+  const on = document.body.classList.toggle('hc');
+  setAccBtns(['acc-hc', 'mob-hc'], on);
+  try { localStorage.setItem('acc_hc', on ? '1' : '0'); } catch {}
+}
+function toggleLM() {
+  const on = document.body.classList.toggle('light-mode');
+  setAccBtns(['acc-lm', 'mob-lm'], on);
+  try { localStorage.setItem('acc_lm', on ? '1' : '0'); } catch {}
+}
+function toggleAudio() {
+  if (synth.speaking) {
+    synth.cancel(); audioOn = false;
+    setAccBtns(['acc-audio', 'mob-audio'], false);
+    return;
+  }
+  const mainText = document.querySelector('main')?.innerText?.substring(0, 4000) || '';
+  audioOn = true;
+  setAccBtns(['acc-audio', 'mob-audio'], true);
+  const u = new SpeechSynthesisUtterance(mainText);
+  u.lang = 'pt-PT'; u.rate = 0.9;
+  u.onend = () => { audioOn = false; setAccBtns(['acc-audio', 'mob-audio'], false); };
+  synth.speak(u);
+}
+function toggleFont() {
+  fontSize = fontSize >= 26 ? 14 : fontSize + 2;
+  document.documentElement.style.setProperty('--fs', fontSize + 'px');
+  document.documentElement.style.fontSize = fontSize + 'px';
+  try { localStorage.setItem('acc_fs', fontSize); } catch {}
+}
+function toggleDys() {
+  const isDys = document.body.style.fontFamily.includes('Comic');
+  document.body.style.fontFamily = isDys ? '' : "'Comic Sans MS', cursive";
+  setAccBtns(['acc-dys', 'mob-dys'], !isDys);
+  try { localStorage.setItem('acc_dys', isDys ? '0' : '1'); } catch {}
+}
+
+/* Restore saved preferences */
+(function applyPrefs() {
+  try {
+    if (localStorage.getItem('acc_hc') === '1') { document.body.classList.add('hc'); setAccBtns(['acc-hc','mob-hc'], true); }
+    if (localStorage.getItem('acc_lm') === '1') { document.body.classList.add('light-mode'); setAccBtns(['acc-lm','mob-lm'], true); }
+    if (localStorage.getItem('acc_dys') === '1') { document.body.style.fontFamily = "'Comic Sans MS', cursive"; setAccBtns(['acc-dys','mob-dys'], true); }
+    const fs = localStorage.getItem('acc_fs');
+    if (fs) { fontSize = +fs; document.documentElement.style.fontSize = fontSize + 'px'; }
+  } catch {}
+})();
@@ -0,0 +1,279 @@
+# Benchmark de carga do /ussd.
+#
+# Reproduz sessões ao estilo Africa's Talking (sessionId, phoneNumber e o
+# `text` acumulado a cada passo) por toda a árvore de menus, incluindo os
+# caminhos que gravam pedidos e voluntários. Cada worker é um processo com o
+# seu próprio pool SQLite e fila de escrita (como no gunicorn), todos sobre a
+# mesma cópia da BD, por isso a contenção de locks é a real.
+#
+#   python bench_ussd.py                       # 1, 2 e 4 workers, compara com a base
+#   python bench_ussd.py --workers 1,4,8 --duracao 20
+#   python bench_ussd.py --gravar              # actualiza bench_ussd_base.json
+#   python bench_ussd.py --verificar           # falha se o p95 piorar além da tolerância
+#   python bench_ussd.py --url https://.../ussd   # contra um servidor já a correr
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+AQUI = os.path.dirname(os.path.abspath(__file__))
+BASE_FILE = os.path.join(AQUI, 'bench_ussd_base.json')
+
+NOMES = ['Ana Muhala', 'Carlos Napipine', 'Fátima Momade', 'José Muatala', 'Rosa Namicopo']
+HABILIDADES = ['médico', 'motorista', 'enfermeira', 'pedreiro', '']
+
+
+def _voluntario(r):
+    nome = r.choice(NOMES)
+    return ['', '5', '5*1', f'5*1*{nome}', f'5*1*{nome}*{r.choice(HABILIDADES)}']
+
+
+# (peso, passos) — cada passo é o `text` completo enviado pelo gateway
+CENARIOS = [
+    (20, lambda r: ['', '1', f'1*{r.randint(1, 3)}']),
+    (8,  lambda r: ['', '1', '1*0']),
+    (15, lambda r: ['', '2', f'2*{r.choice("12")}']),
+    (6,  lambda r: ['', '3', '3*1']),
+    (10, lambda r: ['', '3', '3*2', f'3*2*{r.randint(1, 40)}']),
+    (6,  lambda r: ['', '3', '3*3', f'3*3*{r.randint(1, 40)}']),
+    (4,  lambda r: ['', '3', '3*4', '3*4*paracetamol']),
+    (12, lambda r: ['', '4', f'4*{r.choice("123")}']),
+    (6,  _voluntario),
+    (3,  lambda r: ['', '5', '5*2']),
+    (7,  lambda r: ['', '0', f'0*{r.choice("134")}']),
+    (3,  lambda r: ['', '0', '0*2']),
+]
+
+
+def sessao(r):
+    return r.choices([c for _, c in CENARIOS], weights=[p for p, _ in CENARIOS])[0](r)
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    k = min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))
+    return valores[k]
+
+
+def _correr(enviar, concorrencia, duracao, semente):
+    # Corre sessões em `concorrencia` threads até acabar o tempo. Um pedido
+    # recusado pela admissão acaba a sessão (como no telemóvel) e fica fora
+    # da latência e das sessões/s: conta-se à parte.
+    lat, erros, sessoes, recusados = [], [0], [0], [0]
+    lock = threading.Lock()
+    fim = time.perf_counter() + duracao
+
+    def cliente(i):
+        r = random.Random(semente * 1000 + i)
+        minhas, meus_erros, meus_recusados, n, tentadas = [], 0, 0, 0, 0
+        while time.perf_counter() < fim:
+            sid = f'bench-{semente}-{i}-{tentadas}'
+            tel = f'+25884{r.randint(0, 9999999):07d}'
+            tentadas += 1
+            for text in sessao(r):
+                t = time.perf_counter()
+                try:
+                    estado = enviar(sid, tel, text)
+                except Exception:
+                    estado = 'erro'
+                if estado == 'recusado':
+                    meus_recusados += 1
+                    break
+                minhas.append((time.perf_counter() - t) * 1000)
+                meus_erros += estado == 'erro'
+            else:
+                n += 1
+        with lock:
+            lat.extend(minhas)
+            erros[0] += meus_erros
+            sessoes[0] += n
+            recusados[0] += meus_recusados
+
+    ts = [threading.Thread(target=cliente, args=(i,)) for i in range(concorrencia)]
+    [t.start() for t in ts]
+    [t.join() for t in ts]
+    return lat, erros[0], sessoes[0], recusados[0]
+
+
+def _estado(status, corpo):
+    # 'ok', 'recusado' (ecrã de sobrecarga da admissão) ou 'erro'
+    if status != 200:
+        return 'erro'
+    if 'Serviço sobrecarregado' in corpo:
+        return 'recusado'
+    return 'ok' if corpo.startswith(('CON ', 'END ')) and 'Erro' not in corpo else 'erro'
+
+
+def _worker(indice, concorrencia, duracao, pronto, partida, saida):
+    # ALERTA_DB já aponta para a cópia temporária (herdado do processo pai)
+    import app as A
+    cliente = A.app.test_client()
+
+    def enviar(sid, tel, text):
+        r = cliente.post('/ussd', data={'sessionId': sid, 'phoneNumber': tel,
+                                        'serviceCode': '*384#', 'text': text})
+        return _estado(r.status_code, r.get_data(as_text=True))
+
+    pronto.put(indice)
+    partida.wait()
+    lat, erros, sessoes, recusados = _correr(enviar, concorrencia, duracao, indice + 1)
+    A.fila_escrita.parar()
+    saida.put({'lat': lat, 'erros': erros, 'sessoes': sessoes, 'recusados': recusados,
+               'pool': A.pool.estado(), 'fila': dict(A.fila_escrita.metricas)})
+
+
+def resumir(lat, erros, sessoes, recusados, duracao, limite_ms):
+    lat.sort()
+    return {
+        'pedidos': len(lat),
+        'sessoes': sessoes,
+        'pedidos_s': round(len(lat) / duracao, 1),
+        'sessoes_s': round(sessoes / duracao, 1),
+        'p50_ms': round(percentil(lat, 50), 2),
+        'p95_ms': round(percentil(lat, 95), 2),
+        'p99_ms': round(percentil(lat, 99), 2),
+        'max_ms': round(lat[-1] if lat else 0.0, 2),
+        'acima_limite': sum(1 for x in lat if x > limite_ms),
+        'erros': erros,
+        'recusados': recusados,
+    }
+
+
+def medir_local(workers, concorrencia, duracao, limite_ms, origem):
+    with tempfile.TemporaryDirectory() as pasta:
+        db = os.path.join(pasta, 'alerta.db')
+        if os.path.exists(origem):
+            shutil.copy(origem, db)
+        os.environ['ALERTA_DB'] = db
+        ctx = mp.get_context('spawn')
+        pronto, saida, partida = ctx.Queue(), ctx.Queue(), ctx.Event()
+        procs = [ctx.Process(target=_worker, args=(i, concorrencia, duracao, pronto, partida, saida))
+                 for i in range(workers)]
+        # O primeiro worker corre as migrações sozinho; os outros arrancam depois
+        procs[0].start()
+        pronto.get()
+        [p.start() for p in procs[1:]]
+        [pronto.get() for _ in procs[1:]]
+        partida.set()
+        partes = [saida.get() for _ in procs]
+        [p.join() for p in procs]
+
+    lat = [x for p in partes for x in p['lat']]
+    res = resumir(lat, sum(p['erros'] for p in partes), sum(p['sessoes'] for p in partes),
+                  sum(p['recusados'] for p in partes), duracao, limite_ms)
+    res['sqlite'] = {
+        'busy_retries': sum(p['pool']['busy_retries'] for p in partes),
+        'busy_falhas': sum(p['pool']['busy_falhas'] for p in partes),
+        'espera_escrita_ms': round(sum(p['pool']['escrita_espera_s'] for p in partes) * 1000, 1),
+        'escritas': sum(p['pool']['escritas'] for p in partes),
+        'lotes': sum(p['fila']['lotes'] for p in partes),
+        'linhas': sum(p['fila']['linhas'] for p in partes),
+        'maior_lote': max(p['fila']['maior_lote'] for p in partes),
+    }
+    return res
+
+
+def medir_url(url, concorrencia, duracao, limite_ms):
+    def enviar(sid, tel, text):
+        dados = urllib.parse.urlencode({'sessionId': sid, 'phoneNumber': tel,
+                                        'serviceCode': '*384#', 'text': text}).encode()
+        with urllib.request.urlopen(url, dados, timeout=30) as r:
+            return _estado(r.status, r.read().decode('utf-8'))
+
+    lat, erros, sessoes, recusados = _correr(enviar, concorrencia, duracao, 1)
+    return resumir(lat, erros, sessoes, recusados, duracao, limite_ms)
+
+
+def imprimir(resultados, base):
+    print(f'{"workers":>8} {"sess/s":>8} {"ped/s":>8} {"p50":>8} {"p95":>8} {"p99":>8} '
+          f'{"max":>8} {">lim":>5} {"erros":>5} {"recus":>5} {"busy":>5} {"esp.esc":>8}')
+    for chave, r in resultados.items():
+        s = r.get('sqlite', {})
+        print(f'{chave:>8} {r["sessoes_s"]:>8} {r["pedidos_s"]:>8} {r["p50_ms"]:>8} '
+              f'{r["p95_ms"]:>8} {r["p99_ms"]:>8} {r["max_ms"]:>8} {r["acima_limite"]:>5} '
+              f'{r["erros"]:>5} {r["recusados"]:>5} {s.get("busy_retries", "-"):>5} {s.get("espera_escrita_ms", "-"):>8}')
+        ref = (base or {}).get(chave)
+        if ref:
+            print(f'{"base":>8} {ref["sessoes_s"]:>8} {ref["pedidos_s"]:>8} {ref["p50_ms"]:>8} '
+                  f'{ref["p95_ms"]:>8} {ref["p99_ms"]:>8}')
+
+
+def regressoes(resultados, base, tolerancia):
+    falhas = []
+    for chave, r in resultados.items():
+        ref = (base or {}).get(chave)
+        if not ref:
+            continue
+        if r['p95_ms'] > ref['p95_ms'] * (1 + tolerancia):
+            falhas.append(f'{chave} workers: p95 {r["p95_ms"]} ms (base {ref["p95_ms"]} ms)')
+        if r['pedidos_s'] < ref['pedidos_s'] * (1 - tolerancia):
+            falhas.append(f'{chave} workers: {r["pedidos_s"]} ped/s (base {ref["pedidos_s"]})')
+        if r['erros'] > ref['erros']:
+            falhas.append(f'{chave} workers: {r["erros"]} erros (base {ref["erros"]})')
+        if r['recusados'] > ref.get('recusados', 0):
+            falhas.append(f'{chave} workers: {r["recusados"]} recusados pela admissão '
+                          f'(base {ref.get("recusados", 0)})')
+    return falhas
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark de carga do /ussd')
+    ap.add_argument('--workers', default='1,2,4', help='números de workers a medir (ex: 1,2,4)')
+    ap.add_argument('--concorrencia', type=int, default=8, help='sessões simultâneas por worker')
+    ap.add_argument('--duracao', type=float, default=10, help='segundos por medição')
+    ap.add_argument('--limite-ms', type=float, default=2000,
+                    help='respostas acima deste tempo contam como perdidas pelo gateway')
+    ap.add_argument('--db', default=os.path.join(AQUI, 'alerta.db'), help='BD de origem (é copiada)')
+    ap.add_argument('--url', help='medir um servidor já a correr em vez da app local')
+    ap.add_argument('--gravar', action='store_true', help='gravar os resultados como nova base')
+    ap.add_argument('--verificar', action='store_true', help='sair com erro se houver regressão')
+    ap.add_argument('--tolerancia', type=float, default=0.5, help='piora admitida face à base (0.5 = 50%%)')
+    args = ap.parse_args()
+
+    if args.url:
+        resultados = {'url': medir_url(args.url, args.concorrencia, args.duracao, args.limite_ms)}
+    else:
+        resultados = {}
+        for w in [int(x) for x in args.workers.split(',') if x.strip()]:
+            print(f'… {w} worker(s), {args.concorrencia} sessões cada, {args.duracao:g}s', flush=True)
+            resultados[str(w)] = medir_local(w, args.concorrencia, args.duracao, args.limite_ms, args.db)
+
+    base = None
+    if os.path.exists(BASE_FILE):
+        with open(BASE_FILE, encoding='utf-8') as f:
+            base = json.load(f).get('resultados')
+    imprimir(resultados, None if args.gravar else base)
+
+    if args.gravar:
+        with open(BASE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({
+                'data': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'maquina': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                            'cpus': os.cpu_count(), 'sistema': platform.platform()},
+                'parametros': {'concorrencia': args.concorrencia, 'duracao': args.duracao,
+                               'limite_ms': args.limite_ms},
+                'resultados': resultados,
+            }, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f'✔ Base gravada em {os.path.basename(BASE_FILE)}')
+        return
+
+    falhas = regressoes(resultados, base, args.tolerancia)
+    for f in falhas:
+        print(f'✘ {f}')
+    if args.verificar and falhas:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
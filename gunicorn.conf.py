@@ -0,0 +1,26 @@
+# Configuração do Gunicorn (lida automaticamente a partir da raiz do projecto).
+# Workers gthread, não gevent: as chamadas sqlite3 não cedem ao gevent, por
+# isso um commit lento da FilaEscrita, do Difusor ou do Despachante parava
+# todos os greenlets do worker. Com threads a sério só espera quem precisa.
+# Cada cliente de /api/stream ocupa uma thread enquanto está ligado: metade
+# das threads, no máximo (SSE_MAX); os seguintes recebem 503 e fazem polling.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+# Ligações SQLite de leitura por worker: cada pedido prende uma até ao fim
+# (get_db), mas os clientes SSE não (1 por 4 threads, entre 4 e 32)
+os.environ.setdefault('DB_LEITORES', str(max(4, min(32, threads // 4))))
+os.environ.setdefault('SSE_MAX', str(threads // 2))
+timeout = 60
+graceful_timeout = 20
+keepalive = 5
+
+
+def worker_exit(server, worker):
+    # Grava as inserções USSD ainda na fila antes de o worker sair
+    from app import fila_escrita, despachante
+    fila_escrita.parar()
+    despachante.parar()
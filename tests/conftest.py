@@ -0,0 +1,54 @@
+# Os testes correm sobre uma cópia de alerta.db numa pasta temporária:
+# ALERTA_DB tem de estar definida antes do primeiro `import app`, que migra
+# a BD e arranca as threads de fundo.
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BD_ORIGINAL = os.path.join(RAIZ, 'alerta.db')
+
+_pasta = tempfile.mkdtemp(prefix='alerta-testes-')
+os.environ['ALERTA_DB'] = os.path.join(_pasta, 'alerta.db')
+os.environ.setdefault('BACKUP_DIR', os.path.join(_pasta, 'backups'))
+shutil.copy(BD_ORIGINAL, os.environ['ALERTA_DB'])
+sys.path.insert(0, RAIZ)
+
+import app as A  # noqa: E402
+
+
+@pytest.fixture
+def cliente():
+    return A.app.test_client()
+
+
+@pytest.fixture
+def admin():
+    c = A.app.test_client()
+    adm = A.pool.emprestar()
+    try:
+        linha = adm.execute("SELECT id, nome, nivel FROM admin WHERE nivel='master' LIMIT 1").fetchone()
+    finally:
+        A.pool.devolver(adm)
+    with c.session_transaction() as s:
+        s['admin_id'], s['admin_nome'], s['admin_nivel'] = linha['id'], linha['nome'], linha['nivel']
+    return c
+
+
+def escrever(sql, args=()):
+    # Escrita directa (com os triggers), fora do registo de alterações
+    with A.pool.escrita() as db:
+        cur = db.execute(sql, args)
+        db.commit()
+        return cur.lastrowid
+
+
+def ler(sql, args=()):
+    db = A.pool.emprestar()
+    try:
+        return db.execute(sql, args).fetchall()
+    finally:
+        A.pool.devolver(db)
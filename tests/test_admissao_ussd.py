@@ -0,0 +1,62 @@
+from conftest import A, ler
+
+
+def _admissao():
+    # Balde global de 20 fichas (10/s); as fichas de cada telefone quase não voltam
+    return A.AdmissaoUSSD(taxa=10, taxa_telefone=0.01, rajada_telefone=2,
+                          reserva_vida=0.2, reserva_escrita=0.2)
+
+
+def _esgotar(adm, ate):
+    # Pedidos de telefones diferentes até o balde global ficar abaixo de `ate`
+    n = 0
+    while adm.global_.nivel() >= ate:
+        assert adm.admitir('vida', f'84{n:07d}')
+        n += 1
+
+
+def test_sem_carga_o_mesmo_telefone_passa_da_rajada():
+    adm = _admissao()
+    assert all(adm.admitir('leitura', '840000001') for _ in range(5))
+    assert adm.metricas['leitura'] == {'admitidos': 5, 'recusados': 0, 'da_cache': 0}
+
+
+def test_sob_carga_recusa_o_telefone_sem_fichas():
+    adm = _admissao()
+    assert adm.admitir('leitura', '840000001') and adm.admitir('leitura', '840000001')
+    _esgotar(adm, adm.global_.rajada / 2)
+    assert not adm.admitir('leitura', '840000001')
+    assert adm.admitir('leitura', '840000002')
+
+
+def test_recusa_nao_gasta_fichas_do_telefone():
+    adm = _admissao()
+    _esgotar(adm, 1)
+    assert not adm.admitir('escrita', '840000003')
+    assert adm._balde('840000003').nivel() == 2
+
+
+def test_reservas_por_classe():
+    adm = _admissao()
+    # Acima da reserva da escrita (20%) mas abaixo da da leitura (40%)
+    _esgotar(adm, 7)
+    assert not adm.admitir('leitura', '840000004')
+    assert adm.admitir('escrita', '840000004')
+    _esgotar(adm, 1)
+    assert not adm.admitir('escrita', '840000005')
+    assert adm.admitir('vida', '840000005')
+
+
+def test_ussd_sobrecarregado(cliente, monkeypatch):
+    adm = _admissao()
+    _esgotar(adm, 1)
+    monkeypatch.setattr(A, 'admissao', adm)
+    form = {'sessionId': 's1', 'phoneNumber': '840000006'}
+    r = cliente.post('/ussd', data=dict(form, text='3*2*5'))
+    assert r.get_data(as_text=True) == A.SOBRECARGA_USSD
+    # O resgate (classe vida) passa sempre e fica gravado
+    antes = ler("SELECT COUNT(*) FROM ussd_pedido WHERE telefone='840000006'")[0][0]
+    r = cliente.post('/ussd', data=dict(form, text='3*1'))
+    assert r.get_data(as_text=True).startswith('END')
+    assert r.get_data(as_text=True) != A.SOBRECARGA_USSD
+    assert ler("SELECT COUNT(*) FROM ussd_pedido WHERE telefone='840000006'")[0][0] == antes + 1
@@ -0,0 +1,56 @@
+from conftest import A
+
+
+def _delta(desde):
+    with A.app.app_context():
+        return A.delta_desde(desde)
+
+
+def _novo_alerta(titulo):
+    return A.escrever_alteracao("INSERT INTO alerta(titulo, tipo, conteudo, data) VALUES(?,?,?,?)",
+                                (titulo, 'informativo', 'teste', A.now_cat()), 'alerta')
+
+
+def test_delta_traz_linhas_novas_e_alteradas():
+    desde = A.versao_dados()
+    _novo_alerta('Delta novo')
+    delta = _delta(desde)
+    assert delta['versao'] == A.versao_dados() > desde
+    assert [a['titulo'] for a in delta['alertas']['upsert']] == ['Delta novo']
+    assert delta['alertas']['remove'] == []
+    assert _delta(delta['versao']) == {'versao': delta['versao']}
+
+
+def test_delta_traz_linhas_eliminadas(admin):
+    rid = _novo_alerta('Delta eliminado')
+    fid = A.escrever_alteracao("INSERT INTO familia(bairro, numero, situacao, abrigo, necessidades, data) "
+                               "VALUES(?,?,?,?,?,?)", ('Muhala', 3, 'Inundações', '', '', A.now_cat()), 'familia')
+    desde = A.versao_dados()
+    admin.get(f'/admin/alerta/delete/{rid}')
+    admin.get(f'/admin/familia/delete/{fid}')
+    delta = _delta(desde)
+    assert delta['alertas'] == {'upsert': [], 'remove': [rid]}
+    assert delta['familias'] == {'upsert': [], 'remove': [fid]}
+
+
+def test_delta_trata_alerta_desactivado_como_removido(admin):
+    rid = _novo_alerta('Delta desactivado')
+    desde = A.versao_dados()
+    admin.get(f'/admin/alerta/toggle/{rid}')
+    assert _delta(desde)['alertas'] == {'upsert': [], 'remove': [rid]}
+    desde = A.versao_dados()
+    admin.get(f'/admin/alerta/toggle/{rid}')
+    assert [a['id'] for a in _delta(desde)['alertas']['upsert']] == [rid]
+
+
+def test_marcar_alteracao_sem_ids_devolve_a_versao_actual():
+    versao = A.versao_dados()
+    assert A.pool.transacao(lambda db: A.marcar_alteracao(db, 'familia', [])) == versao
+    assert A.versao_dados() == versao
+
+
+def test_delta_pede_snapshot_depois_de_um_reload():
+    desde = A.versao_dados()
+    A.publicar_versao(A.pool.transacao(lambda db: A.marcar_alteracao(db, 'configuracao', [0], 'reload')))
+    assert _delta(desde) is None
+    assert _delta(A.versao_dados() + 5) is None
@@ -0,0 +1,60 @@
+import sqlite3
+import threading
+
+import pytest
+
+from conftest import A, ler
+
+SQL = "INSERT INTO ussd_pedido(telefone, tipo, descricao, data) VALUES(?,?,?,?)"
+
+
+def test_inserts_concorrentes_saem_em_lotes_com_ids_proprios():
+    fila = A.FilaEscrita()
+    ids = [None] * 20
+
+    def inserir(i):
+        ids[i] = fila.inserir(SQL, ('841000001', 'agua', f'lote {i}', A.now_cat()))
+
+    threads = [threading.Thread(target=inserir, args=(i,)) for i in range(len(ids))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    fila.parar()
+    assert len(set(ids)) == len(ids)
+    linhas = dict(ler(f"SELECT id, descricao FROM ussd_pedido WHERE id IN ({','.join('?' * len(ids))})", ids))
+    assert [linhas[rid] for rid in ids] == [f'lote {i}' for i in range(len(ids))]
+    assert fila.metricas['linhas'] == len(ids) and fila.metricas['lotes'] < len(ids)
+
+
+def test_erro_numa_linha_nao_anula_o_lote():
+    fila = A.FilaEscrita()
+    resultado = {}
+
+    def inserir(chave, telefone):
+        try:
+            resultado[chave] = fila.inserir(SQL, (telefone, 'agua', chave, A.now_cat()))
+        except sqlite3.IntegrityError as e:
+            resultado[chave] = e
+
+    threads = [threading.Thread(target=inserir, args=('sem telefone', None)),
+               threading.Thread(target=inserir, args=('com telefone', '841000002'))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    fila.parar()
+    assert isinstance(resultado['sem telefone'], sqlite3.IntegrityError)
+    assert ler("SELECT descricao FROM ussd_pedido WHERE id=?", (resultado['com telefone'],))[0][0] == 'com telefone'
+
+
+def test_pedido_que_desiste_na_fila_nao_fica_gravado():
+    fila = A.FilaEscrita()
+    fila.ESPERA_MAX_S = 0.2
+    # Com a escrita ocupada o lote não começa antes de o pedido desistir
+    with A.pool.escrita():
+        with pytest.raises(TimeoutError):
+            fila.inserir(SQL, ('841000003', 'agua', 'desistiu', A.now_cat()))
+    fila.parar()
+    assert fila.metricas['canceladas'] == 1
+    assert not ler("SELECT 1 FROM ussd_pedido WHERE descricao='desistiu'")
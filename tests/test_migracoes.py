@@ -0,0 +1,47 @@
+import shutil
+import sqlite3
+
+import pytest
+
+from conftest import A, BD_ORIGINAL
+
+
+def _contadores(db):
+    return (sorted(map(tuple, db.execute("SELECT chave, valor FROM contador"))),
+            sorted(map(tuple, db.execute("SELECT chave, hora, valor FROM contador_hora"))))
+
+
+def test_bd_v0_migra_ate_a_ultima_versao_com_contadores_certos(tmp_path):
+    copia = tmp_path / 'alerta.db'
+    shutil.copy(BD_ORIGINAL, copia)
+    db = sqlite3.connect(copia)
+    if db.execute("PRAGMA user_version").fetchone()[0] != 0:
+        pytest.skip('alerta.db do repositório já foi migrada')
+    familias, pessoas = db.execute("SELECT COUNT(*), SUM(numero) FROM familia").fetchone()
+
+    with A.app.app_context():
+        versao = A.migrar(db)
+
+    assert versao == A.MIGRACOES[-1][0]
+    assert db.execute("PRAGMA user_version").fetchone()[0] == versao
+    contadores = _contadores(db)
+    totais = dict(contadores[0])
+    assert set(totais) == {chave for conts in A.CONTADORES.values() for chave, _ in conts}
+    assert totais['familias'] == familias
+    assert totais['familias_total'] == pessoas
+    # Os triggers instalados pelas migrações dão o mesmo que contar tudo de novo
+    db.execute("BEGIN")
+    A.recalcular_contadores(db)
+    assert _contadores(db) == contadores
+    db.rollback()
+
+
+def test_migrar_outra_vez_nao_faz_nada(tmp_path):
+    db = sqlite3.connect(tmp_path / 'alerta.db')
+    origem = sqlite3.connect(A.DB)
+    origem.backup(db)
+    origem.close()
+    antes = _contadores(db)
+    with A.app.app_context():
+        assert A.migrar(db) == A.MIGRACOES[-1][0]
+    assert _contadores(db) == antes
@@ -0,0 +1,57 @@
+from conftest import A, escrever, ler
+
+
+def _ocupacao(cliente):
+    return cliente.get('/api/ocupacao').get_json()
+
+
+def _contador(chave):
+    return ler("SELECT valor FROM contador WHERE chave=?", (chave,))[0][0]
+
+
+def test_familia_ocupa_a_zona(admin):
+    zid = escrever("INSERT INTO zona(nome, capacidade, recursos) VALUES('Zona ocupada', 10, '')")
+    admin.post('/admin/familia/add', data={'bairro': 'Muatala', 'numero': 4, 'situacao': 'Inundações',
+                                           'necessidades': '', 'zona_id': str(zid)})
+    assert ler("SELECT ocupacao FROM zona WHERE id=?", (zid,))[0][0] == 4
+    assert ler("SELECT abrigo FROM familia WHERE zona_id=?", (zid,))[0][0] == 'Zona ocupada'
+
+
+def test_eliminar_zona_liberta_as_familias(admin, cliente):
+    zid = escrever("INSERT INTO zona(nome, capacidade, recursos) VALUES('Zona a eliminar', 10, '')")
+    fids = [escrever("INSERT INTO familia(bairro, numero, situacao, abrigo, necessidades, zona_id) "
+                     "VALUES('Muhala', ?, 'Ciclone', 'Zona a eliminar', '', ?)", (n, zid)) for n in (3, 6)]
+    assert ler("SELECT ocupacao FROM zona WHERE id=?", (zid,))[0][0] == 9
+    antes, ocupacao = _ocupacao(cliente), _contador('ocupacao_total')
+    desde = A.versao_dados()
+
+    admin.get(f'/admin/zona/delete/{zid}')
+
+    assert not ler("SELECT 1 FROM zona WHERE id=?", (zid,))
+    familias = ler(f"SELECT zona_id, abrigo FROM familia WHERE id IN ({fids[0]}, {fids[1]})")
+    assert [tuple(f) for f in familias] == [(None, ''), (None, '')]
+    depois = _ocupacao(cliente)
+    assert depois['ocupacao'] == antes['ocupacao'] - 9
+    assert depois['por_alojar'] == antes['por_alojar'] + 9
+    assert zid not in [z['id'] for z in depois['zonas']]
+    assert _contador('ocupacao_total') == ocupacao - 9
+    # O site recebe a zona removida e as famílias já sem abrigo
+    with A.app.app_context():
+        delta = A.delta_desde(desde)
+    assert delta['zonas']['remove'] == [zid]
+    assert sorted((f['id'], f['abrigo']) for f in delta['familias']['upsert']) == [(fids[0], ''), (fids[1], '')]
+
+
+def test_contadores_depois_de_eliminar_zona(admin):
+    zid = escrever("INSERT INTO zona(nome, capacidade, recursos) VALUES('Zona lotada', 2, '')")
+    escrever("INSERT INTO familia(bairro, numero, situacao, abrigo, necessidades, zona_id) "
+             "VALUES('Muhala', 5, 'Ciclone', 'Zona lotada', '', ?)", (zid,))
+    lotadas = _contador('zonas_lotadas')
+    admin.get(f'/admin/zona/delete/{zid}')
+    assert _contador('zonas_lotadas') == lotadas - 1
+    with A.pool.escrita() as db:
+        contadores = sorted(map(tuple, db.execute("SELECT chave, valor FROM contador")))
+        db.execute("BEGIN")
+        A.recalcular_contadores(db)
+        assert sorted(map(tuple, db.execute("SELECT chave, valor FROM contador"))) == contadores
+        db.rollback()